@@ -0,0 +1,352 @@
+"""WebSocket load generator for SecureChat.
+
+Starts the app under uvicorn (cheap bcrypt, rate limits off, throwaway
+database), registers one account per room seat, mints a handshake token per
+connection through /api/ws-token, and drives simulated clients across rooms
+with a configurable message mix from several client processes. Results are written as JSON; pass
+--compare with an earlier result file to fail on throughput or latency
+regressions.
+
+    python -m benchmarks.ws_load --clients 1000 --room-size 20 --duration 30
+    python -m benchmarks.ws_load --compare benchmarks/results/baseline.json
+
+Latency is measured from send to receipt with time.perf_counter, which is
+CLOCK_MONOTONIC on Linux and therefore comparable across client processes. Server memory and CPU are read from
+/proc and are only reported when the harness launched the server itself.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+import httpx
+import websockets
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PASSWORD = "benchmark-pass-1"
+ROOM_PASSWORD = "benchmark-room-1"
+LARGE_ROOM_THRESHOLD = 50  # Above the default cap rooms are opened in large mode
+DELIVERED_TYPES = ('{"type":"message"', '{"type":"image"')
+
+class Stats:
+    def __init__(self):
+        self.measuring = False
+        self.sent: Dict[str, int] = {}
+        self.delivered = 0
+        self.latencies: List[float] = []
+        self.errors = 0
+
+    def record_send(self, kind: str):
+        if self.measuring:
+            self.sent[kind] = self.sent.get(kind, 0) + 1
+
+# --- server process ---
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def launch_server(port: int, workdir: str, clients: int) -> subprocess.Popen:
+    # Every client connects from 127.0.0.1, so the per-IP cap has to stay off; lag-driven
+    # shedding is off for the same reason rate limits are: it would cap the load being measured
+    env = dict(os.environ, DEV_MODE="1", BCRYPT_ROUNDS="4", RATE_LIMITS_ENABLED="0",
+               DATABASE_PATH=os.path.join(workdir, "bench.db"), BLOB_DIR=os.path.join(workdir, "blobs"),
+               SESSION_SECRET=os.urandom(32).hex(), SELF_DESTRUCT_MIN="1",
+               MAX_CONNECTIONS=str(clients), MAX_CONNECTIONS_PER_IP="0",
+               LAG_DEGRADE="inf", LAG_NO_NEW_ROOMS="inf", LAG_REJECT="inf")
+    log = open(os.path.join(workdir, "server.log"), "wb")
+    return subprocess.Popen([sys.executable, "-m", "uvicorn", "server.main:app", "--host", "127.0.0.1",
+                             "--port", str(port), "--log-level", "warning", "--no-access-log"],
+                            cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+async def wait_ready(base: str, proc: Optional[subprocess.Popen], timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base) as http:
+        while time.monotonic() < deadline:
+            if proc is not None and proc.poll() is not None:
+                raise RuntimeError(f"server exited with {proc.returncode}")
+            try:
+                if (await http.get("/health")).status_code == 200: return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError("server did not become ready")
+
+def rss_bytes(pid: int) -> Optional[int]:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+
+def cpu_seconds(pid: int) -> Optional[float]:
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except OSError:
+        return None
+
+# --- clients ---
+async def login_accounts(base: str, seats: int, concurrency: int) -> List[str]:
+    """One account per room seat (every room reuses the same handles); returns session cookies"""
+    limit = asyncio.Semaphore(concurrency)
+
+    async def account(i: int) -> str:
+        async with httpx.AsyncClient(base_url=base, timeout=30) as http, limit:
+            body = {"username": f"bench{i:05}", "password": PASSWORD}
+            await http.post("/api/register", json=body)
+            r = await http.post("/api/login", json=body)
+            r.raise_for_status()
+            return http.cookies["ghost_session"]
+
+    return await asyncio.gather(*(account(i) for i in range(seats)))
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    mix = {}
+    for part in spec.split(","):
+        kind, weight = part.split("=")
+        if kind not in ("text", "typing", "image", "self_destruct"):
+            raise ValueError(f"unknown message kind {kind!r}")
+        mix[kind] = float(weight)
+    return mix
+
+def build_frame(kind: str, payload: str, image_payload: str) -> str:
+    # perf_counter is CLOCK_MONOTONIC, shared by every process on the host
+    stamp = f"{time.perf_counter():.9f}|"
+    if kind == "typing":
+        return json.dumps({"type": "typing", "status": random.random() < 0.5})
+    if kind == "image":
+        return json.dumps({"type": "image", "content": stamp + image_payload})
+    frame = {"type": "message", "content": stamp + payload}
+    if kind == "self_destruct":
+        frame["self_destruct"] = 1
+    return json.dumps(frame)
+
+async def receiver(ws, stats: Stats):
+    try:
+        async for raw in ws:
+            if isinstance(raw, bytes) or not raw.startswith(DELIVERED_TYPES):
+                continue
+            now = time.perf_counter()
+            if stats.measuring:
+                content = json.loads(raw).get("content", "")
+                stats.delivered += 1
+                stats.latencies.append(now - float(content.split("|", 1)[0]))
+    except websockets.ConnectionClosed:
+        pass
+
+async def client(ws, args, mix: Dict[str, float], stats: Stats, stop: asyncio.Event):
+    kinds, weights = list(mix), list(mix.values())
+    payload = "x" * args.message_bytes
+    image_payload = "i" * args.image_bytes
+    recv = asyncio.create_task(receiver(ws, stats))
+    try:
+        await asyncio.sleep(random.random() / args.rate)  # Spread the first sends
+        while not stop.is_set():
+            kind = random.choices(kinds, weights)[0]
+            await ws.send(build_frame(kind, payload, image_payload))
+            stats.record_send(kind)
+            await asyncio.sleep(random.expovariate(args.rate))
+    except websockets.ConnectionClosed:
+        stats.errors += 1
+    finally:
+        await ws.close()
+        recv.cancel()
+
+async def connect_all(base: str, cookies: List[str], connections: List[int], args) -> list:
+    """Mint a handshake token per connection and open the sockets"""
+    limit = asyncio.Semaphore(args.connect_concurrency)
+    large = "&large=true" if args.room_size > LARGE_ROOM_THRESHOLD else ""
+    ws_base = "ws" + base[len("http"):]
+    sessions: Dict[int, httpx.AsyncClient] = {}
+
+    async def connect(n: int):
+        rid, seat = f"bench-{n // args.room_size}", n % args.room_size
+        if seat not in sessions:
+            sessions[seat] = httpx.AsyncClient(base_url=base, timeout=30, cookies={"ghost_session": cookies[seat]})
+        async with limit:
+            token = (await sessions[seat].get("/api/ws-token", params={"rid": rid})).json()["token"]
+            uri = f"{ws_base}/ws/{rid}/bench{seat:05}?pwd={ROOM_PASSWORD}&token={token}{large}"
+            ws = await websockets.connect(uri, max_size=None, ping_interval=None, open_timeout=60)
+            # A joined socket is sent the member list first; anything else is a refusal
+            if not (await ws.recv()).startswith('{"type":"user_list"'):
+                await ws.close()
+                return None
+            return ws
+
+    try:
+        return await asyncio.gather(*(connect(n) for n in connections))
+    finally:
+        for http in sessions.values():
+            await http.aclose()
+
+async def drive(base: str, cookies: List[str], connections: List[int], args, barrier) -> dict:
+    stats, stop = Stats(), asyncio.Event()
+    opened = await connect_all(base, cookies, connections, args)
+    sockets = [ws for ws in opened if ws is not None]
+    barrier.wait()  # Everyone connected; the parent samples memory
+    barrier.wait()  # Go
+    clients = [asyncio.create_task(client(ws, args, parse_mix(args.mix), stats, stop)) for ws in sockets]
+    await asyncio.sleep(args.warmup)
+    stats.measuring = True
+    await asyncio.sleep(args.duration)
+    stats.measuring = False
+    stop.set()
+    await asyncio.gather(*clients, return_exceptions=True)
+    return {"sent": stats.sent, "delivered": stats.delivered, "latencies": stats.latencies, "errors": stats.errors,
+            "connected": len(sockets), "refused": len(opened) - len(sockets)}
+
+def client_process(base: str, cookies: List[str], connections: List[int], args, barrier, results):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    results.put(asyncio.run(drive(base, cookies, connections, args, barrier)))
+
+def percentile(sorted_values: List[float], q: float) -> Optional[float]:
+    if not sorted_values: return None
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def run(args) -> dict:
+    workdir = tempfile.mkdtemp(prefix="securechat-bench-")
+    proc = None
+    if args.url:
+        base = args.url.rstrip("/")
+    else:
+        port = free_port()
+        base = f"http://127.0.0.1:{port}"
+        proc = launch_server(port, workdir, args.clients)
+    parse_mix(args.mix)  # Fail fast on a bad mix
+    ctx = multiprocessing.get_context("spawn")
+    barrier, results = ctx.Barrier(args.procs + 1), ctx.Queue()
+    workers = []
+    try:
+        asyncio.run(wait_ready(base, proc))
+        cookies = asyncio.run(login_accounts(base, min(args.room_size, args.clients), args.connect_concurrency))
+        rss_before = rss_bytes(proc.pid) if proc else None
+        workers = [ctx.Process(target=client_process, daemon=True,
+                               args=(base, cookies, list(range(i, args.clients, args.procs)), args, barrier, results))
+                   for i in range(args.procs)]
+        for worker in workers:
+            worker.start()
+        barrier.wait(timeout=args.connect_timeout)
+        time.sleep(1)  # Let join traffic drain
+        rss_after = rss_bytes(proc.pid) if proc else None
+        barrier.wait()
+        time.sleep(args.warmup)
+        cpu_start, started = cpu_seconds(proc.pid) if proc else None, time.perf_counter()
+        time.sleep(args.duration)
+        cpu_used = cpu_seconds(proc.pid) - cpu_start if proc else None
+        elapsed = time.perf_counter() - started
+        parts = [results.get(timeout=args.duration + 60) for _ in workers]
+    finally:
+        for worker in workers:
+            worker.join(timeout=10)
+            if worker.is_alive(): worker.terminate()
+        if proc:
+            proc.terminate()
+            proc.wait(timeout=30)
+
+    sent_by_kind: Dict[str, int] = {}
+    for part in parts:
+        for kind, count in part["sent"].items():
+            sent_by_kind[kind] = sent_by_kind.get(kind, 0) + count
+    latencies = sorted(x for part in parts for x in part["latencies"])
+    delivered = sum(part["delivered"] for part in parts)
+    sent = sum(sent_by_kind.values())
+    connected = sum(part["connected"] for part in parts)
+    return {
+        "benchmark": "ws_load",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        "results": {
+            "duration_s": round(elapsed, 3),
+            "sent": sent_by_kind,
+            "sent_per_sec": round(sent / elapsed, 1),
+            "delivered": delivered,
+            "delivered_per_sec": round(delivered / elapsed, 1),
+            "latency_ms": {name: round(percentile(latencies, q) * 1000, 3) if latencies else None
+                           for name, q in (("p50", 0.50), ("p99", 0.99), ("p999", 0.999), ("max", 1.0))},
+            "connected": connected,
+            "refused": sum(part["refused"] for part in parts),
+            "client_errors": sum(part["errors"] for part in parts),
+            "server": {
+                "rss_per_connection_bytes": (rss_after - rss_before) // connected if rss_before and rss_after and connected else None,
+                "cpu_seconds": round(cpu_used, 3) if cpu_used is not None else None,
+                "cpu_us_per_message": round(cpu_used * 1e6 / sent, 1) if cpu_used is not None and sent else None,
+                "cpu_us_per_delivery": round(cpu_used * 1e6 / delivered, 2) if cpu_used is not None and delivered else None,
+            },
+        },
+    }
+
+def compare(result: dict, baseline_path: str, tolerance: float) -> List[str]:
+    """Regressions beyond the tolerance relative to a previous result file"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)["results"]
+    current, problems = result["results"], []
+    if current["delivered_per_sec"] < baseline["delivered_per_sec"] * (1 - tolerance):
+        problems.append(f"throughput {current['delivered_per_sec']}/s < baseline {baseline['delivered_per_sec']}/s")
+    for q in ("p50", "p99"):
+        now, before = current["latency_ms"][q], baseline["latency_ms"][q]
+        if now is not None and before is not None and now > before * (1 + tolerance):
+            problems.append(f"{q} latency {now}ms > baseline {before}ms")
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive simulated WebSocket clients against SecureChat")
+    parser.add_argument("--clients", type=int, default=200, help="Total WebSocket connections")
+    parser.add_argument("--room-size", type=int, default=10, help="Connections per room")
+    parser.add_argument("--rate", type=float, default=1.0, help="Frames per second per client (Poisson)")
+    parser.add_argument("--mix", default="text=70,typing=20,image=5,self_destruct=5",
+                        help="Weighted message mix of text, typing, image and self_destruct")
+    parser.add_argument("--message-bytes", type=int, default=200, help="Ciphertext size of text messages")
+    parser.add_argument("--image-bytes", type=int, default=16384, help="Inline ciphertext size of image messages")
+    parser.add_argument("--duration", type=float, default=20, help="Measured seconds")
+    parser.add_argument("--warmup", type=float, default=3, help="Unmeasured seconds before measuring")
+    parser.add_argument("--procs", type=int, default=min(4, os.cpu_count() or 1), help="Client processes")
+    parser.add_argument("--connect-concurrency", type=int, default=100, help="Concurrent handshakes per process")
+    parser.add_argument("--connect-timeout", type=float, default=300)
+    parser.add_argument("--url", help="Benchmark an already running server instead of launching one")
+    parser.add_argument("--output", help="Result file (default benchmarks/results/ws_load-<time>.json)")
+    parser.add_argument("--compare", help="Earlier result file; exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed regression for --compare")
+    args = parser.parse_args()
+
+    result = run(args)
+    if result["results"]["refused"]:
+        # A run that did not reach the requested load is not a result to compare against
+        print(json.dumps(result["results"], indent=2))
+        sys.exit(f"{result['results']['refused']} of {args.clients} connections were refused; no result written")
+    output = args.output or os.path.join(ROOT, "benchmarks", "results", f"ws_load-{time.strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(result, f, indent=2)
+    print(json.dumps(result["results"], indent=2))
+    print(f"Wrote {output}")
+    if args.compare:
+        problems = compare(result, args.compare, args.tolerance)
+        for problem in problems:
+            print(f"REGRESSION: {problem}")
+        sys.exit(1 if problems else 0)
+
+if __name__ == "__main__":
+    main()
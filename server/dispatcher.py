@@ -0,0 +1,214 @@
+"""Sticky room-to-worker dispatcher.
+
+Runs N uvicorn workers on loopback ports and proxies client connections to
+them. WebSocket upgrades for /ws/{rid}/{user}, requests under /api/rooms/{rid}/
+and any request carrying a ?rid= query (e.g. /api/ws-token?rid=...) are routed
+through a consistent-hash ring so every member of a room lands on the same
+worker. Each worker's DimensionRegistry stays authoritative for its rooms and
+no backplane traffic is needed. Everything else goes to any live worker.
+
+Workers that exit are dropped from the ring (only their rooms move), restarted,
+and re-added once they accept connections again.
+
+    python -m server.dispatcher --workers 4 --port 8000
+"""
+import argparse
+import asyncio
+import bisect
+import hashlib
+import itertools
+import logging
+import os
+import signal
+import sys
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlsplit
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+logger = logging.getLogger("GhostDispatcher")
+
+MAX_HEAD_BYTES = 64 * 1024
+PIPE_CHUNK = 64 * 1024
+WS_MAX_FRAME_BYTES = os.getenv("WS_MAX_FRAME_BYTES", str(1024 * 1024))  # Passed to workers as --ws-max-size
+
+class HashRing:
+    """Consistent-hash ring with virtual nodes; adding or removing a node only moves its share of keys"""
+    def __init__(self, nodes=(), replicas: int = 128):
+        self.replicas = replicas
+        self._keys: List[int] = []
+        self._owners: Dict[int, str] = {}
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+    def add(self, node: str):
+        for i in range(self.replicas):
+            h = self._hash(f"{node}#{i}")
+            if h not in self._owners:
+                self._owners[h] = node
+                bisect.insort(self._keys, h)
+
+    def remove(self, node: str):
+        for i in range(self.replicas):
+            h = self._hash(f"{node}#{i}")
+            if self._owners.get(h) == node:
+                del self._owners[h]
+                self._keys.pop(bisect.bisect_left(self._keys, h))
+
+    def get(self, key: str) -> Optional[str]:
+        if not self._keys:
+            return None
+        i = bisect.bisect(self._keys, self._hash(key)) % len(self._keys)
+        return self._owners[self._keys[i]]
+
+    def __contains__(self, node: str) -> bool:
+        return node in self._owners.values()
+
+def route_key(target: str) -> Optional[str]:
+    """Room id a request target is pinned to, or None if any worker may serve it"""
+    parts = urlsplit(target)
+    segments = parts.path.split("/")
+    if len(segments) >= 3 and segments[1] == "ws" and segments[2]:
+        return segments[2]
+    if len(segments) >= 4 and segments[1:3] == ["api", "rooms"] and segments[3]:
+        return segments[3]
+    rid = parse_qs(parts.query).get("rid")
+    return rid[0] if rid else None
+
+class Dispatcher:
+    def __init__(self, workers: int, base_port: int, app: str = "server.main:app"):
+        self.app = app
+        self.ports = {f"127.0.0.1:{base_port + i}": base_port + i for i in range(workers)}
+        self.ring = HashRing()
+        self._any = itertools.cycle(list(self.ports))
+
+    # --- worker supervision ---
+    async def supervise(self, node: str, index: int):
+        backoff = 0.5
+        while True:
+            # Without SESSION_SECRET the workers share the key file main.py generates under state/
+            env = dict(os.environ, WORKER_INDEX=str(index))
+            proc = await asyncio.create_subprocess_exec(
+                sys.executable, "-m", "uvicorn", self.app, "--host", "127.0.0.1",
+                "--port", str(self.ports[node]), "--proxy-headers", "--ws-max-size", WS_MAX_FRAME_BYTES, env=env)
+            try:
+                if await self._wait_ready(node, proc):
+                    self.ring.add(node)
+                    logger.info("Worker %s joined the ring (pid %d)", node, proc.pid)
+                    backoff = 0.5
+                await proc.wait()
+            finally:
+                if proc.returncode is None:
+                    proc.terminate()
+                    await proc.wait()
+            if node in self.ring:
+                self.ring.remove(node)
+            logger.warning("Worker %s exited with %s; restarting in %ss", node, proc.returncode, backoff)
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+
+    async def _wait_ready(self, node: str, proc) -> bool:
+        host, port = node.split(":")
+        for _ in range(100):
+            if proc.returncode is not None:
+                return False
+            try:
+                _, w = await asyncio.open_connection(host, int(port))
+                w.close()
+                return True
+            except OSError:
+                await asyncio.sleep(0.1)
+        return False
+
+    def pick(self, key: Optional[str]) -> Optional[str]:
+        if key is not None:
+            return self.ring.get(key)
+        for _ in range(len(self.ports)):
+            node = next(self._any)
+            if node in self.ring:
+                return node
+        return None
+
+    # --- proxy ---
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            writer.close()
+            return
+        lines = head[:-4].decode("latin-1").split("\r\n")
+        try:
+            _, target, _ = lines[0].split(" ", 2)
+        except ValueError:
+            writer.close()
+            return
+        node = self.pick(route_key(target))
+        if node is None:
+            writer.write(b"HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            await writer.drain()
+            writer.close()
+            return
+
+        headers = lines[1:]
+        upgrade = any(h.lower().startswith("upgrade:") for h in headers)
+        if not upgrade:
+            # One request per upstream connection so the next request is routed afresh
+            headers = [h for h in headers if not h.lower().startswith(("connection:", "keep-alive:"))]
+            headers.append("Connection: close")
+        peer = writer.get_extra_info("peername")
+        if peer:
+            headers.append(f"X-Forwarded-For: {peer[0]}")
+        host, port = node.split(":")
+        try:
+            up_reader, up_writer = await asyncio.open_connection(host, int(port))
+        except OSError:
+            writer.close()
+            return
+        up_writer.write("\r\n".join([lines[0]] + headers).encode("latin-1") + b"\r\n\r\n")
+        await asyncio.gather(self._pipe(reader, up_writer), self._pipe(up_reader, writer))
+
+    @staticmethod
+    async def _pipe(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                data = await reader.read(PIPE_CHUNK)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            writer.close()
+
+async def serve(args):
+    dispatcher = Dispatcher(args.workers, args.worker_base_port, args.app)
+    supervisors = [asyncio.create_task(dispatcher.supervise(node, i)) for i, node in enumerate(dispatcher.ports)]
+    server = await asyncio.start_server(dispatcher.handle, args.host, args.port,
+                                        limit=MAX_HEAD_BYTES, reuse_port=args.reuse_port)
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_running_loop().add_signal_handler(sig, stop.set)
+    logger.info("Dispatcher listening on %s:%d with %d workers", args.host, args.port, args.workers)
+    async with server:
+        await stop.wait()
+    # Workers get SIGTERM and run their own graceful shutdown
+    for task in supervisors:
+        task.cancel()
+    await asyncio.gather(*supervisors, return_exceptions=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Route rooms to worker processes by consistent hashing")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 8000)))
+    parser.add_argument("--worker-base-port", type=int, default=9100)
+    parser.add_argument("--app", default="server.main:app")
+    parser.add_argument("--reuse-port", action="store_true", help="Set SO_REUSEPORT so several dispatchers can share the port")
+    asyncio.run(serve(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
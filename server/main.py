@@ -1,26 +1,44 @@
+import fcntl
+import glob
+import gzip
 import json
+import math
+import mmap
+import multiprocessing
+import random
+import signal
+import struct
+import tempfile
 import os
 import sqlite3
 import asyncio
+import atexit
+import bisect
+import hashlib
+import heapq
+import hmac
+import queue
+import threading
 import uuid
 import bcrypt
 import logging
 import re
 import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
-from typing import Dict, List, Optional, Set
+from typing import AsyncIterator, Awaitable, Callable, Collection, Deque, Dict, List, Optional, Set, Tuple, Union
 import secrets
+import shutil
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request, Query, HTTPException, Response
 from fastapi.responses import JSONResponse, FileResponse
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 
-# NASA-Grade Logging Configuration
-logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
-logger = logging.getLogger("GhostOracle")
-
-limiter = Limiter(key_func=get_remote_address)
+# RATE_LIMITS_ENABLED=0 turns off HTTP and WebSocket limits (load testing only)
+RATE_LIMITS_ENABLED = os.getenv("RATE_LIMITS_ENABLED", "1") != "0"
+limiter = Limiter(key_func=get_remote_address, enabled=RATE_LIMITS_ENABLED)
 app = FastAPI(title="GhostChat Oracle Prime")
 
 app.state.limiter = limiter
@@ -32,22 +50,116 @@ from fastapi.middleware.trustedhost import TrustedHostMiddleware
 from fastapi.staticfiles import StaticFiles
 
 # ===== LOGGING SETUP (CODE-3 FIX) =====
-import logging
-from logging.handlers import RotatingFileHandler
-
-# Create logs directory if it doesn't exist
-os.makedirs('logs', exist_ok=True)
-
-# Configure comprehensive logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        RotatingFileHandler('logs/securechat.log', maxBytes=10*1024*1024, backupCount=5),
-        logging.StreamHandler()
-    ]
-)
-logger = logging.getLogger(__name__)
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FILE = os.getenv("LOG_FILE", "logs/securechat.log")  # Empty disables the file
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # text or json (one object per line)
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))  # Records beyond this are dropped, never waited on
+LOG_RATE_LIMITS = os.getenv("LOG_RATE_LIMITS", "auth=20/60")  # category=records/seconds, comma separated
+LOG_SAMPLING = os.getenv("LOG_SAMPLING", "")  # category=fraction kept, e.g. access=0.01
+
+def parse_log_rules(spec: str, parse) -> Dict[str, object]:
+    """'auth=20/60,ws=0.1' -> {'GhostOracle.auth': parse('20/60'), ...}"""
+    rules = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, value = item.partition("=")
+        rules[f"GhostOracle.{name.strip()}"] = parse(value.strip())
+    return rules
+
+def parse_log_rate(value: str) -> Tuple[int, float]:
+    count, _, period = value.partition("/")
+    return int(count), float(period or 1)
+
+class LogThrottle(logging.Filter):
+    """Per-category sampling and fixed-window rate limits, applied before a record is queued.
+
+    Categories are child loggers of GhostOracle (e.g. GhostOracle.auth). When a
+    window reopens, the first record carries the number suppressed in the last one.
+    """
+    def __init__(self, limits: Dict[str, Tuple[int, float]], sampling: Dict[str, float]):
+        super().__init__()
+        self.limits = limits
+        self.sampling = sampling
+        self._windows: Dict[str, List[float]] = {}  # category -> [window start, count, suppressed]
+        self.suppressed = 0
+        self.sampled_out = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        name = record.name
+        if record.levelno >= logging.ERROR: return True
+        rate = self.sampling.get(name)
+        if rate is not None and random.random() >= rate:
+            self.sampled_out += 1
+            return False
+        limit = self.limits.get(name)
+        if limit is None: return True
+        count, period = limit
+        window = self._windows.setdefault(name, [record.created, 0, 0])
+        if record.created - window[0] >= period:
+            if window[2]: record.suppressed = window[2]
+            window[:] = [record.created, 0, 0]
+        if window[1] >= count:
+            window[2] += 1
+            self.suppressed += 1
+            return False
+        window[1] += 1
+        return True
+
+class ThreadQueueHandler(QueueHandler):
+    """Hands records to the writer thread as-is: message formatting happens there, not on the event loop"""
+    def __init__(self, q: "queue.Queue"):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class LogFormatter(logging.Formatter):
+    """Plain text lines, or JSON lines when LOG_FORMAT=json"""
+    def __init__(self, structured: bool = False):
+        super().__init__('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        self.structured = structured
+
+    def format(self, record: logging.LogRecord) -> str:
+        suppressed = getattr(record, "suppressed", 0)
+        if not self.structured:
+            line = super().format(record)
+            return f"{line} ({suppressed} similar suppressed)" if suppressed else line
+        entry = {"ts": record.created, "level": record.levelname, "logger": record.name, "msg": record.getMessage()}
+        if suppressed: entry["suppressed"] = suppressed
+        if record.exc_info: entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+def setup_logging() -> Tuple[ThreadQueueHandler, LogThrottle, QueueListener]:
+    """Route every record through a bounded queue to one writer thread that owns the file and stderr"""
+    formatter = LogFormatter(LOG_FORMAT == "json")
+    handlers: List[logging.Handler] = [logging.StreamHandler()]
+    if LOG_FILE:
+        os.makedirs(os.path.dirname(LOG_FILE) or ".", exist_ok=True)
+        handlers.append(RotatingFileHandler(LOG_FILE, maxBytes=10*1024*1024, backupCount=5))
+    for handler in handlers: handler.setFormatter(formatter)
+    throttle = LogThrottle(parse_log_rules(LOG_RATE_LIMITS, parse_log_rate), parse_log_rules(LOG_SAMPLING, float))
+    handler = ThreadQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    handler.addFilter(throttle)
+    root = logging.getLogger()
+    for old in root.handlers[:]: root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+    listener = QueueListener(handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)  # Flushes whatever is still queued
+    return handler, throttle, listener
+
+log_handler, log_throttle, log_listener = setup_logging()
+logger = logging.getLogger("GhostOracle")
+auth_logger = logger.getChild("auth")  # Failed logins can be flooded; rate limited by default
 
 # ===== CORS CONFIGURATION (HIGH-4 FIX) =====
 # Restrict CORS in production
@@ -115,20 +227,451 @@ def validate_password(password: str) -> str:
     return password
 
 # --- FINTECH-GRADE SECURITY ---
-def hash_password(p: str) -> str:
-    return bcrypt.hashpw(p.encode('utf-8'), bcrypt.gensalt(12)).decode('utf-8')
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
 
-def verify_password(p: str, h: str) -> bool:
-    try: return bcrypt.checkpw(p.encode('utf-8'), h.encode('utf-8'))
-    except: return False
+def hash_password(p: str, rounds: int = BCRYPT_ROUNDS) -> str:
+    return bcrypt.hashpw(p.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
 
-def get_db():
-    db_path = os.getenv("DATABASE_PATH", "database.db")
-    db = sqlite3.connect(db_path, check_same_thread=False)
-    db.execute("PRAGMA journal_mode=WAL")
+def password_needs_rehash(h: str, rounds: int = BCRYPT_ROUNDS) -> bool:
+    """True if a stored hash was made with a lower cost than currently configured"""
+    try: return int(h.split("$")[2]) < rounds
+    except (IndexError, ValueError): return False
+
+# ===== METRICS =====
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+DEPTH_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 1024)
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")  # If set, /metrics requires "Authorization: Bearer <token>"
+
+class Histogram:
+    """Fixed-bucket histogram; observe() only bumps preallocated slots.
+
+    Updates from DB threads are not locked, so a concurrent increment can be
+    lost now and then; that is an accepted trade for a lock-free hot path.
+    """
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class HistogramFamily(Histogram):
+    """A histogram that can also be split by one label; children are created on first use"""
+    __slots__ = ("label", "children")
+
+    def __init__(self, bounds: Tuple[float, ...], label: Optional[str] = None):
+        super().__init__(bounds)
+        self.label = label
+        self.children: Dict[str, Histogram] = {}
+
+    def labels(self, value: str) -> Histogram:
+        child = self.children.get(value)
+        if child is None:
+            child = self.children[value] = Histogram(self.bounds)
+        return child
+
+class Gauge:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value: float):
+        self.value = value
+
+def _label(name: str, value) -> str:
+    value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'{name}="{value}"'
+
+class Metrics:
+    """Prometheus text exposition. Hot paths hold direct references to their
+    instruments; everything else is read from existing stats at scrape time."""
+    def __init__(self):
+        self._entries: List[tuple] = []
+
+    def histogram(self, name: str, help: str, bounds: Tuple[float, ...] = LATENCY_BUCKETS,
+                  label: Optional[str] = None) -> HistogramFamily:
+        family = HistogramFamily(bounds, label)
+        self._entries.append((name, help, "histogram", family))
+        return family
+
+    def gauge(self, name: str, help: str) -> Gauge:
+        gauge = Gauge()
+        self._entries.append((name, help, "gauge", lambda: gauge.value))
+        return gauge
+
+    def collect(self, name: str, help: str, kind: str, fn: Callable[[], Union[float, Dict[str, float]]],
+                label: Optional[str] = None):
+        """Register a value computed at scrape time; fn may return {label value: number}"""
+        self._entries.append((name, help, kind, fn if label is None else (label, fn)))
+
+    def render(self) -> str:
+        lines = []
+        for name, help, kind, source in self._entries:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "histogram":
+                if source.label is None:
+                    self._render_histogram(lines, name, source, "")
+                for value, child in list(source.children.items()):
+                    self._render_histogram(lines, name, child, _label(source.label, value) + ",")
+            elif isinstance(source, tuple):
+                label, fn = source
+                for value, number in fn().items():
+                    lines.append(f"{name}{{{_label(label, value)}}} {number}")
+            else:
+                lines.append(f"{name} {source()}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _render_histogram(lines: List[str], name: str, h: Histogram, labels: str):
+        cumulative = 0
+        for bound, count in zip(h.bounds, h.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels}le="+Inf"}} {h.count}')
+        suffix = f"{{{labels.rstrip(',')}}}" if labels else ""
+        lines.append(f"{name}_sum{suffix} {h.sum}")
+        lines.append(f"{name}_count{suffix} {h.count}")
+
+metrics = Metrics()
+FANOUT_SECONDS = metrics.histogram("securechat_broadcast_fanout_seconds", "Time to encode and queue one room broadcast")
+QUEUE_DEPTH = metrics.histogram("securechat_send_queue_depth", "Frames queued on a socket after each enqueue", DEPTH_BUCKETS)
+PARSE_SECONDS = metrics.histogram("securechat_frame_parse_seconds", "Time to decode one inbound WebSocket text frame")
+DB_SECONDS = metrics.histogram("securechat_db_query_seconds", "SQLite statement execution time", label="statement")
+BCRYPT_SECONDS = metrics.histogram("securechat_bcrypt_seconds", "bcrypt call time including pool wait", label="op")
+LOOP_LAG_SECONDS = metrics.histogram("securechat_event_loop_lag_seconds", "How late the event loop wakes a sleeping task")
+LOOP_LAG = metrics.gauge("securechat_event_loop_lag_last_seconds", "Most recent event loop lag sample")
+
+_statement_labels: Dict[str, str] = {}
+
+def statement_label(sql: str) -> str:
+    """Low-cardinality label for a SQL string, e.g. "SELECT users"; cached per statement"""
+    label = _statement_labels.get(sql)
+    if label is None:
+        words = sql.split()
+        upper = [w.upper() for w in words]
+        table = next((words[i + 1] for i, w in enumerate(upper[:-1]) if w in ("FROM", "INTO", "UPDATE")), "")
+        label = _statement_labels[sql] = f"{upper[0] if upper else '?'} {table}".strip()
+    return label
+
+async def monitor_loop_lag():
+    """Sample event loop lag by measuring how late a fixed sleep returns"""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, time.perf_counter() - started - LOOP_LAG_INTERVAL)
+        LOOP_LAG.set(lag)
+        LOOP_LAG_SECONDS.observe(lag)
+        registry.admission.observe_lag(lag)
+
+# ===== PASSWORD HASHING POOL =====
+class HasherSaturated(Exception):
+    """Raised when too many hashes are already queued"""
+
+class PasswordHasher:
+    """Runs bcrypt on a bounded process pool so hashing never blocks the event loop.
+
+    At most max_pending calls may be running or queued; beyond that callers get
+    HasherSaturated immediately, which the API turns into a 503.
+    """
+    def __init__(self, workers: int, max_pending: int):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.calls = 0
+        self.rejected = 0
+        self.total_seconds = 0.0
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def start(self):
+        """Create the pool and start its workers.
+
+        Workers come from a forkserver (spawn where unavailable), never from a fork
+        of this process: by now it runs the log writer and database threads, and a
+        forked child would also inherit the server's signal handlers and ignore SIGTERM.
+        """
+        if self._pool is None:
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context(method))
+            self._pool.submit(int).result()
+
+    # Workers run the bcrypt builtins directly, so they never import this module
+    async def hash(self, p: str) -> str:
+        salt = bcrypt.gensalt(BCRYPT_ROUNDS)
+        return (await self._run(BCRYPT_SECONDS.labels("hash"), bcrypt.hashpw, p.encode('utf-8'), salt)).decode('utf-8')
+
+    async def verify(self, p: str, h: str) -> bool:
+        try: return await self._run(BCRYPT_SECONDS.labels("verify"), bcrypt.checkpw, p.encode('utf-8'), h.encode('utf-8'))
+        except ValueError: return False  # Malformed stored hash
+
+    async def _run(self, timing: Histogram, fn, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HasherSaturated()
+        self.start()
+        self.pending += 1
+        started = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._pool, fn, *args)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.pending -= 1
+            self.calls += 1
+            self.total_seconds += elapsed
+            timing.observe(elapsed)
+
+    def stats(self) -> dict:
+        return {
+            "pool_size": self.workers,
+            "in_flight": self.pending,
+            "queue_depth": max(0, self.pending - self.workers),
+            "rejected": self.rejected,
+            "calls": self.calls,
+            "avg_ms": round(self.total_seconds * 1000 / self.calls, 1) if self.calls else 0.0,
+        }
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+hasher = PasswordHasher(workers=int(os.getenv("BCRYPT_POOL_SIZE", str(min(4, os.cpu_count() or 1)))),
+                        max_pending=int(os.getenv("BCRYPT_MAX_PENDING", "32")))
+
+async def hasher_saturated_handler(request: Request, exc: HasherSaturated):
+    return JSONResponse({"status": "fail", "msg": "Server busy, try again shortly"}, status_code=503,
+                        headers={"Retry-After": "1"})
+
+app.add_exception_handler(HasherSaturated, hasher_saturated_handler)
+
+# ===== SESSIONS =====
+SESSION_TTL = int(os.getenv("SESSION_TTL", str(7 * 86400)))
+SESSION_SECRET_PATH = os.getenv("SESSION_SECRET_PATH", "state/session.key")
+
+def load_session_secret(path: str = SESSION_SECRET_PATH) -> bytes:
+    """SESSION_SECRET, else a key generated once into an owner-only file and reused by every later process.
+
+    Restarts must keep cookies valid: clients told to reconnect after a deploy fetch a new ws-token with them.
+    """
+    if os.getenv("SESSION_SECRET"): return os.getenv("SESSION_SECRET").encode("utf-8")
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(secrets.token_hex(32))
+        try:
+            os.link(tmp, path)  # Atomic and never overwrites: concurrent workers all end up with the first key
+            logger.warning("SESSION_SECRET not set: generated a session key in %s", path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp)
+    with open(path) as f:
+        return f.read().strip().encode("utf-8")
+
+SESSION_SECRET = load_session_secret()
+
+def _session_signature(payload: str) -> str:
+    return hmac.new(SESSION_SECRET, payload.encode("utf-8"), hashlib.sha256).hexdigest()
+
+def sign_session(uid: int, ttl: int = SESSION_TTL) -> str:
+    """Session cookie value: uid.expires.hmac, verifiable without a DB round trip"""
+    payload = f"{uid}.{int(time.time()) + ttl}"
+    return f"{payload}.{_session_signature(payload)}"
+
+def verify_session(token: Optional[str]) -> Optional[int]:
+    """Return the user id of a valid, unexpired session token"""
+    try:
+        uid, expires, sig = token.split(".")
+        if hmac.compare_digest(sig, _session_signature(f"{uid}.{expires}")) and int(expires) > time.time():
+            return int(uid)
+    except (AttributeError, ValueError):
+        pass
+    return None
+
+class TTLCache:
+    """Bounded LRU cache whose entries also expire after ttl seconds"""
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[object, Tuple[float, object]]" = OrderedDict()
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None: return None
+        if entry[0] <= time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return entry[1]
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+user_cache = TTLCache(int(os.getenv("USER_CACHE_SIZE", "10000")), float(os.getenv("USER_CACHE_TTL", "300")))
+
+def session_uid(request: Request) -> int:
+    uid = verify_session(request.cookies.get("ghost_session"))
+    if uid is None:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    return uid
+
+async def session_user(request: Request) -> Tuple[int, str]:
+    """Resolve the session cookie to (uid, username), hitting SQLite only on a cache miss"""
+    uid = session_uid(request)
+    user = user_cache.get(uid)
+    if user is None:
+        res = await database.fetchone("SELECT username FROM users WHERE id = ?", (uid,))
+        if not res: raise HTTPException(status_code=401)
+        user = res['username']
+        user_cache.set(uid, user)
+    return uid, user
+
+# ===== DATA ACCESS LAYER =====
+SQLITE_PRAGMAS = {
+    "journal_mode": os.getenv("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "cache_size": os.getenv("SQLITE_CACHE_SIZE", "-16000"),  # Negative values are KiB
+    "mmap_size": os.getenv("SQLITE_MMAP_SIZE", str(64 * 1024 * 1024)),
+}
+SQLITE_STATEMENT_CACHE = int(os.getenv("SQLITE_STATEMENT_CACHE", "128"))
+
+def connect_db(path: str, **kwargs) -> sqlite3.Connection:
+    """Open a connection with the tuned pragmas applied once"""
+    db = sqlite3.connect(path, check_same_thread=False, cached_statements=SQLITE_STATEMENT_CACHE, **kwargs)
+    for pragma, value in SQLITE_PRAGMAS.items():
+        db.execute(f"PRAGMA {pragma}={value}")
     db.row_factory = sqlite3.Row
     return db
 
+def get_db():
+    return connect_db(os.getenv("DATABASE_PATH", "database.db"))
+
+class Database:
+    """Awaitable SQLite access that keeps queries off the event loop.
+
+    Reads run on a small thread pool, each thread holding one long-lived
+    connection so sqlite3's statement cache is reused. Writes are serialized
+    through a single writer thread that drains whatever is queued and commits
+    it as one transaction (group commit); each submitted unit runs inside its
+    own savepoint so a failing unit never rolls back its neighbours.
+    """
+    def __init__(self, path: str, readers: int = 4, batch_max: int = 64):
+        self.path = path
+        self.batch_max = batch_max
+        self._read_pool = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-read")
+        self._local = threading.local()
+        self._writes: "queue.Queue" = queue.Queue()
+        self._writer: Optional[threading.Thread] = None
+        self._writer_lock = threading.Lock()
+
+    def _reader(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = connect_db(self.path, isolation_level=None)
+            db.execute("PRAGMA query_only=1")
+        return db
+
+    async def fetchone(self, sql: str, params: tuple = ()):
+        return await asyncio.get_running_loop().run_in_executor(self._read_pool, self._read, sql, params, False)
+
+    async def fetchall(self, sql: str, params: tuple = ()):
+        return await asyncio.get_running_loop().run_in_executor(self._read_pool, self._read, sql, params, True)
+
+    def _read(self, sql: str, params: tuple, many: bool):
+        started = time.perf_counter()
+        cursor = self._reader().execute(sql, params)
+        rows = cursor.fetchall() if many else cursor.fetchone()
+        DB_SECONDS.labels(statement_label(sql)).observe(time.perf_counter() - started)
+        return rows
+
+    async def execute(self, sql: str, params: tuple = ()) -> int:
+        """Run one write statement; returns its rowcount"""
+        return (await self.transaction([(sql, params)]))[0]
+
+    async def transaction(self, statements: List[Tuple[str, tuple]]) -> List[int]:
+        """Run several write statements atomically; returns their rowcounts"""
+        self._ensure_writer()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._writes.put((statements, future, loop))
+        return await future
+
+    def _ensure_writer(self):
+        if self._writer is None:
+            with self._writer_lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._write_loop, name="db-writer", daemon=True)
+                    self._writer.start()
+
+    def _write_loop(self):
+        db = connect_db(self.path, isolation_level=None)
+        running = True
+        while running:
+            batch = [self._writes.get()]
+            while len(batch) < self.batch_max:
+                try: batch.append(self._writes.get_nowait())
+                except queue.Empty: break
+            if None in batch:
+                running = False
+                batch = [unit for unit in batch if unit is not None]
+            if not batch: continue
+            outcomes = []
+            db.execute("BEGIN")
+            for statements, future, loop in batch:
+                db.execute("SAVEPOINT unit")
+                try:
+                    counts = [_timed_write(db, sql, params) for sql, params in statements]
+                    db.execute("RELEASE unit")
+                    outcomes.append((future, loop, counts, None))
+                except Exception as e:
+                    db.execute("ROLLBACK TO unit")
+                    db.execute("RELEASE unit")
+                    outcomes.append((future, loop, None, e))
+            try:
+                db.execute("COMMIT")
+            except Exception as e:
+                db.execute("ROLLBACK")
+                outcomes = [(future, loop, None, e) for future, loop, _, _ in outcomes]
+            for future, loop, counts, error in outcomes:
+                loop.call_soon_threadsafe(_settle, future, counts, error)
+        db.close()
+
+    def close(self):
+        if self._writer is not None:
+            self._writes.put(None)
+            self._writer.join(timeout=5)
+            self._writer = None
+        self._read_pool.shutdown(wait=False)
+
+def _timed_write(db: sqlite3.Connection, sql: str, params: tuple) -> int:
+    started = time.perf_counter()
+    rowcount = db.execute(sql, params).rowcount
+    DB_SECONDS.labels(statement_label(sql)).observe(time.perf_counter() - started)
+    return rowcount
+
+def _settle(future: asyncio.Future, result, error: Optional[Exception]):
+    if future.cancelled(): return
+    if error is not None: future.set_exception(error)
+    else: future.set_result(result)
 
 def init_db():
     """Initialize database with proper indexes and WAL mode"""
@@ -138,48 +681,170 @@ def init_db():
         # SECURITY & PERFORMANCE: Add indexes
         db.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)")
         db.execute("CREATE INDEX IF NOT EXISTS idx_history_user_id ON history(user_id)")
-        # Enable WAL mode
-        db.execute("PRAGMA journal_mode=WAL")
         db.commit()
     logger.info("Database initialized successfully")
 
+TOKEN_SWEEP_INTERVAL = int(os.getenv("TOKEN_SWEEP_INTERVAL", "10"))
+
 # ===== BACKUP SYSTEM (CRITICAL-2 FIX) =====
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_INTERVAL = int(os.getenv("BACKUP_INTERVAL", "86400"))  # Seconds between backups
+BACKUP_RETENTION = int(os.getenv("BACKUP_RETENTION", "7"))  # Compressed copies kept
+BACKUP_PAGES_PER_STEP = int(os.getenv("BACKUP_PAGES_PER_STEP", "256"))
+BACKUP_STEP_SLEEP = float(os.getenv("BACKUP_STEP_SLEEP", "0.05"))  # Pause between steps so writers get the lock
+backup_stats = {"count": 0, "failures": 0, "last_file": None, "last_size": 0, "last_duration": 0.0, "last_finished": None}
+
+def snapshot_database(db_path: str, dest_dir: str = BACKUP_DIR, pages: int = BACKUP_PAGES_PER_STEP,
+                      sleep: float = BACKUP_STEP_SLEEP) -> Tuple[str, int]:
+    """Copy a live database with SQLite's online backup API, then checkpoint and gzip it.
+
+    Blocking; run it in a worker thread. The backup reads a consistent snapshot
+    including pages still in the -wal file. Returns (path, compressed size).
+    """
+    os.makedirs(dest_dir, exist_ok=True)
+    raw = os.path.join(dest_dir, f"database_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db")
+    src, dst = sqlite3.connect(db_path, timeout=30), sqlite3.connect(raw)
+    try:
+        src.backup(dst, pages=pages, sleep=sleep)
+        # Fold any WAL frames into the copy so it is a single self-contained file
+        dst.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        dst.execute("PRAGMA journal_mode=DELETE")
+    finally:
+        dst.close()
+        src.close()
+    with open(raw, "rb") as f_in, gzip.open(raw + ".gz", "wb", compresslevel=6) as f_out:
+        shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+    os.remove(raw)
+    return raw + ".gz", os.path.getsize(raw + ".gz")
+
+def prune_backups(dest_dir: str = BACKUP_DIR, keep: int = BACKUP_RETENTION) -> List[str]:
+    """Delete all but the newest `keep` backups (timestamped names sort chronologically)"""
+    backups = sorted(glob.glob(os.path.join(dest_dir, "database_backup_*.db*")))
+    removed = backups[:-keep] if keep > 0 else backups
+    for old_backup in removed:
+        os.remove(old_backup)
+        logger.info("Removed old backup: %s", old_backup)
+    return removed
+
+def backup_if_due(db_path: str, dest_dir: str = BACKUP_DIR, interval: float = BACKUP_INTERVAL) -> Optional[Tuple[str, int]]:
+    """Back up and prune unless another worker holds the backup lock or backed up within half an interval.
+
+    Every worker runs the scheduler, however the workers were started; the lock
+    file in the backup directory makes exactly one of them do each round.
+    """
+    os.makedirs(dest_dir, exist_ok=True)
+    with open(os.path.join(dest_dir, ".lock"), "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+        latest = max(glob.glob(os.path.join(dest_dir, "database_backup_*.db*")), key=os.path.getmtime, default=None)
+        if latest and os.path.getmtime(latest) > time.time() - interval / 2: return None
+        result = snapshot_database(db_path, dest_dir)
+        prune_backups(dest_dir)
+        return result
+
 async def backup_database():
-    """Automated daily database backup with rotation"""
-    import shutil
-    from datetime import datetime
-    
+    """Periodic online backup with rotation; the copy and compression run off the event loop"""
+    loop = asyncio.get_running_loop()
     while True:
+        await asyncio.sleep(BACKUP_INTERVAL)
+        started = time.monotonic()
         try:
-            await asyncio.sleep(86400)  # Wait 24 hours
-            
-            os.makedirs('backups', exist_ok=True)
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            backup_file = f'backups/database_backup_{timestamp}.db'
-            db_path = os.getenv("DATABASE_PATH", "database.db")
-            shutil.copy2(db_path, backup_file)
-            logger.info(f"Database backed up to {backup_file}")
-            
-            # Rotate: keep last 7 days
-            import glob
-            backups = sorted(glob.glob('backups/database_backup_*.db'))
-            if len(backups) > 7:
-                for old_backup in backups[:-7]:
-                    os.remove(old_backup)
-                    logger.info(f"Removed old backup: {old_backup}")
-                    
+            result = await loop.run_in_executor(None, backup_if_due, database.path)
+            if result is None: continue  # Another worker took this round
+            path, size = result
+            duration = time.monotonic() - started
+            backup_stats.update(count=backup_stats["count"] + 1, last_file=path, last_size=size,
+                                last_duration=round(duration, 3), last_finished=datetime.now().isoformat())
+            logger.info("Database backed up to %s (%d bytes in %.2fs)", path, size, duration)
         except Exception as e:
-            logger.error(f"Backup failed: {e}")
+            backup_stats["failures"] += 1
+            logger.error("Backup failed: %s", e)
+
+async def sweep_blobs():
+    """Remove uploads that no message ever referenced"""
+    while True:
+        await asyncio.sleep(BLOB_SWEEP_INTERVAL)
+        try:
+            removed = await asyncio.get_running_loop().run_in_executor(None, registry.blobs.sweep)
+            if removed: logger.info("Swept %d orphaned blobs", removed)
+        except Exception as e:
+            logger.error("Blob sweep failed: %s", e)
+
+async def run_heartbeat():
+    """Single scheduler for every socket's heartbeat; no per-connection tasks"""
+    while True:
+        await asyncio.sleep(min(HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT) / 2)
+        try:
+            await registry.heartbeat()
+        except Exception as e:
+            logger.error("Heartbeat pass failed: %s", e)
+
+async def sweep_handshake_tokens():
+    """Drop abandoned /api/ws-token tokens that were never redeemed"""
+    while True:
+        await asyncio.sleep(TOKEN_SWEEP_INTERVAL)
+        try:
+            removed = await registry.tokens.sweep()
+            if removed: logger.info("Swept %d expired handshake tokens", removed)
+        except Exception as e:
+            logger.error("Token sweep failed: %s", e)
+
+def install_drain_handler():
+    """Run registry.drain() ahead of the server's own SIGTERM/SIGINT handling.
+
+    uvicorn closes every WebSocket before the shutdown event fires, so rooms would
+    already be torn down by then; the wrapped handler snapshots first, then hands over.
+    """
+    if threading.current_thread() is not threading.main_thread(): return
+    loop = asyncio.get_running_loop()
+
+    async def drain_then(original, signum, frame):
+        try:
+            await registry.drain()
+        except Exception as e:
+            logger.error("Drain failed: %s", e)
+        finally:
+            original(signum, frame)
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        original = signal.getsignal(sig)
+        if not callable(original) or original is signal.default_int_handler: continue
+
+        def handler(signum, frame, original=original):
+            signal.signal(signum, original)  # A second signal goes straight to the server
+            loop.call_soon_threadsafe(lambda: asyncio.ensure_future(drain_then(original, signum, frame)))
+        signal.signal(sig, handler)
+
+def restore_rooms():
+    """Reload the room snapshot left by the previous process, if any"""
+    path = snapshot_path()
+    if not os.path.exists(path): return
+    try:
+        registry.restore(read_snapshot(path))
+    except Exception as e:
+        logger.error("Discarded unreadable room snapshot: %s", e)
 
 @app.on_event("startup")
 async def startup_event():
     """Initialize app on startup"""
     logger.info("SecureChat server starting...")
+    hasher.start()
     init_db()
+    restore_rooms()
+    await registry.start_backplane()
+    registry.timers.start(registry.expire_message)
     asyncio.create_task(backup_database())
     logger.info("Backup scheduler started")
+    asyncio.create_task(sweep_handshake_tokens())
+    asyncio.create_task(sweep_blobs())
+    asyncio.create_task(monitor_loop_lag())
+    asyncio.create_task(run_heartbeat())
+    install_drain_handler()
 
 init_db()
+database = Database(os.getenv("DATABASE_PATH", "database.db"), readers=int(os.getenv("DB_READERS", "4")))
 
 # ===== MESSAGE TYPE CONSTANTS (CODE-2 FIX) =====
 class MessageTypes:
@@ -189,6 +854,11 @@ class MessageTypes:
     FILE = "file"
     TYPING = "typing"
     USER_LIST = "user_list"
+    PRESENCE = "presence"
+    BATCH = "batch"
+    PING = "ping"
+    PONG = "pong"
+    RECONNECT = "reconnect"
     DELETE_MSG = "delete_msg"
     EDIT_MSG = "edit_msg"
     WIPE_ALL = "wipe_all"
@@ -196,81 +866,1481 @@ class MessageTypes:
     ERROR = "error"
     SYSTEM = "system"
 
+# ===== JSON CODEC =====
+class JSONCodec:
+    """Stdlib json codec, wire-compatible with Starlette's send_json"""
+    name = "json"
+
+    def dumps(self, obj) -> str:
+        return json.dumps(obj, separators=(",", ":"), ensure_ascii=False)
+
+    def loads(self, data):
+        return json.loads(data)
+
+class OrjsonCodec:
+    """Optional fast backend, used when orjson is installed"""
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def dumps(self, obj) -> str:
+        return self._orjson.dumps(obj).decode("utf-8")
+
+    def loads(self, data):
+        return self._orjson.loads(data)
+
+def build_codec(name: str = "auto"):
+    """Select the codec named by JSON_CODEC: auto, json or orjson"""
+    if name in ("auto", "orjson"):
+        try:
+            return OrjsonCodec()
+        except ImportError:
+            if name == "orjson":
+                logger.warning("JSON_CODEC=orjson but orjson is not installed; falling back to json")
+    return JSONCodec()
+
+codec = build_codec(os.getenv("JSON_CODEC", "auto"))
+logger.info("JSON codec: %s", codec.name)
+
+# ===== INBOUND ENVELOPES =====
+WS_MAX_FRAME_BYTES = int(os.getenv("WS_MAX_FRAME_BYTES", str(1024 * 1024)))  # Text frames above this are never parsed
+ENVELOPE_ERROR_LIMIT = int(os.getenv("ENVELOPE_ERROR_LIMIT", "5"))  # Close a socket after this many rejected frames
+
+class EnvelopeError(ValueError):
+    """An inbound frame that is too large or does not match its envelope"""
+    def __init__(self, message: str, close_code: int = 1007):
+        super().__init__(message)
+        self.close_code = close_code  # 1009 for oversized frames, 1007 for malformed ones
+
+def frame_too_large(text: str, limit: int = WS_MAX_FRAME_BYTES) -> bool:
+    """UTF-8 size check that only encodes when the character count alone is not conclusive"""
+    n = len(text)
+    return n > limit or (n * 4 > limit and len(text.encode("utf-8")) > limit)
+
+def _text(value, optional: bool = False) -> Optional[str]:
+    if value is None and optional: return None
+    if not isinstance(value, str): raise EnvelopeError("Malformed frame")
+    return value
+
+def _ciphertext(value):
+    """Message content: a string, or the web client's AES-GCM {iv, data} pair (extra keys dropped)"""
+    if isinstance(value, dict):
+        return {"iv": _text(value.get("iv")), "data": _text(value.get("data"))}
+    return _text(value)
+
+class Envelope:
+    """Typed view of one inbound frame; fields not declared by its kind are dropped"""
+    __slots__ = ("type",)
+    FIELDS: Tuple[str, ...] = ()
+
+    def __init__(self, type: str):
+        self.type = type
+
+    @classmethod
+    def decode(cls, d: dict) -> "Envelope":
+        return cls(d["type"])
+
+    def to_dict(self) -> dict:
+        """Declared fields that are set, ready to be extended with server fields and broadcast"""
+        data = {"type": self.type}
+        for name in self.FIELDS:
+            value = getattr(self, name)
+            if value is not None: data[name] = value
+        return data
+
+class TypingEnvelope(Envelope):
+    __slots__ = ("status",)
+    FIELDS = ("status",)
+
+    def __init__(self, type: str, status: bool):
+        super().__init__(type)
+        self.status = status
+
+    @classmethod
+    def decode(cls, d: dict) -> "TypingEnvelope":
+        return cls(d["type"], bool(d.get("status")))
+
+class KickEnvelope(Envelope):
+    __slots__ = ("target",)
+    FIELDS = ("target",)
+
+    def __init__(self, type: str, target: str):
+        super().__init__(type)
+        self.target = target
+
+    @classmethod
+    def decode(cls, d: dict) -> "KickEnvelope":
+        return cls(d["type"], _text(d.get("target")))
+
+class PresenceSyncEnvelope(Envelope):
+    __slots__ = ("v",)
+    FIELDS = ("v",)
+
+    def __init__(self, type: str, v: Optional[int]):
+        super().__init__(type)
+        self.v = v
+
+    @classmethod
+    def decode(cls, d: dict) -> "PresenceSyncEnvelope":
+        v = d.get("v")
+        return cls(d["type"], v if isinstance(v, int) and not isinstance(v, bool) else None)
+
+class EditEnvelope(Envelope):
+    __slots__ = ("id", "content")
+    FIELDS = ("id", "content")
+
+    def __init__(self, type: str, id: str, content: Union[str, dict]):
+        super().__init__(type)
+        self.id = id
+        self.content = content
+
+    @classmethod
+    def decode(cls, d: dict) -> "EditEnvelope":
+        return cls(d["type"], _text(d.get("id")), _ciphertext(d.get("content")))
+
+class ChatEnvelope(Envelope):
+    """message and reaction: ciphertext plus an optional reply target and self-destruct request"""
+    __slots__ = ("content", "reply_to", "self_destruct")
+    FIELDS = ("content", "reply_to", "self_destruct")
+
+    def __init__(self, type: str, content: Union[str, dict], reply_to: Optional[str] = None, self_destruct=None):
+        super().__init__(type)
+        self.content = content
+        self.reply_to = reply_to
+        self.self_destruct = self_destruct
+
+    @classmethod
+    def decode(cls, d: dict) -> "ChatEnvelope":
+        ttl = d.get("self_destruct")
+        if ttl is not None and not isinstance(ttl, (bool, int, float)): raise EnvelopeError("Malformed frame")
+        return cls(d["type"], _ciphertext(d.get("content", "")), _text(d.get("reply_to"), optional=True), ttl)
+
+class AttachmentEnvelope(ChatEnvelope):
+    """image and file: inline ciphertext, a stored blob digest, or a binary transfer announcement"""
+    __slots__ = ("blob", "transfer")
+    FIELDS = ChatEnvelope.FIELDS + ("blob", "transfer")
+
+    def __init__(self, type: str, content: Union[str, dict], reply_to: Optional[str] = None, self_destruct=None,
+                 blob: Optional[str] = None, transfer: Optional[dict] = None):
+        super().__init__(type, content, reply_to, self_destruct)
+        self.blob = blob
+        self.transfer = transfer
+
+    @classmethod
+    def decode(cls, d: dict) -> "AttachmentEnvelope":
+        base = ChatEnvelope.decode(d)
+        transfer = d.get("transfer")
+        if transfer is not None:
+            if not isinstance(transfer, dict): raise EnvelopeError("Malformed transfer")
+            transfer = {"id": transfer.get("id"), "size": transfer.get("size")}
+        return cls(base.type, base.content, base.reply_to, base.self_destruct, _text(d.get("blob"), optional=True), transfer)
+
+ENVELOPES: Dict[str, type] = {
+    MessageTypes.PONG: Envelope, MessageTypes.TYPING: TypingEnvelope, "kick": KickEnvelope,
+    "presence_sync": PresenceSyncEnvelope, "wipe": Envelope, "lock": Envelope, "unlock": Envelope,
+    MessageTypes.EDIT_MSG: EditEnvelope, MessageTypes.MESSAGE: ChatEnvelope, "reaction": ChatEnvelope,
+    MessageTypes.IMAGE: AttachmentEnvelope, MessageTypes.FILE: AttachmentEnvelope,
+}
+
+def decode_envelope(text: str) -> Optional[Envelope]:
+    """Size-check, parse and narrow one text frame; None for kinds the server does not handle"""
+    if frame_too_large(text): raise EnvelopeError("Frame too large", 1009)
+    try:
+        d = codec.loads(text)
+    except ValueError:
+        raise EnvelopeError("Malformed frame")
+    if not isinstance(d, dict) or not isinstance(d.get("type"), str): raise EnvelopeError("Malformed frame")
+    kind = ENVELOPES.get(d["type"])
+    return kind.decode(d) if kind else None
+
+# ===== OUTBOUND SEND QUEUES =====
+SEND_QUEUE_MAX = int(os.getenv("SEND_QUEUE_MAX", "256"))  # Frames buffered per socket
+SEND_QUEUE_MAX_BYTES = int(os.getenv("SEND_QUEUE_MAX_BYTES", str(8 * 1024 * 1024)))  # Bytes buffered per socket
+SEND_OVERFLOW_POLICY = os.getenv("SEND_OVERFLOW_POLICY", "shed")  # "shed" or "disconnect"
+SLOW_CONSUMER_CLOSE_TIMEOUT = 2.0
+
+class ConnectionWriter:
+    """Bounded outbound queue drained by one writer task per socket.
+
+    Broadcasts only enqueue, so a stalled receiver never holds up the sender or
+    the rest of the room. When the queue is full the "shed" policy drops typing
+    events first; if nothing can be shed the consumer is reported as dead and
+    the registry disconnects it. The "disconnect" policy skips shedding.
+    Frames are text (str) or binary (bytes); queued bytes are capped too, so a
+    receiver that falls behind on attachment chunks is dropped, not buffered.
+    """
+    __slots__ = ("ws", "max_queue", "max_bytes", "policy", "queue", "queued_bytes", "dead", "dropped", "_wakeup", "_task")
+
+    def __init__(self, ws: WebSocket, max_queue: int = SEND_QUEUE_MAX, policy: str = SEND_OVERFLOW_POLICY,
+                 max_bytes: int = SEND_QUEUE_MAX_BYTES):
+        self.ws = ws
+        self.max_queue = max_queue
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.queue: Deque[Tuple[Union[str, bytes], bool]] = deque()
+        self.queued_bytes = 0
+        self.dead = False
+        self.dropped = 0
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    def enqueue(self, frame: Union[str, bytes], droppable: bool = False) -> bool:
+        """Queue an encoded frame without awaiting. Returns False if the consumer must be dropped."""
+        if self.dead:
+            return False
+        if len(self.queue) >= self.max_queue or self.queued_bytes + len(frame) > self.max_bytes:
+            if self.policy == "shed" and droppable:
+                self.dropped += 1
+                return True
+            # Shedding typing frames can relieve a full queue, but not a byte backlog
+            if not (self.policy == "shed" and len(self.queue) >= self.max_queue and self._shed_one()
+                    and self.queued_bytes + len(frame) <= self.max_bytes):
+                self._abandon()
+                return False
+        self.queue.append((frame, droppable))
+        self.queued_bytes += len(frame)
+        self._wakeup.set()
+        QUEUE_DEPTH.observe(len(self.queue))
+        return True
+
+    def _shed_one(self) -> bool:
+        for i, (frame, droppable) in enumerate(self.queue):
+            if droppable:
+                del self.queue[i]
+                self.queued_bytes -= len(frame)
+                self.dropped += 1
+                return True
+        return False
+
+    def _abandon(self):
+        self.dead = True
+        self.queue.clear()
+        self.queued_bytes = 0
+
+    async def _run(self):
+        try:
+            while True:
+                if not self.queue:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+                frame, _ = self.queue.popleft()
+                self.queued_bytes -= len(frame)
+                if isinstance(frame, bytes): await self.ws.send_bytes(frame)
+                else: await self.ws.send_text(frame)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Socket is gone; the next enqueue reports it so the registry can clean up
+            self._abandon()
+
+    def close(self):
+        self._abandon()
+        self._task.cancel()
+
+async def close_quietly(ws: WebSocket, code: int = 1000, farewell: Optional[str] = None):
+    """Close a socket without letting a stalled peer block the caller"""
+    try:
+        if farewell: await asyncio.wait_for(ws.send_text(farewell), SLOW_CONSUMER_CLOSE_TIMEOUT)
+        await asyncio.wait_for(ws.close(code=code), SLOW_CONSUMER_CLOSE_TIMEOUT)
+    except Exception: pass
+
+# ===== CROSS-PROCESS BACKPLANE =====
+BACKPLANE_NODE_TIMEOUT = float(os.getenv("BACKPLANE_NODE_TIMEOUT", "60"))  # A silent worker's members are dropped after this
+RemoteHandler = Callable[[str, str, dict], Awaitable[None]]  # (origin, room_id, event)
+
+class Backplane:
+    """Relays room events between worker processes.
+
+    publish() never awaits and implementations deliver events to every other
+    node in publish order, which preserves per-room ordering.
+    """
+    def __init__(self):
+        self.node_id = uuid.uuid4().hex[:12]
+        self._handler: Optional[RemoteHandler] = None
+
+    async def start(self, handler: RemoteHandler):
+        self._handler = handler
+
+    def publish(self, room_id: str, event: dict):
+        raise NotImplementedError
+
+    async def stop(self):
+        pass
+
+    async def _deliver(self, origin: str, room_id: str, event: dict):
+        try: await self._handler(origin, room_id, event)
+        except Exception as e: logger.error("Backplane event failed (%s): %s", event.get('op'), e)
+
+class InProcessBackplane(Backplane):
+    """Hub shared by every started registry in this process (single worker, or tests)"""
+    _default_hub: List["InProcessBackplane"] = []
+
+    def __init__(self, hub: Optional[List["InProcessBackplane"]] = None):
+        super().__init__()
+        self._hub = hub if hub is not None else InProcessBackplane._default_hub
+        self._inbox: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self, handler: RemoteHandler):
+        await super().start(handler)
+        self._inbox = asyncio.Queue()
+        self._hub.append(self)
+        self._task = asyncio.create_task(self._pump())
+
+    def publish(self, room_id: str, event: dict):
+        for peer in self._hub:
+            if peer is not self:
+                peer._inbox.put_nowait((self.node_id, room_id, event))
+
+    async def _pump(self):
+        while True:
+            origin, room_id, event = await self._inbox.get()
+            await self._deliver(origin, room_id, event)
+
+    async def stop(self):
+        if self in self._hub: self._hub.remove(self)
+        if self._task: self._task.cancel()
+
+class SQLiteBackplane(Backplane):
+    """Append-only event log in a shared SQLite file, polled by every worker.
+
+    Events are written and read on one dedicated thread, so inserts keep
+    publish order and the AUTOINCREMENT sequence gives a total order that all
+    workers replay identically. Rows older than the retention window are pruned.
+    """
+    def __init__(self, path: str, poll_interval: float = 0.02, retention: float = 60.0):
+        super().__init__()
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="backplane")
+        self._db: Optional[sqlite3.Connection] = None
+        self._last_seq = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def _open(self) -> int:
+        # Owner-only: the log carries room seals and ciphertext; SQLite gives -wal and -shm the same mode
+        os.close(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600))
+        os.chmod(self.path, 0o600)
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS backplane_events (seq INTEGER PRIMARY KEY AUTOINCREMENT, origin TEXT, room_id TEXT, payload TEXT, created_at REAL)")
+        self._db.commit()
+        return self._db.execute("SELECT COALESCE(MAX(seq), 0) FROM backplane_events").fetchone()[0]
+
+    def _insert(self, room_id: str, payload: str):
+        self._db.execute("INSERT INTO backplane_events (origin, room_id, payload, created_at) VALUES (?, ?, ?, ?)",
+                         (self.node_id, room_id, payload, time.time()))
+        self._db.commit()
+
+    def _fetch(self, after: int):
+        return self._db.execute("SELECT seq, origin, room_id, payload FROM backplane_events WHERE seq > ? ORDER BY seq", (after,)).fetchall()
+
+    def _prune(self):
+        self._db.execute("DELETE FROM backplane_events WHERE created_at < ?", (time.time() - self.retention,))
+        self._db.commit()
+
+    async def start(self, handler: RemoteHandler):
+        await super().start(handler)
+        loop = asyncio.get_running_loop()
+        self._last_seq = await loop.run_in_executor(self._executor, self._open)
+        self._task = asyncio.create_task(self._poll())
+
+    def publish(self, room_id: str, event: dict):
+        future = self._executor.submit(self._insert, room_id, codec.dumps(event))
+        future.add_done_callback(lambda f: f.exception() and logger.error("Backplane publish failed: %s", f.exception()))
+
+    async def _poll(self):
+        loop = asyncio.get_running_loop()
+        last_prune = time.time()
+        while True:
+            try:
+                rows = await loop.run_in_executor(self._executor, self._fetch, self._last_seq)
+                for seq, origin, room_id, payload in rows:
+                    self._last_seq = seq
+                    if origin != self.node_id:
+                        await self._deliver(origin, room_id, codec.loads(payload))
+                if time.time() - last_prune > self.retention:
+                    await loop.run_in_executor(self._executor, self._prune)
+                    last_prune = time.time()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Backplane poll failed: %s", e)
+            await asyncio.sleep(self.poll_interval)
+
+    async def stop(self):
+        if self._task: self._task.cancel()
+        if self._db:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._db.close)
+        self._executor.shutdown(wait=False)
+
+def build_backplane(kind: str = "inprocess") -> Backplane:
+    """Select the backplane named by BACKPLANE: inprocess or sqlite"""
+    if kind == "sqlite":
+        return SQLiteBackplane(os.getenv("BACKPLANE_PATH", "backplane.db"),
+                               poll_interval=int(os.getenv("BACKPLANE_POLL_MS", "20")) / 1000)
+    return InProcessBackplane()
+
+# ===== HANDSHAKE TOKEN STORE =====
+HANDSHAKE_TOKEN_TTL = 60  # Seconds a /api/ws-token token stays redeemable
+
+class TokenStore:
+    """Single-use WebSocket handshake tokens with expiry and issue/redeem/expire counters"""
+    def __init__(self):
+        self.issued = 0
+        self.redeemed = 0
+        self.expired = 0
+
+    async def issue(self, uid: int, user: str, ttl: float = HANDSHAKE_TOKEN_TTL) -> str:
+        token = secrets.token_urlsafe(32)
+        await self._call(self._put, token, {"uid": uid, "user": user, "expires": time.time() + ttl})
+        self.issued += 1
+        return token
+
+    async def redeem(self, token: str) -> Optional[dict]:
+        data = await self._call(self._pop, token) if token else None
+        if data and data["expires"] > time.time():
+            self.redeemed += 1
+            return data
+        if data: self.expired += 1
+        return None
+
+    async def sweep(self) -> int:
+        return await self._call(self._sweep)
+
+    def stats(self) -> dict:
+        return {"issued": self.issued, "redeemed": self.redeemed, "expired": self.expired, "held": len(self)}
+
+    async def _call(self, fn: Callable, *args):
+        return fn(*args)
+
+    def close(self):
+        pass
+
+    def _put(self, token: str, data: dict): raise NotImplementedError
+    def _pop(self, token: str) -> Optional[dict]: raise NotImplementedError
+    def _sweep(self) -> int: raise NotImplementedError
+    def __len__(self) -> int: raise NotImplementedError
+
+class MemoryTokenStore(TokenStore):
+    """Per-process store; a min-heap on expiry lets sweep() touch only expired entries"""
+    def __init__(self):
+        super().__init__()
+        self._tokens: Dict[str, dict] = {}
+        self._expiry: List[Tuple[float, str]] = []
+
+    def _put(self, token: str, data: dict):
+        self._sweep()
+        self._tokens[token] = data
+        heapq.heappush(self._expiry, (data["expires"], token))
+
+    def _pop(self, token: str) -> Optional[dict]:
+        # The heap entry goes stale and is discarded when its deadline passes
+        return self._tokens.pop(token, None)
+
+    def _sweep(self) -> int:
+        now, removed = time.time(), 0
+        while self._expiry and self._expiry[0][0] <= now:
+            _, token = heapq.heappop(self._expiry)
+            if self._tokens.pop(token, None) is not None:
+                removed += 1
+        self.expired += removed
+        return removed
+
+    def __len__(self) -> int:
+        return len(self._tokens)
+
+class SQLiteTokenStore(TokenStore):
+    """Store shared by every worker on the host, so a token minted on one can be redeemed on another.
+
+    Every query runs on one dedicated thread, so lock waits (BEGIN IMMEDIATE
+    while another worker writes) never stall the event loop. len() is the
+    count from the last sweep rather than a query per scrape.
+    """
+    def __init__(self, path: str):
+        super().__init__()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tokens")
+        self._held = 0
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # Tokens live for seconds; losing them in a power cut is harmless
+        self._db.execute("PRAGMA synchronous=OFF")
+        self._db.execute("CREATE TABLE IF NOT EXISTS handshake_tokens (token TEXT PRIMARY KEY, uid INTEGER, user TEXT, expires REAL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_handshake_tokens_expires ON handshake_tokens(expires)")
+
+    def _put(self, token: str, data: dict):
+        self._db.execute("INSERT INTO handshake_tokens (token, uid, user, expires) VALUES (?, ?, ?, ?)",
+                         (token, data["uid"], data["user"], data["expires"]))
+
+    def _pop(self, token: str) -> Optional[dict]:
+        # Select and delete in one write transaction so only one worker can redeem a token
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._db.execute("SELECT uid, user, expires FROM handshake_tokens WHERE token = ?", (token,)).fetchone()
+            if row: self._db.execute("DELETE FROM handshake_tokens WHERE token = ?", (token,))
+        finally:
+            self._db.execute("COMMIT")
+        return {"uid": row[0], "user": row[1], "expires": row[2]} if row else None
+
+    def _sweep(self) -> int:
+        removed = self._db.execute("DELETE FROM handshake_tokens WHERE expires <= ?", (time.time(),)).rowcount
+        self._held = self._db.execute("SELECT COUNT(*) FROM handshake_tokens").fetchone()[0]
+        self.expired += removed
+        return removed
+
+    async def _call(self, fn: Callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._db.close()
+
+    def __len__(self) -> int:
+        return self._held
+
+def build_token_store(kind: str = "memory") -> TokenStore:
+    """Select the store named by TOKEN_STORE: memory or sqlite"""
+    if kind == "sqlite":
+        return SQLiteTokenStore(os.getenv("TOKEN_STORE_PATH", "tokens.db"))
+    return MemoryTokenStore()
+
+# ===== PER-CONNECTION RATE LIMITING =====
+def parse_budget(spec: str) -> Tuple[float, float]:
+    """'30/10' -> burst of 30 frames refilled over 10 seconds -> (capacity, rate per second)"""
+    count, seconds = spec.split("/")
+    return float(count), float(count) / float(seconds)
+
+RATE_BUDGETS = {
+    "chat": parse_budget(os.getenv("RATE_LIMIT_CHAT", "30/10")),
+    "typing": parse_budget(os.getenv("RATE_LIMIT_TYPING", "20/10")),
+    "media": parse_budget(os.getenv("RATE_LIMIT_MEDIA", "5/10")),
+}
+
+def frame_kind(msg_type: Optional[str]) -> str:
+    """Which rate budget an inbound frame is charged to"""
+    if msg_type == MessageTypes.TYPING: return "typing"
+    if msg_type in (MessageTypes.IMAGE, MessageTypes.FILE): return "media"
+    return "chat"
+
+class TokenBucket:
+    __slots__ = ("capacity", "rate", "tokens", "stamp")
+
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+
+    def take(self, now: float) -> bool:
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+class ConnectionState:
+    """Constant-size per-socket limiter and liveness state, dropped with the socket in leave()"""
+    __slots__ = ("chat", "typing", "media", "throttled", "rejected", "transfer_bytes", "last_seen", "last_active")
+
+    def __init__(self):
+        self.chat = TokenBucket(*RATE_BUDGETS["chat"])
+        self.typing = TokenBucket(*RATE_BUDGETS["typing"])
+        self.media = TokenBucket(*RATE_BUDGETS["media"])
+        self.throttled = 0
+        self.rejected = 0  # Frames that failed envelope decoding
+        self.transfer_bytes = 0  # Announced bytes of this socket's open binary transfers
+        self.last_seen = self.last_active = time.monotonic()  # Any inbound frame / any non-heartbeat frame
+
+# ===== HEARTBEAT =====
+HEARTBEAT_INTERVAL = float(os.getenv("HEARTBEAT_INTERVAL", "25"))  # Ping sockets silent for this long
+HEARTBEAT_TIMEOUT = float(os.getenv("HEARTBEAT_TIMEOUT", "60"))  # Reap sockets silent for this long
+IDLE_TIMEOUT = float(os.getenv("IDLE_TIMEOUT", "1800"))  # Reap sockets that only answer pings; 0 disables
+
+# ===== BINARY ATTACHMENT TRANSFERS =====
+# Binary frame layout, identical in both directions so the server relays frames untouched:
+#   u8 kind (0x01 = attachment chunk) | 16-byte transfer id | u32 chunk index | u8 flags (0x01 = last) | ciphertext
+CHUNK_HEADER = struct.Struct("!B16sIB")
+CHUNK_KIND = 0x01
+CHUNK_LAST = 0x01
+MEDIA_MAX_TRANSFER_BYTES = int(os.getenv("MEDIA_MAX_TRANSFER_BYTES", str(25 * 1024 * 1024)))
+MEDIA_MAX_CONN_BYTES = int(os.getenv("MEDIA_MAX_CONN_BYTES", str(25 * 1024 * 1024)))
+MEDIA_MAX_ROOM_BYTES = int(os.getenv("MEDIA_MAX_ROOM_BYTES", str(100 * 1024 * 1024)))
+MEDIA_MAX_CHUNK_BYTES = int(os.getenv("MEDIA_MAX_CHUNK_BYTES", str(256 * 1024)))
+MEDIA_TRANSFER_TIMEOUT = float(os.getenv("MEDIA_TRANSFER_TIMEOUT", "60"))  # Seconds without a chunk before a transfer is aborted
+
+class Transfer:
+    """An announced attachment whose ciphertext is still streaming in as binary chunks"""
+    __slots__ = ("sender", "size", "received", "next_index", "last_chunk")
+
+    def __init__(self, sender: WebSocket, size: int):
+        self.sender = sender
+        self.size = size
+        self.received = 0
+        self.next_index = 0
+        self.last_chunk = time.monotonic()  # Stale transfers give their reserved budget back in the heartbeat
+
+# ===== MESSAGE BACKLOG =====
+BACKLOG_MAX_MESSAGES = int(os.getenv("BACKLOG_MAX_MESSAGES", "100"))
+BACKLOG_MAX_BYTES = int(os.getenv("BACKLOG_MAX_BYTES", str(1024 * 1024)))
+
+SEQUENCED_TYPES = (MessageTypes.MESSAGE, MessageTypes.IMAGE, MessageTypes.FILE, "reaction")  # Numbered and kept for replay
+BACKLOG_TYPES = SEQUENCED_TYPES + (MessageTypes.EDIT_MSG, MessageTypes.DELETE_MSG, MessageTypes.WIPE_ALL)  # Change a replay
+
+class MessageBacklog:
+    """Ring buffer of encoded message frames keyed by a per-room sequence number.
+
+    Slots are preallocated, so appends never reslice; the oldest frames are
+    evicted when either the count or the byte budget is exceeded. Retained
+    sequence numbers are always the contiguous range [first_seq, next_seq);
+    removed messages leave an empty slot behind.
+    """
+    __slots__ = ("capacity", "max_bytes", "first_seq", "next_seq", "nbytes", "_frames", "_ids", "_index")
+
+    def __init__(self, capacity: int = BACKLOG_MAX_MESSAGES, max_bytes: int = BACKLOG_MAX_BYTES):
+        self.capacity = max(1, capacity)
+        self.max_bytes = max_bytes
+        self.first_seq = 1
+        self.next_seq = 1
+        self.nbytes = 0
+        self._frames: List[Optional[str]] = [None] * self.capacity
+        self._ids: List[Optional[str]] = [None] * self.capacity
+        self._index: Dict[str, int] = {}  # message id -> seq
+
+    def append(self, seq: int, frame: str, mid: Optional[str] = None):
+        """Store the frame for seq, which must be next_seq"""
+        if seq != self.next_seq:
+            raise ValueError(f"Backlog expected seq {self.next_seq}, got {seq}")
+        if self.next_seq - self.first_seq == self.capacity:
+            self._evict_oldest()
+        slot = seq % self.capacity
+        self._frames[slot], self._ids[slot] = frame, mid
+        self.nbytes += len(frame)
+        if mid: self._index[mid] = seq
+        self.next_seq += 1
+        while self.nbytes > self.max_bytes:
+            self._evict_oldest()
+
+    def since(self, seq: int) -> List[str]:
+        """Frames with sequence numbers greater than seq, oldest first"""
+        frames = self._frames
+        return [frames[s % self.capacity] for s in range(max(seq + 1, self.first_seq), self.next_seq)
+                if frames[s % self.capacity] is not None]
+
+    def items(self) -> List[Tuple[int, str, Optional[str]]]:
+        """(seq, frame, message id) for every retained frame, oldest first"""
+        cap = self.capacity
+        return [(s, self._frames[s % cap], self._ids[s % cap]) for s in range(self.first_seq, self.next_seq)
+                if self._frames[s % cap] is not None]
+
+    def restore(self, first_seq: int, next_seq: int, entries: List[Tuple[int, str, Optional[str]]]):
+        """Reload items() output, keeping the original numbering; missing seqs stay empty slots"""
+        self.clear()
+        self.first_seq = self.next_seq = max(1, first_seq)
+        for seq, frame, mid in entries:
+            if seq < self.next_seq: continue
+            self.skip_to(seq)
+            self.append(seq, frame, mid)
+        self.skip_to(next_seq)
+
+    def skip_to(self, seq: int):
+        """Advance next_seq to seq, leaving empty slots for numbers this backlog never saw"""
+        if seq - self.next_seq >= self.capacity:  # Everything retained would be evicted anyway
+            self.clear()
+            self.first_seq = self.next_seq = seq
+            return
+        while self.next_seq < seq:
+            if self.next_seq - self.first_seq == self.capacity:
+                self._evict_oldest()
+            self.next_seq += 1
+
+    def get(self, mid: str) -> Optional[str]:
+        seq = self._index.get(mid)
+        return self._frames[seq % self.capacity] if seq is not None and seq >= self.first_seq else None
+
+    def replace(self, mid: str, frame: str) -> bool:
+        """Swap the stored frame of a message in place, keeping its seq"""
+        seq = self._index.get(mid)
+        if seq is None or seq < self.first_seq: return False
+        slot = seq % self.capacity
+        self.nbytes += len(frame) - len(self._frames[slot])
+        self._frames[slot] = frame
+        return True
+
+    def remove(self, mid: str) -> bool:
+        seq = self._index.pop(mid, None)
+        if seq is None or seq < self.first_seq: return False
+        self._clear(seq % self.capacity)
+        return True
+
+    def clear(self):
+        """Drop every frame; sequence numbers keep counting up"""
+        while self.first_seq < self.next_seq:
+            self._evict_oldest()
+
+    def _evict_oldest(self):
+        self._clear(self.first_seq % self.capacity)
+        self.first_seq += 1
+
+    def _clear(self, slot: int):
+        frame, mid = self._frames[slot], self._ids[slot]
+        if frame is not None: self.nbytes -= len(frame)
+        if mid: self._index.pop(mid, None)
+        self._frames[slot] = self._ids[slot] = None
+
+    def __len__(self) -> int:
+        return sum(1 for f in self._frames if f is not None)
+
+# ===== SELF-DESTRUCT SCHEDULER =====
+SELF_DESTRUCT_DEFAULT = 30  # Seconds, for clients that just send self_destruct: true
+SELF_DESTRUCT_MIN = int(os.getenv("SELF_DESTRUCT_MIN", "5"))
+SELF_DESTRUCT_MAX = int(os.getenv("SELF_DESTRUCT_MAX", "86400"))
+
+def self_destruct_ttl(value) -> Optional[int]:
+    """Clamp a client-requested TTL to server limits; None means the message is permanent"""
+    if value is True: return SELF_DESTRUCT_DEFAULT
+    if isinstance(value, (int, float)) and not isinstance(value, bool) and value > 0:
+        return int(min(max(value, SELF_DESTRUCT_MIN), SELF_DESTRUCT_MAX))
+    return None
+
+class TimerEntry:
+    __slots__ = ("deadline", "group", "key", "level", "slot")
+
+    def __init__(self, deadline: int, group: str, key: str):
+        self.deadline = deadline
+        self.group = group
+        self.key = key
+        self.level = 0
+        self.slot = 0
+
+class TimerWheel:
+    """Hierarchical timing wheel driven by a single task for the whole process.
+
+    Level 0 has one bucket per tick; each bucket on level L spans a full
+    rotation of level L-1, and its entries cascade down when it comes due.
+    Scheduling and cancelling are O(1) and a tick only touches due buckets.
+    Entries are grouped (by room) so a whole group can be purged at once.
+    """
+    def __init__(self, tick: float = 1.0, slots: int = 64, levels: int = 3):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.now_tick = 0
+        self._wheels: List[List[Set[TimerEntry]]] = [[set() for _ in range(slots)] for _ in range(levels)]
+        self._groups: Dict[str, Dict[str, TimerEntry]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._on_expire: Optional[Callable[[str, str], Awaitable[None]]] = None
+
+    def schedule(self, delay: float, group: str, key: str):
+        self.cancel(group, key)
+        ticks = min(max(1, math.ceil(delay / self.tick)), self.slots ** self.levels - 1)
+        entry = TimerEntry(self.now_tick + ticks, group, key)
+        self._groups.setdefault(group, {})[key] = entry
+        self._place(entry)
+
+    def cancel(self, group: str, key: str):
+        entry = self._groups.get(group, {}).pop(key, None)
+        if entry: self._wheels[entry.level][entry.slot].discard(entry)
+
+    def cancel_group(self, group: str) -> int:
+        """Drop every pending entry of a group, e.g. when its room is destroyed"""
+        entries = self._groups.pop(group, {})
+        for entry in entries.values():
+            self._wheels[entry.level][entry.slot].discard(entry)
+        return len(entries)
+
+    def _place(self, entry: TimerEntry):
+        delta, level, span = entry.deadline - self.now_tick, 0, self.slots
+        while delta >= span and level < self.levels - 1:
+            level += 1
+            span *= self.slots
+        entry.level = level
+        entry.slot = (entry.deadline // self.slots ** level) % self.slots
+        self._wheels[level][entry.slot].add(entry)
+
+    def advance(self) -> List[TimerEntry]:
+        """Move one tick forward and return the entries that are now due"""
+        self.now_tick += 1
+        # Cascade from the top so entries land in lower buckets before those are processed
+        for level in range(self.levels - 1, 0, -1):
+            span = self.slots ** level
+            if self.now_tick % span == 0:
+                bucket = self._wheels[level][(self.now_tick // span) % self.slots]
+                entries = list(bucket)
+                bucket.clear()
+                for entry in entries:
+                    self._place(entry)
+        bucket = self._wheels[0][self.now_tick % self.slots]
+        due = list(bucket)
+        bucket.clear()
+        for entry in due:
+            group = self._groups.get(entry.group)
+            if group is not None:
+                group.pop(entry.key, None)
+                if not group: del self._groups[entry.group]
+        return due
+
+    def __len__(self) -> int:
+        return sum(len(entries) for entries in self._groups.values())
+
+    def start(self, on_expire: Callable[[str, str], Awaitable[None]]):
+        self._on_expire = on_expire
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        origin = time.monotonic() - self.now_tick * self.tick
+        while True:
+            # Sleep to the next tick boundary; catch up if the loop was stalled
+            await asyncio.sleep(max(0.0, origin + (self.now_tick + 1) * self.tick - time.monotonic()))
+            while time.monotonic() >= origin + (self.now_tick + 1) * self.tick:
+                for entry in self.advance():
+                    try: await self._on_expire(entry.group, entry.key)
+                    except Exception as e: logger.error("Timer callback failed: %s", e)
+
+    def stop(self):
+        if self._task: self._task.cancel()
+
+# ===== ATTACHMENT BLOB STORE =====
+BLOB_DIR = os.getenv("BLOB_DIR", "blobs")
+BLOB_MAX_BYTES = int(os.getenv("BLOB_MAX_BYTES", str(25 * 1024 * 1024)))
+BLOB_ORPHAN_GRACE = int(os.getenv("BLOB_ORPHAN_GRACE", "600"))  # Seconds an unreferenced upload survives
+BLOB_SWEEP_INTERVAL = int(os.getenv("BLOB_SWEEP_INTERVAL", "300"))
+BLOB_DIGEST = re.compile(r"^[0-9a-f]{64}$")
+
+class BlobStore:
+    """Content-addressed, deduplicated store for encrypted attachments.
+
+    Blobs are stored once per SHA-256 under <root>/<h[:2]>/<h[2:4]>/<h>, and
+    chat messages carry only the hash. A blob is deleted as soon as the last
+    message referencing it expires or its room dies; uploads that are never
+    referenced are removed by sweep() after the grace period. References are
+    marker files under <root>/refs/<h>/, one per (room, message), so every
+    worker sharing the root sees the ones the others hold. Markers are named
+    after the store that took them, which holds a lock under refs/.owners/
+    while it lives; sweep() drops the markers of stores that no longer do.
+    """
+    def __init__(self, root: str = BLOB_DIR, max_bytes: int = BLOB_MAX_BYTES, grace: float = BLOB_ORPHAN_GRACE):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.grace = grace
+        self.owner = uuid.uuid4().hex[:12]
+        self._owner_lock = None  # Taken on the first reference, held until the process exits
+        self._by_message: Dict[Tuple[str, str], str] = {}  # (room id, message id) -> digest
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def exists(self, digest: str) -> bool:
+        return bool(BLOB_DIGEST.match(digest or "")) and os.path.exists(self.path(digest))
+
+    async def put(self, chunks: AsyncIterator[bytes]) -> Tuple[str, int]:
+        """Stream an upload to disk while hashing it; returns (digest, size)"""
+        loop = asyncio.get_running_loop()
+        tmp_dir = os.path.join(self.root, "tmp")
+        os.makedirs(tmp_dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=tmp_dir)
+        digest, size = hashlib.sha256(), 0
+        try:
+            with os.fdopen(fd, "wb") as f:
+                async for chunk in chunks:
+                    size += len(chunk)
+                    if size > self.max_bytes: raise ValueError("Attachment too large")
+                    digest.update(chunk)
+                    await loop.run_in_executor(None, f.write, chunk)
+            if not size: raise ValueError("Empty attachment")
+            key = digest.hexdigest()
+            await loop.run_in_executor(None, self._commit, tmp, key)
+        except BaseException:
+            if os.path.exists(tmp): os.remove(tmp)
+            raise
+        return key, size
+
+    def _commit(self, tmp: str, digest: str):
+        path = self.path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            os.remove(tmp)
+            os.utime(path)  # Deduplicated; restart the orphan grace period
+        else:
+            os.replace(tmp, path)
+
+    def _refs_dir(self, digest: str) -> str:
+        return os.path.join(self.root, "refs", digest)
+
+    def _marker(self, digest: str, key: Tuple[str, str]) -> str:
+        name = hashlib.sha256("\0".join(key).encode()).hexdigest()[:32]
+        return os.path.join(self._refs_dir(digest), f"{self.owner}.{name}")
+
+    def _owners_dir(self) -> str:
+        return os.path.join(self.root, "refs", ".owners")
+
+    def ref(self, digest: str, rid: str, mid: str):
+        if self._owner_lock is None:
+            os.makedirs(self._owners_dir(), exist_ok=True)
+            self._owner_lock = open(os.path.join(self._owners_dir(), self.owner), "w")
+            fcntl.flock(self._owner_lock, fcntl.LOCK_EX)
+        os.makedirs(self._refs_dir(digest), exist_ok=True)
+        open(self._marker(digest, (rid, mid)), "a").close()
+        self._by_message[(rid, mid)] = digest
+
+    def release_message(self, rid: str, mid: str):
+        digest = self._by_message.pop((rid, mid), None)
+        if digest: self._release(digest, (rid, mid))
+
+    def release_room(self, rid: str):
+        for key in [key for key in self._by_message if key[0] == rid]:
+            self._release(self._by_message.pop(key), key)
+
+    def _release(self, digest: str, key: Tuple[str, str]):
+        try:
+            os.remove(self._marker(digest, key))
+            os.rmdir(self._refs_dir(digest))  # Fails while any worker still holds a reference
+        except OSError:
+            return
+        self._unlink(digest)
+
+    def _unlink(self, digest: str):
+        try: os.remove(self.path(digest))
+        except FileNotFoundError: pass
+
+    def _reap_dead_owners(self):
+        """Remove the markers of stores whose process exited, crashed or was restarted"""
+        owners = self._owners_dir()
+        dead = set()
+        for owner in os.listdir(owners) if os.path.isdir(owners) else []:
+            if owner == self.owner: continue
+            with open(os.path.join(owners, owner), "a") as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                dead.add(owner)
+        if not dead: return
+        refs = os.path.join(self.root, "refs")
+        for digest in os.listdir(refs):
+            if digest == ".owners": continue
+            for marker in os.listdir(os.path.join(refs, digest)):
+                if marker.split(".", 1)[0] in dead:
+                    try: os.remove(os.path.join(refs, digest, marker))
+                    except FileNotFoundError: pass
+            try: os.rmdir(os.path.join(refs, digest))
+            except OSError: pass  # Still referenced by a live store
+        for owner in dead:
+            os.remove(os.path.join(owners, owner))
+
+    def sweep(self) -> int:
+        """Delete unreferenced blobs older than the grace period (run in a worker thread)"""
+        self._reap_dead_owners()
+        cutoff, removed = time.time() - self.grace, 0
+        for dirpath, dirnames, files in os.walk(self.root):
+            if dirpath == self.root and "refs" in dirnames: dirnames.remove("refs")
+            for name in files:
+                path = os.path.join(dirpath, name)
+                try:
+                    # Checked per file, just before removal, so a reference another worker just took is seen
+                    if os.path.getmtime(path) < cutoff and not os.path.isdir(self._refs_dir(name)):
+                        os.remove(path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+# ===== PRESENCE & TYPING COALESCING =====
+PRESENCE_FLUSH_INTERVAL = float(os.getenv("PRESENCE_FLUSH_INTERVAL", "0.15"))  # Seconds per batching tick
+
+# ===== ADMISSION CONTROL =====
+MAX_CONNECTIONS = int(os.getenv("MAX_CONNECTIONS", "10000"))  # WebSockets per worker
+MAX_CONNECTIONS_PER_IP = int(os.getenv("MAX_CONNECTIONS_PER_IP", "0"))  # 0 disables; needs real client IPs behind a proxy
+LAG_DEGRADE = float(os.getenv("LAG_DEGRADE", "0.1"))  # Sustained loop lag (s) at which typing is shed
+LAG_NO_NEW_ROOMS = float(os.getenv("LAG_NO_NEW_ROOMS", "0.25"))  # ... and no new rooms are created
+LAG_REJECT = float(os.getenv("LAG_REJECT", "0.5"))  # ... and no new connections are accepted
+LAG_SUSTAIN = max(1, int(os.getenv("LAG_SUSTAIN", "3")))  # Consecutive lag samples needed to raise the level
+ADMISSION_RETRY_AFTER = float(os.getenv("ADMISSION_RETRY_AFTER", "5"))  # Base seconds in the retry hint
+DEGRADED_FLUSH_FACTOR = 10  # Presence batches this many times less often while degraded
+
+class AdmissionController:
+    """Tracks live sockets per worker and per IP, plus recent event loop lag samples.
+
+    Load levels escalate with lag: 1 sheds typing and slows presence, 2 also
+    refuses to create rooms, 3 also refuses new sockets. A level applies only
+    once the last `sustain` samples all reach it, so a single stall changes
+    nothing, and it drops as soon as one sample is below it. Rooms that
+    already exist keep working at every level.
+    """
+    NORMAL, DEGRADED, NO_NEW_ROOMS, REJECTING = range(4)
+
+    def __init__(self, max_connections: int = MAX_CONNECTIONS, max_per_ip: int = MAX_CONNECTIONS_PER_IP,
+                 thresholds: Tuple[float, float, float] = (LAG_DEGRADE, LAG_NO_NEW_ROOMS, LAG_REJECT),
+                 sustain: int = LAG_SUSTAIN):
+        self.max_connections = max_connections
+        self.max_per_ip = max_per_ip
+        self.thresholds = thresholds
+        self.lag = 0.0  # Latest sample
+        self._levels: Deque[int] = deque(maxlen=sustain)  # Level each recent sample alone would call for
+        self.connections = 0
+        self.per_ip: Dict[str, int] = {}
+        self.rejected = {"overloaded": 0, "capacity": 0, "per_ip": 0, "new_room": 0}
+
+    def observe_lag(self, lag: float):
+        self.lag = lag
+        self._levels.append(sum(1 for threshold in self.thresholds if lag >= threshold))
+
+    @property
+    def level(self) -> int:
+        if len(self._levels) < self._levels.maxlen: return self.NORMAL
+        return min(self._levels)
+
+    @property
+    def degraded(self) -> bool:
+        return self.level >= self.DEGRADED
+
+    def admit(self, ip: str) -> Optional[str]:
+        """Reserve a slot for a new socket, or return why it was refused"""
+        if self.level >= self.REJECTING: reason = "overloaded"
+        elif self.connections >= self.max_connections: reason = "capacity"
+        elif self.max_per_ip and self.per_ip.get(ip, 0) >= self.max_per_ip: reason = "per_ip"
+        else:
+            self.connections += 1
+            self.per_ip[ip] = self.per_ip.get(ip, 0) + 1
+            return None
+        self.rejected[reason] += 1
+        return reason
+
+    def release(self, ip: str):
+        self.connections -= 1
+        if self.per_ip[ip] <= 1: del self.per_ip[ip]
+        else: self.per_ip[ip] -= 1
+
+    def allow_new_room(self) -> bool:
+        if self.level < self.NO_NEW_ROOMS: return True
+        self.rejected["new_room"] += 1
+        return False
+
+    def retry_hint(self, reason: str) -> str:
+        """Reconnect frame with a jittered delay, so refused clients do not retry in lockstep"""
+        after_ms = int(ADMISSION_RETRY_AFTER * 1000 * (1 + random.random()))
+        return codec.dumps({"type": MessageTypes.RECONNECT, "after_ms": after_ms, "reason": reason})
+
+    def stats(self) -> dict:
+        return {"level": self.level, "lag": round(self.lag, 4), "connections": self.connections,
+                "ips": len(self.per_ip), "rejected": dict(self.rejected)}
+
+# ===== LARGE ROOMS =====
+LARGE_ROOM_MEMORY_BUDGET = int(os.getenv("LARGE_ROOM_MEMORY_BUDGET", str(512 * 1024 * 1024)))  # Bytes per room
+LARGE_ROOM_CONN_BYTES = int(os.getenv("LARGE_ROOM_CONN_BYTES", str(64 * 1024)))  # Estimated baseline per socket
+LARGE_ROOM_SHARDS = int(os.getenv("LARGE_ROOM_SHARDS", "8"))  # Fan-out tasks per large room
+LARGE_ROOM_SNAPSHOT = int(os.getenv("LARGE_ROOM_SNAPSHOT", "100"))  # Names included in a join snapshot
+LARGE_ROOM_TYPING_THRESHOLD = int(os.getenv("LARGE_ROOM_TYPING_THRESHOLD", "200"))  # Members before typing is sampled
+LARGE_ROOM_MAX_TYPERS = int(os.getenv("LARGE_ROOM_MAX_TYPERS", "5"))
+MEMBER_PAGE_MAX = 500
+
+class FanoutShard:
+    """Delivers a large room's frames to its share of the writers from a dedicated task.
+
+    Each socket belongs to exactly one shard and a shard handles frames in order,
+    so per-connection ordering is kept while a broadcast costs the caller one
+    enqueue per shard instead of one per member.
+    """
+    __slots__ = ("writers", "queue", "on_stale", "_wakeup", "_task")
+
+    def __init__(self, on_stale: Callable[[WebSocket], Awaitable[None]]):
+        self.writers: Dict[WebSocket, ConnectionWriter] = {}
+        self.queue: Deque[Tuple[Union[str, bytes], bool, Optional[WebSocket]]] = deque()
+        self.on_stale = on_stale
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    def submit(self, frame: Union[str, bytes], droppable: bool, exclude: Collection[WebSocket] = ()):
+        self.queue.append((frame, droppable, exclude))
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            if not self.queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            frame, droppable, exclude = self.queue.popleft()
+            stale = [ws for ws, writer in self.writers.items()
+                     if ws not in exclude and not writer.enqueue(frame, droppable)]
+            for ws in stale:
+                await self.on_stale(ws)
+            await asyncio.sleep(0)  # Let the other shards and the readers run
+
+    def close(self):
+        self._task.cancel()
+
+# ===== ROOM SEALS =====
+# The room password is also the clients' E2E key material, so rooms, snapshots and the
+# backplane only ever hold a salted scrypt digest of it ("seal").
+ROOM_SEAL_SCRYPT_N = int(os.getenv("ROOM_SEAL_SCRYPT_N", str(2 ** 14)))
+SEAL_PEPPER = secrets.token_bytes(32)  # Per process; keys the in-memory fast path and is never written
+
+def room_seal(rid: str, password: str) -> str:
+    """scrypt digest salted with the room id, so every worker derives the same seal.
+
+    The salt prefix keeps it apart from the client's PBKDF2 key, which is salted with the bare room id.
+    """
+    return hashlib.scrypt(password.encode(), salt=b"securechat-seal\0" + rid.encode(),
+                          n=ROOM_SEAL_SCRYPT_N, r=8, p=1).hex()
+
+async def seal_for(rid: str, password: str, room: Optional["GhostDimension"] = None) -> Tuple[str, bytes]:
+    """(seal, fast check) for a join attempt; scrypt is skipped for a password this worker already verified"""
+    fast = hmac.new(SEAL_PEPPER, f"{rid}\0{password}".encode(), hashlib.sha256).digest()
+    if room and room.seal_fast and hmac.compare_digest(fast, room.seal_fast):
+        return room.seal, fast
+    return await asyncio.get_running_loop().run_in_executor(None, room_seal, rid, password), fast
+
+# ===== WARM RESTART =====
+# Snapshot layout: header (magic, version, room count), then per room a
+# length-prefixed JSON record followed by its backlog frames, each length-prefixed.
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH")  # Unset: one file per worker under state/, see snapshot_path()
+WARM_RESTART_GRACE = float(os.getenv("WARM_RESTART_GRACE", "120"))  # Seconds restored rooms wait for their members
+RECONNECT_MIN_MS = int(os.getenv("RECONNECT_MIN_MS", "500"))
+RECONNECT_JITTER_MS = int(os.getenv("RECONNECT_JITTER_MS", "5000"))  # Spreads the reconnect storm over this window
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "2"))  # Seconds to let reconnect hints flush
+SNAPSHOT_MAGIC = b"GHOSTSNP"
+SNAPSHOT_VERSION = 2  # 2: rooms carry their seal, never the password
+SNAPSHOT_HEADER = struct.Struct("!8sII")
+SNAPSHOT_LEN = struct.Struct("!I")
+
+def encode_snapshot(rooms: Dict[str, "GhostDimension"]) -> bytes:
+    """Serialize rooms and their backlogs; self-destructing messages are left behind"""
+    parts = [SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(rooms))]
+    for rid, room in rooms.items():
+        seqs, frames, blobs = [], [], {}
+        for seq, frame, mid in room.backlog.items():
+            data = codec.loads(frame)
+            if data.get("self_destruct"): continue
+            if data.get("blob") and mid: blobs[mid] = data["blob"]
+            seqs.append([seq, mid])
+            frames.append(frame.encode("utf-8"))
+        record = codec.dumps({
+            "id": rid, "seal": room.seal, "admin": room.admin, "locked": room.locked,
+            "large": room.large, "members": sorted(room.returning.union(room.sockets)),
+            "first_seq": room.backlog.first_seq, "next_seq": room.backlog.next_seq,
+            "seqs": seqs, "blobs": blobs,
+        }).encode("utf-8")
+        parts.append(SNAPSHOT_LEN.pack(len(record)) + record)
+        parts.extend(SNAPSHOT_LEN.pack(len(frame)) + frame for frame in frames)
+    return b"".join(parts)
+
+def decode_snapshot(buf) -> List[Tuple[dict, List[str]]]:
+    """Parse a snapshot from any buffer (bytes or mmap) into (record, frames) pairs"""
+    magic, version, count = SNAPSHOT_HEADER.unpack_from(buf, 0)
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+        raise ValueError("Unrecognized room snapshot")
+    offset = SNAPSHOT_HEADER.size
+    rooms = []
+
+    def chunk() -> bytes:
+        nonlocal offset
+        (size,) = SNAPSHOT_LEN.unpack_from(buf, offset)
+        offset += SNAPSHOT_LEN.size + size
+        if offset > len(buf): raise ValueError("Truncated room snapshot")
+        return buf[offset - size:offset]
+
+    for _ in range(count):
+        record = codec.loads(chunk())
+        rooms.append((record, [chunk().decode("utf-8") for _ in record["seqs"]]))
+    return rooms
+
+def write_snapshot(path: str, data: bytes):
+    """Write atomically and owner-only: the snapshot holds room seals and ciphertext"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def read_snapshot(path: str) -> List[Tuple[dict, List[str]]]:
+    """Map the snapshot file and parse it, then delete it so a crash loop cannot replay it twice"""
+    try:
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0: return []
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                return decode_snapshot(buf)
+    finally:
+        os.remove(path)
+
+def claim_snapshot_slot(state_dir: str = "state"):
+    """Lock the lowest-numbered snapshot slot no live process holds; returns (path, open lock file)"""
+    os.makedirs(state_dir, exist_ok=True)
+    slot = 0
+    while True:
+        lock = open(os.path.join(state_dir, f"rooms-{slot}.lock"), "w")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return os.path.join(state_dir, f"rooms-{slot}.snap"), lock
+        except BlockingIOError:
+            lock.close()
+            slot += 1
+
+_snapshot_slot = None  # (path, lock file) kept open for the life of the process
+
+def snapshot_path() -> str:
+    """SNAPSHOT_PATH if set, else state/rooms-<WORKER_INDEX>.snap under the dispatcher.
+
+    uvicorn --workers and gunicorn set no index, so each worker claims a slot
+    instead; a replacement worker takes over the slot, and the snapshot, of
+    the one that exited.
+    """
+    global _snapshot_slot
+    if SNAPSHOT_PATH: return SNAPSHOT_PATH
+    if os.getenv("WORKER_INDEX") is not None: return f"state/rooms-{os.getenv('WORKER_INDEX')}.snap"
+    if _snapshot_slot is None: _snapshot_slot = claim_snapshot_slot()
+    return _snapshot_slot[0]
+
+def reconnect_hint() -> str:
+    return codec.dumps({"type": MessageTypes.RECONNECT, "after_ms": RECONNECT_MIN_MS + random.randint(0, RECONNECT_JITTER_MS)})
+
 # --- DIMENSION ORCHESTRATOR ---
 class GhostDimension:
-    """HIGH-3 FIX: Added message buffer limit to prevent memory leaks"""
-    MAX_MESSAGES_IN_MEMORY = 100  # Prevent memory leak
+    """HIGH-3 FIX: Recent messages live in a bounded ring buffer to prevent memory leaks"""
     
-    def __init__(self, room_id: str, password: str, admin: str):
+    def __init__(self, room_id: str, seal: str, admin: str, large: bool = False):
         self.room_id = room_id
-        self.password = password
+        self.seal = seal  # room_seal() of the password; the password itself is never kept
+        self.seal_fast: Optional[bytes] = None  # Keyed hash of the password once verified here, see seal_for()
         self.admin = admin
         self.locked = False
+        self.large = large  # Opt-in: sharded fan-out, paged member list, sampled typing
+        self.shards: List[FanoutShard] = []
+        self.count_dirty = False  # Large rooms announce member counts instead of joined/left
         self.connections: Dict[WebSocket, str] = {}
-        self.message_counts: Dict[WebSocket, List[float]] = {}  # For rate limiting
-        self.handshake_tokens: Dict[str, dict] = {}  # token -> {uid, user, expires}
-        self.recent_messages: List[dict] = []  # Limited buffer for recent messages
+        self.sockets: Dict[str, WebSocket] = {}  # username -> socket, for O(1) handle and kick lookups
+        self.presence_version = 0  # Bumped on every presence delta this worker emits
+        self.pending_events: List[dict] = []  # Presence deltas waiting for the next flush
+        self.pending_typing: Dict[str, bool] = {}  # Latest typing status per user this tick
+        self.typing: Set[str] = set()  # Users currently shown as typing
+        self.writers: Dict[WebSocket, ConnectionWriter] = {}  # Per-socket outbound queues
+        self.remote: Dict[str, str] = {}  # username -> node id of members on other workers
+        self.states: Dict[WebSocket, ConnectionState] = {}  # For rate limiting
+        self.backlog = MessageBacklog()  # Replayed to reconnecting clients
+        self.diverged_upto = 0  # Highest seq renumbered after a cross-worker collision; older cursors get a reset
+        self.transfers: Dict[bytes, Transfer] = {}  # Binary attachment uploads in flight
+        self.transfer_bytes = 0
+        self.returning: Set[str] = set()  # Members before a warm restart; may rejoin even if locked
+        self.dormant_until = 0.0  # Restored rooms survive being empty until this monotonic deadline
+
+    def members(self) -> List[str]:
+        return list(self.connections.values()) + list(self.remote)
+
+    def is_empty(self) -> bool:
+        return not self.connections and not self.remote
+
+    def has_member(self, user: str) -> bool:
+        return user in self.sockets or user in self.remote
+
+    def member_count(self) -> int:
+        return len(self.connections) + len(self.remote)
+
+    def memory_estimate(self) -> int:
+        """Approximate bytes this worker holds for the room"""
+        queued = sum(writer.queued_bytes for writer in self.writers.values())
+        return len(self.connections) * LARGE_ROOM_CONN_BYTES + queued + self.backlog.nbytes + self.transfer_bytes
 
 class DimensionRegistry:
-    def __init__(self):
+    def __init__(self, backplane: Optional[Backplane] = None, tokens: Optional[TokenStore] = None,
+                 blobs: Optional[BlobStore] = None, admission: Optional[AdmissionController] = None):
         self.rooms: Dict[str, GhostDimension] = {}
         self.MAX_PARTICIPANTS = 50  # Limit per dimension
+        self.backplane = backplane or InProcessBackplane()
+        self.tokens = tokens or MemoryTokenStore()
+        self.throttled: Dict[str, int] = {kind: 0 for kind in RATE_BUDGETS}
+        self.timers = TimerWheel()  # Self-destruct deadlines for every room
+        self.blobs = blobs or BlobStore()
+        self.admission = admission or AdmissionController()
+        self._dirty: Set[str] = set()  # Rooms with presence or typing updates to flush
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self.coalesced = {"events": 0, "frames": 0}
+        self.reaped = {"timeout": 0, "idle": 0}
+        self.draining = False  # Set once the process starts shutting down; rooms are then kept for the snapshot
+        self.nodes: Dict[str, float] = {}  # Other workers' node ids -> when we last heard from them (monotonic)
 
-    def generate_handshake_token(self, uid: int, user: str) -> str:
-        token = secrets.token_urlsafe(32)
-        # Token expires in 60 seconds
-        expires = time.time() + 60
-        # We'll store it in a simple dict for now. In prod, use Redis.
-        # But since registry is a singleton, this works for single instance.
-        self.rooms_info = getattr(self, 'rooms_info', {}) # Using a trick to store global data if needed
-        # Actually, let's just add it to the registry
-        if not hasattr(self, '_tokens'): self._tokens = {}
-        self._tokens[token] = {"uid": uid, "user": user, "expires": expires}
-        return token
+    async def generate_handshake_token(self, uid: int, user: str) -> str:
+        return await self.tokens.issue(uid, user)
 
-    def verify_handshake_token(self, token: str) -> Optional[dict]:
-        if not hasattr(self, '_tokens'): return None
-        data = self._tokens.pop(token, None)
-        if data and data['expires'] > time.time():
-            return data
-        return None
+    async def verify_handshake_token(self, token: str) -> Optional[dict]:
+        return await self.tokens.redeem(token)
+
+    async def broadcast(self, room_id: str, data: dict, exclude: Collection[WebSocket] = ()):
+        room = self.rooms.get(room_id)
+        if room and data.get("type") in SEQUENCED_TYPES:
+            data = {**data, "seq": room.backlog.next_seq}  # Numbered once, here; other workers keep this seq
+        # Backlog changes also reach workers with no members here, so any of them can serve a resume
+        if room and (room.remote or data.get("type") in BACKLOG_TYPES):
+            self.backplane.publish(room_id, {"op": "broadcast", "data": data})
+        await self._fanout(room_id, data, exclude)
 
-    async def broadcast(self, room_id: str, data: dict, exclude: Optional[WebSocket] = None):
+    async def _fanout(self, room_id: str, data: dict, exclude: Collection[WebSocket] = ()):
+        """Deliver to the sockets held by this worker only"""
         if room_id in self.rooms:
             room = self.rooms[room_id]
+            started = time.perf_counter()
             
-            # HIGH-3 FIX: Store message in buffer with size limit
-            if data.get("type") in [MessageTypes.MESSAGE, MessageTypes.IMAGE, MessageTypes.FILE]:
-                room.recent_messages.append(data)
-                # Keep only last N messages to prevent memory leak
-                if len(room.recent_messages) > GhostDimension.MAX_MESSAGES_IN_MEMORY:
-                    room.recent_messages = room.recent_messages[-GhostDimension.MAX_MESSAGES_IN_MEMORY:]
+            # HIGH-3 FIX: Messages are numbered and kept in the size-bounded backlog
+            if data.get("type") in SEQUENCED_TYPES:
+                seq = data.get("seq", room.backlog.next_seq)
+                if seq < room.backlog.next_seq:
+                    # Another worker numbered a concurrent message the same; cursors up to here are ambiguous
+                    seq = room.diverged_upto = room.backlog.next_seq
+                    data = {**data, "seq": seq}
+                room.backlog.skip_to(seq)
+                frame = codec.dumps(data)
+                room.backlog.append(seq, frame, data.get("id"))
+            else:
+                if data.get("type") == MessageTypes.DELETE_MSG:
+                    room.backlog.remove(data.get("id"))
+                elif data.get("type") == MessageTypes.WIPE_ALL:
+                    room.backlog.clear()
+                elif data.get("type") == MessageTypes.EDIT_MSG:
+                    stored = room.backlog.get(data.get("id"))
+                    if stored:  # Replays show the edited ciphertext
+                        room.backlog.replace(data["id"], codec.dumps({**codec.loads(stored), "content": data.get("content")}))
+                frame = codec.dumps(data)
             
-            for ws in list(room.connections.keys()):
-                if ws == exclude: continue
-                try: await ws.send_json(data)
-                except: await self.leave(ws, room_id)
+            # Encode once, then fan out the shared frame; each writer task does the actual send
+            droppable = data.get("type") == MessageTypes.TYPING or (
+                data.get("type") == MessageTypes.BATCH and all(e["type"] == MessageTypes.TYPING for e in data["events"]))
+            if room.shards:
+                for shard in room.shards: shard.submit(frame, droppable, exclude)
+                FANOUT_SECONDS.observe(time.perf_counter() - started)
+                return
+            stale = [ws for ws, writer in room.writers.items()
+                     if ws not in exclude and not writer.enqueue(frame, droppable)]
+            FANOUT_SECONDS.observe(time.perf_counter() - started)
+            for ws in stale:
+                await self.disconnect(ws, room_id)
+
+    def unicast(self, ws: WebSocket, room_id: str, data: dict):
+        """Queue a frame for a single member of a dimension"""
+        room = self.rooms.get(room_id)
+        writer = room.writers.get(ws) if room else None
+        if writer: writer.enqueue(codec.dumps(data))
+
+    def open_transfer(self, ws: WebSocket, rid: str, spec) -> Optional[str]:
+        """Reserve byte budgets for an announced binary transfer; returns an error message on refusal"""
+        room = self.rooms.get(rid)
+        state = room.states.get(ws) if room else None
+        if not state: return "Not manifest in this dimension"
+        try:
+            tid, size = bytes.fromhex(spec["id"]), int(spec["size"])
+        except (KeyError, TypeError, ValueError):
+            return "Malformed transfer"
+        if len(tid) != 16 or size <= 0 or tid in room.transfers: return "Malformed transfer"
+        if size > MEDIA_MAX_TRANSFER_BYTES: return "Attachment too large"
+        if state.transfer_bytes + size > MEDIA_MAX_CONN_BYTES or room.transfer_bytes + size > MEDIA_MAX_ROOM_BYTES:
+            return "Too many uploads in flight. Try again shortly"
+        room.transfers[tid] = Transfer(ws, size)
+        state.transfer_bytes += size
+        room.transfer_bytes += size
+        return None
 
-    async def join(self, ws: WebSocket, rid: str, user: str, pwd: str) -> bool:
+    async def relay_chunk(self, ws: WebSocket, rid: str, frame: bytes):
+        """Fan an attachment chunk out unchanged: the same bytes object is queued for every receiver.
+
+        Chunks are local to this worker; rooms that span workers need sticky routing for binary transfers.
+        """
         room = self.rooms.get(rid)
-        if room and (room.locked or room.password != pwd):
+        if not room: return
+        if not CHUNK_HEADER.size < len(frame) <= CHUNK_HEADER.size + MEDIA_MAX_CHUNK_BYTES:
+            self.unicast(ws, rid, {"type": "error", "message": "Invalid attachment chunk"})
+            return
+        kind, tid, index, flags = CHUNK_HEADER.unpack_from(frame)
+        transfer = room.transfers.get(tid)
+        if kind != CHUNK_KIND or not transfer or transfer.sender is not ws or index != transfer.next_index:
+            self.unicast(ws, rid, {"type": "error", "message": "Invalid attachment chunk"})
+            return
+        transfer.received += len(frame) - CHUNK_HEADER.size
+        if transfer.received > transfer.size:
+            self._close_transfer(room, tid)
+            await self.broadcast(rid, {"type": "transfer_aborted", "transfer_id": tid.hex()})
+            return
+        transfer.next_index += 1
+        transfer.last_chunk = time.monotonic()
+        if flags & CHUNK_LAST: self._close_transfer(room, tid)
+        stale = [other for other, writer in room.writers.items()
+                 if other is not ws and not writer.enqueue(frame)]
+        for other in stale:
+            await self.disconnect(other, rid)
+
+    def _close_transfer(self, room: GhostDimension, tid: bytes):
+        transfer = room.transfers.pop(tid)
+        room.transfer_bytes -= transfer.size
+        state = room.states.get(transfer.sender)
+        if state: state.transfer_bytes -= transfer.size
+
+    def replay(self, ws: WebSocket, rid: str, since: int):
+        """Send every backlog frame after `since` to one socket as a single batch frame"""
+        room = self.rooms.get(rid)
+        writer = room.writers.get(ws) if room else None
+        if not writer: return
+        # A cursor inside a range numbered differently on another worker cannot be trusted: resend everything
+        reset = since < room.diverged_upto
+        # Stored frames are already encoded, so the batch is assembled without re-serializing
+        frames = room.backlog.since(0 if reset else since)
+        writer.enqueue('{"type":"backlog","first_seq":%d,"next_seq":%d,%s"messages":[%s]}'
+                       % (room.backlog.first_seq, room.backlog.next_seq, '"reset":true,' if reset else "", ",".join(frames)))
+
+    async def disconnect(self, ws: WebSocket, rid: str, code: int = 1013):
+        """Evict a dead or slow consumer and close its socket in the background"""
+        await self.leave(ws, rid)
+        asyncio.create_task(close_quietly(ws, code))
+
+    async def join(self, ws: WebSocket, rid: str, user: str, pwd: str, large: bool = False) -> bool:
+        if self.draining:
+            await ws.send_text(reconnect_hint())
+            return False
+        seal, fast = await seal_for(rid, pwd, self.rooms.get(rid))
+        room = self.rooms.get(rid)  # Re-read: another join may have created or dropped it meanwhile
+        if room and ((room.locked and user not in room.returning) or not hmac.compare_digest(room.seal, seal)):
             msg = "Dimension Sealed" if room.locked else "Incorrect Seal"
             await ws.send_json({"type": "error", "message": msg})
             return False
         if not room:
-            room = self.rooms[rid] = GhostDimension(rid, pwd, user)
+            if not self.admission.allow_new_room():
+                await ws.send_text(self.admission.retry_hint("new_room"))
+                return False
+            room = self.rooms[rid] = GhostDimension(rid, seal, user, large)
+        room.seal_fast = fast
         
-        if len(room.connections) >= self.MAX_PARTICIPANTS:
+        # Large rooms are bounded by what this worker can hold, not by head count
+        full = (room.memory_estimate() + LARGE_ROOM_CONN_BYTES > LARGE_ROOM_MEMORY_BUDGET if room.large
+                else room.member_count() >= self.MAX_PARTICIPANTS)
+        if full:
             await ws.send_json({"type": "error", "message": "Dimension at Maximum Capacity"})
+            if room.is_empty() and room.dormant_until <= time.monotonic(): self._drop_room(rid)
             return False
 
-        if any(u == user for u in room.connections.values()):
+        if room.has_member(user):
             await ws.send_json({"type": "error", "message": "Handle already manifest"})
             return False
         
         room.connections[ws] = user
-        await self.broadcast_user_list(rid)
-        await self.broadcast(rid, {"type": "system", "content": f"{user} manifest. Guardian: {room.admin}"})
+        room.sockets[user] = ws
+        room.writers[ws] = writer = ConnectionWriter(ws)
+        room.states[ws] = ConnectionState()
+        if room.large:
+            if not room.shards:
+                room.shards = [FanoutShard(lambda sock, rid=rid: self.disconnect(sock, rid)) for _ in range(LARGE_ROOM_SHARDS)]
+            min(room.shards, key=lambda shard: len(shard.writers)).writers[ws] = writer
+        self.backplane.publish(rid, {"op": "join", "user": user, "seal": room.seal, "admin": room.admin,
+                                     "locked": room.locked, "large": room.large, "count": room.member_count(),
+                                     "next_seq": room.backlog.next_seq})
+        # Existing members get a delta; only the newcomer pays for the full snapshot
+        self._presence(rid, "joined", user=user)
+        self.unicast(ws, rid, self._user_list(room))
+        if not room.large:  # Large rooms only announce the member count
+            await self.broadcast(rid, {"type": "system", "content": f"{user} manifest. Guardian: {room.admin}"})
         return True
 
     async def leave(self, ws: WebSocket, rid: str):
@@ -278,41 +2348,364 @@ class DimensionRegistry:
             room = self.rooms[rid]
             if ws in room.connections:
                 user = room.connections.pop(ws)
+                room.sockets.pop(user, None)
+                writer = room.writers.pop(ws, None)
+                if writer: writer.close()
+                for shard in room.shards: shard.writers.pop(ws, None)
+                room.states.pop(ws, None)
+                if self.draining:  # Keep the room for the snapshot; its members are reconnecting elsewhere
+                    room.returning.add(user)
+                    return
+                for tid in [tid for tid, t in room.transfers.items() if t.sender is ws]:
+                    self._close_transfer(room, tid)
+                    await self.broadcast(rid, {"type": "transfer_aborted", "transfer_id": tid.hex()})
                 # Clear typing status for this user
-                await self.broadcast(rid, {"type": "typing", "username": user, "status": False}, exclude=ws)
+                self.queue_typing(rid, user, False)
                 
-                if not room.connections: self.rooms.pop(rid)
+                new_admin = user == room.admin and not room.is_empty()
+                if new_admin:
+                    room.admin = next(iter(room.connections.values()), None) or next(iter(room.remote))
+                self.backplane.publish(rid, {"op": "leave", "user": user, "admin": room.admin})
+                if room.is_empty():
+                    if room.dormant_until <= time.monotonic(): self._drop_room(rid)
                 else:
-                    if user == room.admin:
-                        room.admin = next(iter(room.connections.values()))
+                    self._presence(rid, "left", user=user)
+                    if new_admin:
+                        self._presence(rid, "admin_changed", admin=room.admin)
                         await self.broadcast(rid, {"type": "system", "content": f"Guardian vanished. New Guardian: {room.admin}"})
-                    await self.broadcast_user_list(rid)
-                    await self.broadcast(rid, {"type": "system", "content": f"{user} vanished."})
+                    if not room.large:
+                        await self.broadcast(rid, {"type": "system", "content": f"{user} vanished."})
 
-    async def broadcast_user_list(self, rid: str):
+    def _drop_room(self, rid: str):
+        room = self.rooms.pop(rid, None)
+        if room:
+            for shard in room.shards: shard.close()
+        self.timers.cancel_group(rid)
+        self.blobs.release_room(rid)
+
+    async def expire_message(self, rid: str, mid: str):
+        """Timer callback for self-destructing messages; delete_msg also evicts it from the backlog"""
+        self.blobs.release_message(rid, mid)
         if rid in self.rooms:
-            room = self.rooms[rid]
-            await self.broadcast(rid, {"type": "user_list", "users": list(room.connections.values()), "admin": room.admin, "is_locked": room.locked})
+            await self.broadcast(rid, {"type": MessageTypes.DELETE_MSG, "id": mid})
+
+    async def set_locked(self, rid: str, locked: bool):
+        room = self.rooms.get(rid)
+        if room and room.locked != locked:
+            room.locked = locked
+            self.backplane.publish(rid, {"op": "state", "admin": room.admin, "locked": locked})
+            self._presence(rid, "lock_changed", locked=locked)
+
+    async def kick(self, rid: str, target: str):
+        """Eject a member; local targets are found through the handle index"""
+        room = self.rooms.get(rid)
+        if not room or not room.has_member(target): return
+        ws = room.sockets.get(target)
+        if ws is None:
+            # Held by another worker, which ejects it the same way and relays the leave
+            self.backplane.publish(rid, {"op": "kick", "node": room.remote[target], "user": target})
+            return
+        await self.leave(ws, rid)
+        asyncio.create_task(close_quietly(ws, 1008, codec.dumps({"type": MessageTypes.KICKED, "target": target})))
+
+    def send_snapshot(self, ws: WebSocket, rid: str, version: Optional[int] = None):
+        """Resync a client whose presence version does not match this worker's"""
+        room = self.rooms.get(rid)
+        if room and version != room.presence_version:
+            self.unicast(ws, rid, self._user_list(room))
+
+    def _presence(self, rid: str, op: str, **fields):
+        """Queue a versioned presence delta (joined, left, admin_changed, lock_changed).
+
+        Versions are per worker: every worker applies the same backplane events and
+        emits its own deltas, so they are delivered locally and never relayed.
+        Clients ignore deltas at or below the version of their last snapshot.
+        """
+        room = self.rooms.get(rid)
+        if room and room.large and op in ("joined", "left"):
+            room.count_dirty = True  # Collapsed into one "count" delta per flush
+            self._mark_dirty(rid)
+        elif room:
+            room.presence_version += 1
+            room.pending_events.append({"type": MessageTypes.PRESENCE, "v": room.presence_version, "op": op, **fields})
+            self._mark_dirty(rid)
 
-    async def check_rate_limit(self, ws: WebSocket, rid: str) -> bool:
+    def queue_typing(self, rid: str, user: str, status):
+        """Debounce typing state; only the last status per user in a tick is considered"""
+        room = self.rooms.get(rid)
+        if room and (not status or not self.admission.degraded):  # Under load only "stopped typing" gets through
+            room.pending_typing[user] = bool(status)
+            self._mark_dirty(rid)
+
+    def _mark_dirty(self, rid: str):
+        self._dirty.add(rid)
+        if self._flush_handle is None:
+            delay = PRESENCE_FLUSH_INTERVAL * (DEGRADED_FLUSH_FACTOR if self.admission.degraded else 1)
+            self._flush_handle = asyncio.get_running_loop().call_later(
+                delay, lambda: asyncio.create_task(self.flush_presence()))
+
+    async def flush_presence(self):
+        """Send each dirty room's presence deltas and typing changes as a single frame"""
+        if self._flush_handle: self._flush_handle.cancel()
+        self._flush_handle = None
+        dirty, self._dirty = self._dirty, set()
+        for rid in dirty:
+            room = self.rooms.get(rid)
+            if not room: continue
+            events, room.pending_events = room.pending_events, []
+            if room.count_dirty:
+                room.count_dirty = False
+                room.presence_version += 1
+                events.append({"type": MessageTypes.PRESENCE, "v": room.presence_version, "op": "count",
+                               "total": room.member_count()})
+            # Crowded large rooms show only a handful of typers
+            sampled = room.large and room.member_count() > LARGE_ROOM_TYPING_THRESHOLD
+            relay = []
+            for user, status in room.pending_typing.items():
+                if status == (user in room.typing): continue  # Repeated keystrokes change nothing
+                if status and sampled and len(room.typing) >= LARGE_ROOM_MAX_TYPERS: continue
+                if status: room.typing.add(user)
+                else: room.typing.discard(user)
+                events.append({"type": MessageTypes.TYPING, "username": user, "status": status})
+                if user in room.sockets: relay.append([user, status])
+            room.pending_typing.clear()
+            if relay and room.remote:
+                self.backplane.publish(rid, {"op": "typing", "events": relay})
+            if not events: continue
+            self.coalesced["events"] += len(events)
+            self.coalesced["frames"] += 1
+            # Typists get the same batch without their own typing events
+            typists = {room.sockets[user]: user for user, _ in relay}
+            await self._fanout(rid, self._batch(events), typists)
+            for ws, user in typists.items():
+                own = [e for e in events if e["type"] != MessageTypes.TYPING or e["username"] != user]
+                if own: self.unicast(ws, rid, self._batch(own))
+
+    @staticmethod
+    def _batch(events: List[dict]) -> dict:
+        return events[0] if len(events) == 1 else {"type": MessageTypes.BATCH, "events": events}
+
+    def _user_list(self, room: GhostDimension) -> dict:
+        frame = {"type": "user_list", "v": room.presence_version, "users": room.members(),
+                 "admin": room.admin, "is_locked": room.locked}
+        if room.large:
+            # First page only; the rest is fetched from /api/rooms/{rid}/members
+            frame["total"] = len(frame["users"])
+            frame["users"] = heapq.nsmallest(LARGE_ROOM_SNAPSHOT, frame["users"])
+        return frame
+
+    def members_page(self, rid: str, after: str = "", limit: int = 100) -> dict:
+        """One page of a room's members in name order, resuming after the given name"""
+        room = self.rooms.get(rid)
+        names = sorted(room.members()) if room else []
+        start = bisect.bisect_right(names, after) if after else 0
+        page = names[start:start + limit]
+        return {"members": page, "total": len(names), "next": page[-1] if start + limit < len(names) else None}
+
+    async def start_backplane(self):
+        """Join the backplane and ask the other workers for the rooms they already hold"""
+        await self.backplane.start(self.handle_remote)
+        self.backplane.publish("", {"op": "sync"})
+
+    def _room_state(self, room: GhostDimension) -> dict:
+        return {"op": "room", "seal": room.seal, "admin": room.admin, "locked": room.locked,
+                "large": room.large, "members": list(room.connections.values()), "next_seq": room.backlog.next_seq}
+
+    async def handle_remote(self, origin: str, rid: str, event: dict):
+        """Apply an event relayed from another worker; fan-out stays local"""
+        op = event.get("op")
+        if op == "node_down":
+            for room_id, room in list(self.rooms.items()):
+                gone = [u for u, node in room.remote.items() if node == origin]
+                for user in gone:
+                    await self.handle_remote(origin, room_id, {"op": "leave", "user": user, "admin": room.admin})
+            self.nodes.pop(origin, None)  # After the leaves, which count as hearing from it
+            return
+        self.nodes[origin] = time.monotonic()
+        if op == "node_alive": return
+        if op == "sync":  # An empty room id asks for every room
+            for room_id in [rid] if rid else list(self.rooms):
+                room = self.rooms.get(room_id)
+                if room and room.connections:
+                    self.backplane.publish(room_id, self._room_state(room))
+            return
+        room = self.rooms.get(rid)
+        created = op in ("join", "room") and not room
+        if created:
+            room = self.rooms[rid] = GhostDimension(rid, event["seal"], event["admin"], event.get("large", False))
+            room.locked = event["locked"]
+            if op == "join" and event.get("count", 1) > 1:  # Members joined before this worker was listening
+                self.backplane.publish(rid, {"op": "sync"})
+        if op == "join":
+            user = event["user"]
+            # The origin checked against its own copy, which is stale if it never heard of this room
+            if room.seal != event["seal"] or (room.locked and not created and user not in room.returning):
+                message = "Dimension Sealed" if room.seal == event["seal"] else "Incorrect Seal"
+                self.backplane.publish(rid, {"op": "reject", "node": origin, "user": user, "message": message})
+                return
+            room.remote[user] = origin
+            room.backlog.skip_to(event.get("next_seq", 1))  # Number on from where the room already is
+            self._presence(rid, "joined", user=user)
+        elif op == "room":
+            if room.seal != event["seal"]: return  # A rival copy; the joins behind it get rejected
+            room.backlog.skip_to(event.get("next_seq", 1))
+            for user in event["members"]:
+                if not room.has_member(user):
+                    room.remote[user] = origin
+                    if not created: self._presence(rid, "joined", user=user)
+        elif not room:
+            return
+        elif op == "reject":
+            ws = room.sockets.get(event["user"]) if event["node"] == self.backplane.node_id else None
+            if ws:
+                await self.leave(ws, rid)
+                asyncio.create_task(close_quietly(ws, 1008, codec.dumps({"type": "error", "message": event["message"]})))
+        elif op == "kick":
+            if event["node"] == self.backplane.node_id and event["user"] in room.sockets:
+                await self.kick(rid, event["user"])
+        elif op == "broadcast":
+            await self._fanout(rid, event["data"])
+        elif op == "leave":
+            if room.remote.pop(event["user"], None) is None: return
+            if room.is_empty(): return self._drop_room(rid)
+            self._presence(rid, "left", user=event["user"])
+            self.queue_typing(rid, event["user"], False)
+            if room.admin == event["user"]:
+                # The origin picks the successor; fall back locally if it had nobody left to pick
+                successor = event["admin"]
+                room.admin = successor if successor != event["user"] else room.members()[0]
+                self._presence(rid, "admin_changed", admin=room.admin)
+        elif op == "typing":
+            for user, status in event["events"]:
+                self.queue_typing(rid, user, status)
+        elif op == "state":
+            if room.admin != event["admin"]:
+                room.admin = event["admin"]
+                self._presence(rid, "admin_changed", admin=room.admin)
+            if room.locked != event["locked"]:
+                room.locked = event["locked"]
+                self._presence(rid, "lock_changed", locked=room.locked)
+
+    def snapshot(self) -> bytes:
+        """Encode every room; taken once sockets and the backplane are closed, so no later seq can exist"""
+        return encode_snapshot(self.rooms)
+
+    async def drain(self, timeout: float = DRAIN_TIMEOUT):
+        """Stop tearing rooms down, then tell each local socket when to come back, jittered so they do not return at once"""
+        if self.draining: return
+        self.draining = True
+        goodbye = codec.dumps({"type": "system", "content": "The void is collapsing for maintenance. Reconnect shortly."})
+        writers = [writer for room in self.rooms.values() for writer in room.writers.values()]
+        for writer in writers:
+            writer.enqueue(goodbye)
+            writer.enqueue(reconnect_hint())
+        deadline = time.monotonic() + timeout
+        while any(writer.queue for writer in writers if not writer.dead) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        logger.info("Drained %d sockets across %d rooms", len(writers), len(self.rooms))
+
+    def restore(self, records: List[Tuple[dict, List[str]]], now: Optional[float] = None):
+        """Recreate rooms from a snapshot; they stay dormant until their members return or the grace ends"""
+        deadline = (time.monotonic() if now is None else now) + WARM_RESTART_GRACE
+        for record, frames in records:
+            rid = record["id"]
+            room = self.rooms[rid] = GhostDimension(rid, record["seal"], record["admin"], record["large"])
+            room.locked = record["locked"]
+            room.returning = set(record["members"])
+            room.dormant_until = deadline
+            room.backlog.restore(record["first_seq"], record["next_seq"],
+                                 [(seq, frame, mid) for (seq, mid), frame in zip(record["seqs"], frames)])
+            for mid, digest in record["blobs"].items():
+                if self.blobs.exists(digest): self.blobs.ref(digest, rid, mid)
+        if records: logger.info("Restored %d rooms from the warm-restart snapshot", len(records))
+
+    def expire_dormant(self, now: float):
+        """End the grace period of restored rooms: drop the abandoned ones, replace a Guardian who never came back"""
+        for rid, room in list(self.rooms.items()):
+            if not room.dormant_until or room.dormant_until > now: continue
+            room.dormant_until = 0.0
+            room.returning.clear()
+            if room.is_empty():
+                self._drop_room(rid)
+            elif not room.has_member(room.admin):
+                room.admin = next(iter(room.connections.values()), None) or next(iter(room.remote))
+                self.backplane.publish(rid, {"op": "state", "admin": room.admin, "locked": room.locked})
+                self._presence(rid, "admin_changed", admin=room.admin)
+
+    async def heartbeat(self, now: Optional[float] = None):
+        """One pass over every local socket: ping the quiet ones, reap the dead and the idle"""
+        now = time.monotonic() if now is None else now
+        self.expire_dormant(now)
+        # Workers that crash never send node_down; their members go once they have been silent long enough
+        self.backplane.publish("", {"op": "node_alive"})
+        for node in [node for node, seen in self.nodes.items() if now - seen > BACKPLANE_NODE_TIMEOUT]:
+            logger.warning("Backplane node %s went silent; dropping its members", node)
+            await self.handle_remote(node, "", {"op": "node_down"})
+        ping = codec.dumps({"type": MessageTypes.PING})
+        doomed = []
+        for rid, room in self.rooms.items():
+            for ws, state in room.states.items():
+                if now - state.last_seen > HEARTBEAT_TIMEOUT:
+                    doomed.append((ws, rid, "timeout"))
+                elif IDLE_TIMEOUT and now - state.last_active > IDLE_TIMEOUT:
+                    doomed.append((ws, rid, "idle"))
+                elif now - state.last_seen > HEARTBEAT_INTERVAL:
+                    if not room.writers[ws].enqueue(ping):
+                        doomed.append((ws, rid, "timeout"))
+        for ws, rid, reason in doomed:
+            self.reaped[reason] += 1
+            await self.disconnect(ws, rid, code=1001)
+        if doomed: logger.info("Reaped %d unresponsive or idle sockets", len(doomed))
+        for rid, room in list(self.rooms.items()):
+            for tid in [tid for tid, t in room.transfers.items() if now - t.last_chunk > MEDIA_TRANSFER_TIMEOUT]:
+                self._close_transfer(room, tid)
+                await self.broadcast(rid, {"type": "transfer_aborted", "transfer_id": tid.hex()})
+
+    async def check_rate_limit(self, ws: WebSocket, rid: str, kind: str = "chat") -> bool:
         """Prevent spamming phantoms from crashing the dimension"""
         room = self.rooms.get(rid)
-        if not room: return True
-        
-        now = time.time()
-        if ws not in room.message_counts:
-            room.message_counts[ws] = []
+        state = room.states.get(ws) if room else None
+        if not state or not RATE_LIMITS_ENABLED: return True
         
-        # Keep only timestamps from the last 10 seconds
-        room.message_counts[ws] = [t for t in room.message_counts[ws] if now - t < 10]
-        
-        if len(room.message_counts[ws]) > 30:  # Max 30 messages per 10 seconds
-            return False
-            
-        room.message_counts[ws].append(now)
-        return True
+        if getattr(state, kind).take(time.monotonic()):
+            return True
+        state.throttled += 1
+        self.throttled[kind] += 1
+        return False
+
+registry = DimensionRegistry(build_backplane(os.getenv("BACKPLANE", "inprocess")),
+                             build_token_store(os.getenv("TOKEN_STORE", "memory")))
 
-registry = DimensionRegistry()
+# Scrape-time views of state the registry and pools already track
+metrics.collect("securechat_rooms", "Rooms held by this worker", "gauge", lambda: len(registry.rooms))
+metrics.collect("securechat_connections", "WebSockets held by this worker", "gauge",
+                lambda: sum(len(room.connections) for room in registry.rooms.values()))
+metrics.collect("securechat_remote_members", "Room members held by other workers", "gauge",
+                lambda: sum(len(room.remote) for room in registry.rooms.values()))
+metrics.collect("securechat_handshake_tokens", "Unredeemed handshake tokens", "gauge", lambda: len(registry.tokens))
+metrics.collect("securechat_handshake_tokens_total", "Handshake token lifecycle events", "counter",
+                lambda: {k: v for k, v in registry.tokens.stats().items() if k != "held"}, label="event")
+metrics.collect("securechat_self_destruct_timers", "Pending self-destruct timers", "gauge", lambda: len(registry.timers))
+metrics.collect("securechat_throttled_total", "Frames rejected by per-connection rate limits", "counter",
+                lambda: registry.throttled, label="kind")
+metrics.collect("securechat_coalesced_total", "Typing/presence events and the frames that carried them", "counter",
+                lambda: registry.coalesced, label="unit")
+metrics.collect("securechat_reaped_total", "Sockets closed by the heartbeat reaper", "counter",
+                lambda: registry.reaped, label="reason")
+metrics.collect("securechat_admission_level", "Load level: 0 normal, 1 degraded, 2 no new rooms, 3 rejecting", "gauge",
+                lambda: registry.admission.level)
+metrics.collect("securechat_admission_rejected_total", "Sockets and rooms refused by admission control", "counter",
+                lambda: registry.admission.rejected, label="reason")
+metrics.collect("securechat_log_records_discarded_total", "Log records dropped before reaching the writer thread", "counter",
+                lambda: {"queue_full": log_handler.dropped, "rate_limited": log_throttle.suppressed,
+                         "sampled_out": log_throttle.sampled_out}, label="reason")
+metrics.collect("securechat_bcrypt_in_flight", "bcrypt calls running or queued", "gauge", lambda: hasher.pending)
+metrics.collect("securechat_bcrypt_rejected_total", "bcrypt calls refused with 503", "counter", lambda: hasher.rejected)
+metrics.collect("securechat_backup_last_size_bytes", "Compressed size of the last backup", "gauge",
+                lambda: backup_stats["last_size"])
+metrics.collect("securechat_backup_last_duration_seconds", "Duration of the last backup", "gauge",
+                lambda: backup_stats["last_duration"])
+metrics.collect("securechat_backup_failures_total", "Failed backups", "counter", lambda: backup_stats["failures"])
 
 # --- API ---
 @app.post("/api/register")
@@ -327,12 +2720,13 @@ async def register(request: Request, d: dict):
         return JSONResponse({"status": "fail", "msg": str(e)}, status_code=400)
     
     recovery_key = secrets.token_hex(16)
-    with get_db() as db:
-        if db.execute("SELECT 1 FROM users WHERE username = ?", (u,)).fetchone():
-            return {"status": "fail", "msg": "ID taken"}
-        db.execute("INSERT INTO users (username, password, recovery_key) VALUES (?, ?, ?)", (u, hash_password(p), recovery_key))
-        db.commit()
-        logger.info(f"New user registered: {u}")
+    if await database.fetchone("SELECT 1 FROM users WHERE username = ?", (u,)):
+        return {"status": "fail", "msg": "ID taken"}
+    try:
+        await database.execute("INSERT INTO users (username, password, recovery_key) VALUES (?, ?, ?)", (u, await hasher.hash(p), recovery_key))
+    except sqlite3.IntegrityError:
+        return {"status": "fail", "msg": "ID taken"}
+    auth_logger.info("New user registered: %s", u)
     return {"status": "ok", "recovery_key": recovery_key}
 
 @app.post("/api/login")
@@ -345,15 +2739,22 @@ async def login(request: Request, d: dict, response: Response):
     except ValueError as e:
         return JSONResponse({"status": "fail", "msg": str(e)}, status_code=400)
     
-    with get_db() as db:
-        res = db.execute("SELECT * FROM users WHERE username = ?", (u,)).fetchone()
-        if res and verify_password(p, res['password']):
-            logger.info(f"User logged in: {u}")
-            # SECURITY: Use HttpOnly cookie for session
-            response.set_cookie(key="ghost_session", value=str(res['id']), httponly=True, samesite="strict")
-            return {"status": "ok", "user_id": res['id'], "username": u}
+    res = await database.fetchone("SELECT * FROM users WHERE username = ?", (u,))
+    if res and await hasher.verify(p, res['password']):
+        auth_logger.info("User logged in: %s", u)
+        if password_needs_rehash(res['password']):
+            # Cost was raised since this hash was made; upgrade it while we have the plaintext
+            try:
+                await database.execute("UPDATE users SET password = ? WHERE id = ?", (await hasher.hash(p), res['id']))
+            except HasherSaturated:
+                pass
+        # SECURITY: Use HttpOnly cookie for session
+        response.set_cookie(key="ghost_session", value=sign_session(res['id']), max_age=SESSION_TTL,
+                            httponly=True, samesite="strict")
+        user_cache.set(res['id'], res['username'])
+        return {"status": "ok", "user_id": res['id'], "username": u}
     
-    logger.warning(f"Failed login attempt for: {u}")
+    auth_logger.warning("Failed login attempt for: %s", u)
     return JSONResponse({"status": "fail", "msg": "Invalid credentials"}, status_code=401)
 
 @app.post("/api/logout")
@@ -363,14 +2764,13 @@ async def logout(response: Response):
 
 @app.post("/api/delete-account")
 async def delete_account(request: Request):
-    uid = request.cookies.get("ghost_session")
-    if not uid:
-        raise HTTPException(status_code=401, detail="Unauthorized")
+    uid = session_uid(request)
     
-    with get_db() as db:
-        db.execute("DELETE FROM users WHERE id = ?", (uid,))
-        db.execute("DELETE FROM history WHERE user_id = ?", (uid,))
-        db.commit()
+    await database.transaction([
+        ("DELETE FROM users WHERE id = ?", (uid,)),
+        ("DELETE FROM history WHERE user_id = ?", (uid,)),
+    ])
+    user_cache.invalidate(uid)
     
     response = JSONResponse({"status": "ok"})
     response.delete_cookie(key="ghost_session")
@@ -388,12 +2788,11 @@ async def recover_account(d: dict):
     except ValueError as e:
         return JSONResponse({"status": "fail", "msg": str(e)}, status_code=400)
     
-    with get_db() as db:
-        res = db.execute("SELECT * FROM users WHERE username = ? AND recovery_key = ?", (u, rk)).fetchone()
-        if res:
-            db.execute("UPDATE users SET password = ? WHERE id = ?", (hash_password(np), res['id']))
-            db.commit()
-            return {"status": "ok"}
+    res = await database.fetchone("SELECT * FROM users WHERE username = ? AND recovery_key = ?", (u, rk))
+    if res:
+        await database.execute("UPDATE users SET password = ? WHERE id = ?", (await hasher.hash(np), res['id']))
+        user_cache.invalidate(res['id'])
+        return {"status": "ok"}
     return JSONResponse({"status": "fail", "msg": "Recovery failed"}, status_code=401)
 
 @app.post("/api/save-room")
@@ -407,30 +2806,36 @@ async def save_room(request: Request, d: dict):
         if user_id <= 0:
             raise HTTPException(400, "Invalid user ID")
         
-        with get_db() as db:
-            db.execute("INSERT OR IGNORE INTO history (user_id, room_id) VALUES (?, ?)", (user_id, room_id))
-            db.commit()
+        await database.execute("INSERT OR IGNORE INTO history (user_id, room_id) VALUES (?, ?)", (user_id, room_id))
         return {"status": "ok"}
     except (ValueError, TypeError) as e:
         raise HTTPException(400, f"Invalid input: {str(e)}")
 
 @app.get("/api/history/{uid}")
 async def get_history(uid: int):
-    with get_db() as db:
-        res = db.execute("SELECT room_id FROM history WHERE user_id = ?", (uid,)).fetchall()
-        return [r['room_id'] for r in res]
+    res = await database.fetchall("SELECT room_id FROM history WHERE user_id = ?", (uid,))
+    return [r['room_id'] for r in res]
 
 @app.get("/health")
 async def health_check():
     """NASA-Grade Health Check"""
     try:
-        with get_db() as db:
-            db.execute("SELECT 1")
-        return {"status": "healthy", "timestamp": datetime.now().isoformat(), "version": "1.1.0"}
+        await database.fetchone("SELECT 1")
+        return {"status": "healthy", "timestamp": datetime.now().isoformat(), "version": "1.1.0",
+                "tokens": registry.tokens.stats(), "hasher": hasher.stats(), "throttled": registry.throttled,
+                "coalesced": registry.coalesced, "backup": backup_stats, "reaped": registry.reaped,
+                "admission": registry.admission.stats()}
     except Exception as e:
-        logger.error(f"Health check failed: {str(e)}")
+        logger.error("Health check failed: %s", e)
         return JSONResponse({"status": "unhealthy", "error": str(e)}, status_code=503)
 
+@app.get("/metrics")
+async def metrics_endpoint(request: Request):
+    """Prometheus metrics for this worker"""
+    if METRICS_TOKEN and not hmac.compare_digest(request.headers.get("authorization", ""), f"Bearer {METRICS_TOKEN}"):
+        raise HTTPException(status_code=401)
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
 @app.post("/api/verify-room")
 @limiter.limit("20/minute")
 async def verify_room(request: Request, d: dict):
@@ -441,82 +2846,167 @@ async def verify_room(request: Request, d: dict):
         return JSONResponse({"status": "fail", "msg": str(e)}, status_code=400)
     
     room = registry.rooms.get(room_id)
-    if not room or room.password == password:
+    if not room or hmac.compare_digest((await seal_for(room_id, password, room))[0], room.seal):
         return {"status": "ok"}
     return JSONResponse({"status": "fail", "msg": "Incorrect seal"}, status_code=403)
 
 @app.get("/api/ws-token")
 async def get_ws_token(request: Request):
-    uid = request.cookies.get("ghost_session")
-    if not uid:
-        raise HTTPException(status_code=401, detail="Unauthorized")
-    
-    # Get username from DB
-    with get_db() as db:
-        res = db.execute("SELECT username FROM users WHERE id = ?", (uid,)).fetchone()
-        if not res: raise HTTPException(status_code=401)
-        user = res['username']
-        
-    token = registry.generate_handshake_token(int(uid), user)
+    uid, user = await session_user(request)
+    token = await registry.generate_handshake_token(uid, user)
     return {"token": token}
 
-# --- SOCKET ---
-async def destruct(rid, mid):
-    await asyncio.sleep(30)
-    await registry.broadcast(rid, {"type": "delete_msg", "id": mid})
+@app.get("/api/rooms/{rid}/members")
+async def room_members(request: Request, rid: str, after: str = "", limit: int = 100):
+    """Page through a room's members; large rooms only push the first page on join"""
+    _, user = await session_user(request)
+    room = registry.rooms.get(rid)
+    if not room or not room.has_member(user):
+        raise HTTPException(status_code=404, detail="Not found")
+    return registry.members_page(rid, after, max(1, min(limit, MEMBER_PAGE_MAX)))
 
+@app.post("/api/blobs")
+@limiter.limit("30/minute")
+async def upload_blob(request: Request):
+    """Upload an encrypted attachment once; messages then reference it by hash"""
+    session_uid(request)
+    if int(request.headers.get("content-length") or 0) > registry.blobs.max_bytes:
+        return JSONResponse({"status": "fail", "msg": "Attachment too large"}, status_code=413)
+    try:
+        digest, size = await registry.blobs.put(request.stream())
+    except ValueError as e:
+        return JSONResponse({"status": "fail", "msg": str(e)}, status_code=413)
+    return {"status": "ok", "blob": digest, "size": size}
+
+@app.get("/api/blobs/{digest}")
+async def download_blob(request: Request, digest: str):
+    """Serve a blob with Range support; servers implementing pathsend send it zero-copy"""
+    session_uid(request)
+    if not registry.blobs.exists(digest):
+        raise HTTPException(status_code=404, detail="Not found")
+    return FileResponse(registry.blobs.path(digest), media_type="application/octet-stream",
+                        headers={"Cache-Control": "private, max-age=31536000, immutable"})
+
+# --- SOCKET ---
 @app.websocket("/ws/{rid}/{user}")
-async def websocket_endpoint(ws: WebSocket, rid: str, user: str, pwd: str = Query(""), token: str = Query("")):
+async def websocket_endpoint(ws: WebSocket, rid: str, user: str, pwd: str = Query(""), token: str = Query(""),
+                             since: Optional[int] = Query(None), large: bool = Query(False)):
+    # Admission first: an overloaded worker spends nothing on the refused socket beyond the handshake
+    ip = ws.client.host if ws.client else "unknown"
+    refusal = registry.admission.admit(ip)
     await ws.accept()
-    
+    if refusal:
+        await close_quietly(ws, 1013, registry.admission.retry_hint(refusal))
+        return
+    try:
+        await serve_socket(ws, rid, user, pwd, token, since, large)
+    finally:
+        registry.admission.release(ip)
+
+async def serve_socket(ws: WebSocket, rid: str, user: str, pwd: str, token: str, since: Optional[int], large: bool):
     # SECURITY: Verify handshake token
-    token_data = registry.verify_handshake_token(token)
+    token_data = await registry.verify_handshake_token(token)
     if not token_data or token_data['user'] != user:
         await ws.send_json({"type": "error", "message": "Portal Token Expired or Invalid"})
         await ws.close()
         return
 
-    if not await registry.join(ws, rid, user, pwd): return
+    if not await registry.join(ws, rid, user, pwd, large): return
+    # Resume: replay messages missed since the client's last seen sequence number
+    if since is not None: registry.replay(ws, rid, since)
+    state = registry.rooms[rid].states[ws]  # Liveness stamps for the heartbeat reaper
     try:
         while True:
-            d = await ws.receive_json()
+            message = await ws.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            state.last_seen = time.monotonic()
+            if message.get("bytes") is not None:
+                state.last_active = state.last_seen
+                await registry.relay_chunk(ws, rid, message["bytes"])
+                continue
+            started = time.perf_counter()
+            try:
+                env = decode_envelope(message["text"])
+            except EnvelopeError as e:
+                # Rejected frames cost a chat token, and a socket that keeps sending them is closed
+                state.rejected += 1
+                if state.rejected >= ENVELOPE_ERROR_LIMIT:
+                    await registry.disconnect(ws, rid, code=e.close_code)
+                    return
+                if await registry.check_rate_limit(ws, rid, "chat"):
+                    registry.unicast(ws, rid, {"type": "error", "message": str(e)})
+                continue
+            PARSE_SECONDS.observe(time.perf_counter() - started)
+            if env is None: continue
             
-            # SECURITY: Rate Limiting
-            if not await registry.check_rate_limit(ws, rid):
-                await ws.send_json({"type": "error", "message": "Oracle Rate Limit Exceeded. Slow down, phantom."})
+            t = env.type
+            if t == MessageTypes.PONG: continue
+            state.last_active = state.last_seen
+
+            # SECURITY: Rate Limiting (separate budgets for chat, typing and media)
+            kind = frame_kind(t)
+            if not await registry.check_rate_limit(ws, rid, kind):
+                if kind != "typing":  # Excess typing frames are dropped silently
+                    registry.unicast(ws, rid, {"type": "error", "message": "Oracle Rate Limit Exceeded. Slow down, phantom."})
                 continue
 
-            t = d.get("type")
             room = registry.rooms.get(rid)
             is_adm = room and room.admin == user
             
-            if t == "typing": await registry.broadcast(rid, {"type": "typing", "username": user, "status": d.get("status")}, exclude=ws)
-            elif t == "kick" and is_adm: await registry.broadcast(rid, {"type": "kicked", "target": d.get("target")})
+            if t == "typing": registry.queue_typing(rid, user, env.status)
+            elif t == "kick" and is_adm: await registry.kick(rid, env.target)
+            elif t == "presence_sync": registry.send_snapshot(ws, rid, env.v)
             elif t == "wipe" and is_adm: await registry.broadcast(rid, {"type": "wipe_all"})
-            elif t == "lock" and is_adm: room.locked = True; await registry.broadcast_user_list(rid)
-            elif t == "unlock" and is_adm: room.locked = False; await registry.broadcast_user_list(rid)
+            elif t == "lock" and is_adm: await registry.set_locked(rid, True)
+            elif t == "unlock" and is_adm: await registry.set_locked(rid, False)
             elif t == "edit_msg":
-                mid = d.get("id")
-                await registry.broadcast(rid, {"type": "edit_msg", "id": mid, "content": d.get("content")})
-            elif t in ["message", "image", "file", "reaction"]:
+                await registry.broadcast(rid, env.to_dict())
+            elif isinstance(env, ChatEnvelope):
+                blob = getattr(env, "blob", None)
+                if getattr(env, "transfer", None) is not None:
+                    # Ciphertext follows as binary chunks; reserve budgets before announcing it
+                    error = registry.open_transfer(ws, rid, env.transfer)
+                    if error:
+                        registry.unicast(ws, rid, {"type": "error", "message": error})
+                        continue
+                if blob is not None and not registry.blobs.exists(blob):
+                    registry.unicast(ws, rid, {"type": "error", "message": "Unknown attachment"})
+                    continue
                 mid = str(uuid.uuid4())
+                ttl = env.self_destruct = self_destruct_ttl(env.self_destruct)
+                d = env.to_dict()  # Only declared fields are rebroadcast; unset ones are left out
                 d.update({
                     "id": mid, 
                     "username": user, 
                     "timestamp": datetime.now().isoformat(),
-                    "reply_to": d.get("reply_to")
                 })
+                if blob: registry.blobs.ref(blob, rid, mid)
                 await registry.broadcast(rid, d)
-                if d.get("self_destruct"): asyncio.create_task(destruct(rid, mid))
+                if ttl: registry.timers.schedule(ttl, rid, mid)
     except: await registry.leave(ws, rid)
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """Graceful Shutdown: Notify all active phantoms before the void closes"""
     logger.info("Oracle shutting down. Dismissing all phantoms...")
-    for rid, room in registry.rooms.items():
-        await registry.broadcast(rid, {"type": "system", "content": "The void is collapsing for maintenance. Reconnect shortly."})
+    # A no-op when the signal handler already drained; local sockets only, members on other workers stay
+    await registry.drain()
+    await asyncio.gather(*(close_quietly(ws, 1012) for room in registry.rooms.values() for ws in list(room.connections)))
+    registry.backplane.publish("", {"op": "node_down"})
     await asyncio.sleep(1)  # Small window for broadcast
+    await registry.backplane.stop()
+    # Last: every message this worker numbered, including any sent while draining, is in the snapshot
+    if registry.rooms:
+        try:
+            write_snapshot(snapshot_path(), registry.snapshot())
+            logger.info("Saved %d rooms to %s", len(registry.rooms), snapshot_path())
+        except OSError as e:
+            logger.error("Room snapshot failed: %s", e)
+    registry.timers.stop()
+    registry.tokens.close()
+    database.close()
+    hasher.close()
 
 # Serve static files (CSS, JS) explicitly
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -528,4 +3018,4 @@ async def read_root():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=int(os.environ.get("PORT", 8000)))
+    uvicorn.run(app, host="0.0.0.0", port=int(os.environ.get("PORT", 8000)), ws_max_size=WS_MAX_FRAME_BYTES)
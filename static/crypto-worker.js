@@ -0,0 +1,45 @@
+/**
+ * SecureChat crypto worker
+ * Decrypts batches of room messages off the main thread
+ */
+const keys = new Map(); // `${roomId}\0${password}` -> Promise<CryptoKey>
+const decoder = new TextDecoder();
+const fromBase64 = (s) => Uint8Array.from(atob(s), c => c.charCodeAt(0));
+
+// Same parameters as deriveKey in script.js: both sides must produce the same key
+const roomKey = (password, roomId) => {
+    const id = `${roomId}\0${password}`;
+    if (!keys.has(id)) {
+        const encoder = new TextEncoder();
+        const pending = crypto.subtle.importKey("raw", encoder.encode(password), "PBKDF2", false, ["deriveKey"])
+            .then(baseKey => crypto.subtle.deriveKey(
+                { name: "PBKDF2", salt: encoder.encode(roomId), iterations: 100000, hash: "SHA-256" },
+                baseKey, { name: "AES-GCM", length: 256 }, false, ["decrypt"]
+            ));
+        pending.catch(() => keys.delete(id));
+        keys.set(id, pending);
+    }
+    return keys.get(id);
+};
+
+const decryptOne = async (key, enc) => {
+    try {
+        const dec = await crypto.subtle.decrypt({ name: "AES-GCM", iv: fromBase64(enc.iv) }, key, fromBase64(enc.data));
+        return decoder.decode(dec);
+    } catch (e) { return "[ENCRYPTION ERROR]"; }
+};
+
+self.onmessage = async ({ data }) => {
+    if (data.type === 'forget') {
+        for (const id of keys.keys()) if (id.startsWith(`${data.roomId}\0`)) keys.delete(id);
+        return;
+    }
+    let results;
+    try {
+        const key = await roomKey(data.password, data.roomId);
+        results = await Promise.all(data.items.map(enc => decryptOne(key, enc)));
+    } catch (e) {
+        results = data.items.map(() => "[ENCRYPTION ERROR]");
+    }
+    self.postMessage({ id: data.id, results });
+};
@@ -76,8 +76,25 @@ document.addEventListener('DOMContentLoaded', () => {
         );
     };
 
+    // Keys are derived once per room and password, not per message; entries are dropped on leave
+    const roomKeys = new Map();
+    const getRoomKey = (password, roomId) => {
+        const id = `${roomId}\0${password}`;
+        if (!roomKeys.has(id)) {
+            const pending = deriveKey(password, roomId);
+            pending.catch(() => roomKeys.delete(id));
+            roomKeys.set(id, pending);
+        }
+        return roomKeys.get(id);
+    };
+
+    const forgetRoomKeys = (roomId) => {
+        for (const id of roomKeys.keys()) if (id.startsWith(`${roomId}\0`)) roomKeys.delete(id);
+        if (cryptoWorker) cryptoWorker.postMessage({ type: 'forget', roomId });
+    };
+
     const encryptMessage = async (text, password, roomId) => {
-        const key = await deriveKey(password, roomId);
+        const key = await getRoomKey(password, roomId);
         const iv = crypto.getRandomValues(new Uint8Array(12));
         const ciphertext = await crypto.subtle.encrypt({ name: "AES-GCM", iv }, key, new TextEncoder().encode(text));
         return { iv: btoa(String.fromCharCode(...iv)), data: btoa(String.fromCharCode(...new Uint8Array(ciphertext))) };
@@ -85,7 +102,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
     const decryptMessage = async (enc, password, roomId) => {
         try {
-            const key = await deriveKey(password, roomId);
+            const key = await getRoomKey(password, roomId);
             const iv = new Uint8Array(atob(enc.iv).split("").map(c => c.charCodeAt(0)));
             const data = new Uint8Array(atob(enc.data).split("").map(c => c.charCodeAt(0)));
             const dec = await crypto.subtle.decrypt({ name: "AES-GCM", iv }, key, data);
@@ -93,6 +110,36 @@ document.addEventListener('DOMContentLoaded', () => {
         } catch (e) { return "[ENCRYPTION ERROR]"; }
     };
 
+    // Incoming ciphertext is decrypted in batches by a Web Worker; main-thread fallback if it is unavailable
+    let cryptoWorker = window.Worker ? new Worker('/static/crypto-worker.js') : null;
+    const pendingBatches = new Map(); // batch id -> { resolve, items, password, roomId }
+    let nextBatchId = 0;
+
+    const decryptOnMainThread = ({ items, password, roomId }) =>
+        Promise.all(items.map(enc => decryptMessage(enc, password, roomId)));
+
+    if (cryptoWorker) {
+        cryptoWorker.onmessage = ({ data }) => {
+            const batch = pendingBatches.get(data.id);
+            pendingBatches.delete(data.id);
+            if (batch) batch.resolve(data.results);
+        };
+        cryptoWorker.onerror = () => {
+            cryptoWorker = null;
+            pendingBatches.forEach(batch => decryptOnMainThread(batch).then(batch.resolve));
+            pendingBatches.clear();
+        };
+    }
+
+    const decryptBatch = (items, password, roomId) => {
+        if (!cryptoWorker) return decryptOnMainThread({ items, password, roomId });
+        return new Promise(resolve => {
+            const id = nextBatchId++;
+            pendingBatches.set(id, { resolve, items, password, roomId });
+            cryptoWorker.postMessage({ type: 'decrypt', id, roomId, password, items });
+        });
+    };
+
     // --- DISCORD STYLE RENDERING ---
     const renderMessage = (msg) => {
         const m = document.createElement('div');
@@ -127,6 +174,10 @@ document.addEventListener('DOMContentLoaded', () => {
             item.className = `chat-item ${state.activeRoom === rid ? 'active' : ''}`;
             item.innerHTML = `<span class="hash">#</span><span class="channel-name">${sanitizeHTML(rid)}</span>`;
             item.addEventListener('click', () => switchRoom(rid));
+            item.addEventListener('contextmenu', (e) => {
+                e.preventDefault();
+                if (confirm(`Leave #${rid}?`)) leaveRoom(rid);
+            });
             elements.chatList.appendChild(item);
         });
     };
@@ -143,6 +194,18 @@ document.addEventListener('DOMContentLoaded', () => {
         updateMemberList();
     };
 
+    const leaveRoom = (rid) => {
+        delete state.rooms[rid];
+        forgetRoomKeys(rid);
+        localStorage.setItem('sc_rooms', JSON.stringify(state.rooms));
+        if (state.activeRoom === rid) {
+            state.activeRoom = null;
+            elements.activeChat.classList.add('hidden');
+            elements.emptyState.classList.remove('hidden');
+        }
+        updateSidebar();
+    };
+
     const updateMemberList = () => {
         elements.memberList.innerHTML = '';
         // In local state, we only know ourselves for now
@@ -156,17 +219,42 @@ document.addEventListener('DOMContentLoaded', () => {
     };
 
     // --- WEBSOCKET ---
+    // Messages arriving in the same tick are decrypted together: one worker round-trip per room, in order
+    let inbox = [];
+    let delivering = Promise.resolve();
+
+    const deliverBatch = async (frames) => {
+        const byRoom = new Map();
+        frames.forEach(f => byRoom.has(f.room) ? byRoom.get(f.room).push(f) : byRoom.set(f.room, [f]));
+        for (const [rid, list] of byRoom) {
+            const room = state.rooms[rid];
+            if (!room) continue;
+            const texts = await decryptBatch(list.map(f => f.content), room.password, rid);
+            if (state.rooms[rid] !== room) continue; // Left while decrypting
+            list.forEach((f, i) => {
+                const msg = { sender: f.sender, content: texts[i], timestamp: new Date() };
+                room.messages.push(msg);
+                if (state.activeRoom === rid) renderMessage(msg);
+            });
+        }
+    };
+
+    const queueIncoming = (data) => {
+        if (inbox.push(data) > 1) return;
+        setTimeout(() => {
+            const frames = inbox;
+            inbox = [];
+            // A failed batch must not stall the ones queued behind it
+            delivering = delivering.then(() => deliverBatch(frames)).catch(e => console.error('Message delivery failed', e));
+        }, 0);
+    };
+
     const connectWS = () => {
         const protocol = location.protocol === 'https:' ? 'wss:' : 'ws:';
         state.ws = new WebSocket(`${protocol}//${location.host}/ws`);
         state.ws.onmessage = async (e) => {
             const data = JSON.parse(e.data);
-            if (data.type === 'message' && state.rooms[data.room]) {
-                const dec = await decryptMessage(data.content, state.rooms[data.room].password, data.room);
-                const msg = { sender: data.sender, content: dec, timestamp: new Date() };
-                state.rooms[data.room].messages.push(msg);
-                if (state.activeRoom === data.room) renderMessage(msg);
-            }
+            if (data.type === 'message' && state.rooms[data.room]) queueIncoming(data);
         };
     };
 
@@ -215,6 +303,7 @@ document.addEventListener('DOMContentLoaded', () => {
         const rid = $('room-id-input').value;
         const pwd = $('room-password-input').value;
         if (rid && pwd) {
+            if (state.rooms[rid] && state.rooms[rid].password !== pwd) forgetRoomKeys(rid);
             state.rooms[rid] = { password: pwd, messages: [] };
             localStorage.setItem('sc_rooms', JSON.stringify(state.rooms));
             switchRoom(rid);
@@ -0,0 +1,34 @@
+import asyncio
+import inspect
+import json
+import pytest
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_pyfunc_call(pyfuncitem):
+    """Run `async def` tests to completion on a fresh event loop, so no asyncio plugin is needed"""
+    if inspect.iscoroutinefunction(pyfuncitem.obj):
+        args = {name: pyfuncitem.funcargs[name] for name in pyfuncitem._fixtureinfo.argnames}
+        asyncio.run(pyfuncitem.obj(**args))
+        return True
+
+class FakeSocket:
+    """Stands in for a Starlette WebSocket: records text frames (decoded), binary frames and the close code"""
+    def __init__(self, stall=False):
+        self.sent = []
+        self.chunks = []
+        self.closed = None
+        self.stall = stall  # Never completes a send, like a peer that stopped reading
+
+    async def send_text(self, frame):
+        if self.stall:
+            await asyncio.Event().wait()
+        self.sent.append(json.loads(frame))
+
+    async def send_json(self, data):
+        self.sent.append(data)
+
+    async def send_bytes(self, frame):
+        self.chunks.append(frame)
+
+    async def close(self, code=1000):
+        self.closed = code
@@ -0,0 +1,50 @@
+import json
+from conftest import FakeSocket
+from server.main import AdmissionController, DimensionRegistry
+
+def test_connection_caps_and_release():
+    adm = AdmissionController(max_connections=3, max_per_ip=2)
+    assert adm.admit("1.1.1.1") is None and adm.admit("1.1.1.1") is None
+    assert adm.admit("1.1.1.1") == "per_ip"
+    assert adm.admit("2.2.2.2") is None
+    assert adm.admit("3.3.3.3") == "capacity"
+    adm.release("1.1.1.1")
+    adm.release("2.2.2.2")
+    assert adm.per_ip == {"1.1.1.1": 1} and adm.connections == 1
+    assert adm.rejected["per_ip"] == adm.rejected["capacity"] == 1
+
+def test_zero_per_ip_cap_is_disabled():
+    adm = AdmissionController(max_connections=3, max_per_ip=0)
+    assert [adm.admit("10.0.0.1") for _ in range(3)] == [None, None, None]
+    assert adm.admit("10.0.0.1") == "capacity"
+
+def test_levels_need_sustained_lag():
+    adm = AdmissionController(thresholds=(0.1, 0.25, 0.5), sustain=3)
+    adm.observe_lag(5.0)
+    adm.observe_lag(0.0)
+    adm.observe_lag(5.0)
+    assert adm.level == AdmissionController.NORMAL  # Isolated stalls change nothing
+    adm.observe_lag(1.0)
+    assert adm.level == AdmissionController.NORMAL
+    adm.observe_lag(0.3)
+    assert adm.level == AdmissionController.NO_NEW_ROOMS  # Lowest of the last three samples
+    for _ in range(3): adm.observe_lag(1.0)
+    assert adm.level == AdmissionController.REJECTING and adm.admit("1.1.1.1") == "overloaded"
+    hint = json.loads(adm.retry_hint("overloaded"))
+    assert hint["type"] == "reconnect" and hint["after_ms"] >= 5000
+    adm.observe_lag(0.0)
+    assert adm.level == AdmissionController.NORMAL  # Recovery is immediate
+
+async def test_pressure_refuses_new_rooms_and_sheds_typing():
+    reg = DimensionRegistry(admission=AdmissionController(thresholds=(0.1, 0.25, 0.5), sustain=1))
+    alice, bob, carol = FakeSocket(), FakeSocket(), FakeSocket()
+    assert await reg.join(alice, "room", "alice", "pw")
+    reg.admission.observe_lag(0.3)
+    assert await reg.join(bob, "room", "bob", "pw")  # Existing rooms still admit members
+    assert not await reg.join(carol, "new", "carol", "pw")
+    assert carol.sent[-1]["type"] == "reconnect" and "new" not in reg.rooms
+    reg.rooms["room"].typing.add("bob")
+    reg.queue_typing("room", "alice", True)
+    reg.queue_typing("room", "bob", False)
+    assert reg.rooms["room"].pending_typing == {"bob": False}
+    await reg.flush_presence()
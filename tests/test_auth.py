@@ -0,0 +1,24 @@
+import asyncio
+import pytest
+from server.main import PasswordHasher, HasherSaturated, hash_password, password_needs_rehash
+
+def test_needs_rehash_when_cost_raised():
+    h = hash_password("StrongPass123", rounds=4)
+    assert password_needs_rehash(h, rounds=5)
+    assert not password_needs_rehash(h, rounds=4)
+    assert not password_needs_rehash("not-a-bcrypt-hash")
+
+async def test_hasher_round_trip_and_fail_fast():
+    hasher = PasswordHasher(workers=1, max_pending=1)
+    try:
+        h = await hasher.hash("StrongPass123")
+        assert await hasher.verify("StrongPass123", h)
+        assert not await hasher.verify("WrongPass123", h)
+        first = asyncio.ensure_future(hasher.hash("StrongPass123"))
+        await asyncio.sleep(0)
+        with pytest.raises(HasherSaturated):
+            await hasher.hash("StrongPass123")
+        await first
+        assert hasher.stats()["rejected"] == 1
+    finally:
+        hasher.close()
@@ -0,0 +1,59 @@
+import asyncio
+from conftest import FakeSocket
+from server.main import DimensionRegistry, MessageBacklog
+
+def fill(backlog, count, size=10):
+    for _ in range(count):
+        seq = backlog.next_seq
+        backlog.append(seq, "x" * size, f"m{seq}")
+
+def test_ring_is_bounded_by_count():
+    backlog = MessageBacklog(capacity=4, max_bytes=1000)
+    fill(backlog, 10)
+    assert (backlog.first_seq, backlog.next_seq) == (7, 11)
+    assert len(backlog.since(0)) == 4 and len(backlog.since(8)) == 2
+    assert backlog.nbytes == 40
+
+def test_ring_is_bounded_by_bytes():
+    backlog = MessageBacklog(capacity=100, max_bytes=35)
+    fill(backlog, 10)
+    assert len(backlog) == 3 and backlog.nbytes == 30
+
+def test_remove_leaves_gap():
+    backlog = MessageBacklog(capacity=4, max_bytes=1000)
+    fill(backlog, 3)
+    assert backlog.remove("m2")
+    assert not backlog.remove("m2")
+    assert len(backlog.since(0)) == 2 and backlog.nbytes == 20
+
+async def test_reconnect_replays_missed_messages():
+    reg = DimensionRegistry()
+    await reg.join(FakeSocket(), "room", "alice", "pw")
+    for i in range(5):
+        await reg.broadcast("room", {"type": "message", "content": str(i)})
+    bob = FakeSocket()
+    await reg.join(bob, "room", "bob", "pw")
+    reg.replay(bob, "room", 3)
+    await asyncio.sleep(0.01)
+    batch = bob.sent[-1]
+    assert batch["type"] == "backlog"
+    assert [m["seq"] for m in batch["messages"]] == [4, 5]
+    assert [m["content"] for m in batch["messages"]] == ["3", "4"]
+
+async def test_replay_shows_edits_and_reactions():
+    reg = DimensionRegistry()
+    alice = FakeSocket()
+    await reg.join(alice, "room", "alice", "pw")
+    await reg.broadcast("room", {"type": "message", "id": "m1", "content": "draft"})
+    await reg.broadcast("room", {"type": "edit_msg", "id": "m1", "content": "final"})
+    await reg.broadcast("room", {"type": "reaction", "id": "r1", "content": "+1", "reply_to": "m1"})
+    reg.replay(alice, "room", 0)
+    await asyncio.sleep(0.01)
+    messages = alice.sent[-1]["messages"]
+    assert [(m["type"], m["seq"], m["content"]) for m in messages] == [("message", 1, "final"), ("reaction", 2, "+1")]
+
+def test_skip_far_ahead_jumps():
+    backlog = MessageBacklog(capacity=4, max_bytes=1000)
+    fill(backlog, 2)
+    backlog.skip_to(1000)
+    assert (backlog.first_seq, backlog.next_seq, len(backlog)) == (1000, 1000, 0)
@@ -0,0 +1,174 @@
+import asyncio
+import json
+import os
+from conftest import FakeSocket
+import server.main as main
+from server.main import DimensionRegistry, InProcessBackplane, SQLiteBackplane
+
+async def settle(seconds=0.05):
+    await asyncio.sleep(seconds)
+
+async def test_room_spans_workers():
+    hub = []
+    a, b = DimensionRegistry(InProcessBackplane(hub)), DimensionRegistry(InProcessBackplane(hub))
+    await a.backplane.start(a.handle_remote)
+    await b.backplane.start(b.handle_remote)
+    alice, bob = FakeSocket(), FakeSocket()
+    assert await a.join(alice, "room", "alice", "pw")
+    await settle()
+    assert not await b.join(FakeSocket(), "room", "eve", "wrong")
+    assert await b.join(bob, "room", "bob", "pw")
+    await settle()
+    await a.flush_presence()
+    await settle()
+    frames = [e for f in alice.sent for e in f.get("events", [f])]  # Batched or not, depending on the tick
+    assert frames[-1] == {"type": "presence", "v": 2, "op": "joined", "user": "bob"}
+    assert sorted(bob.sent[0]["users"]) == ["alice", "bob"]
+
+    await a.broadcast("room", {"type": "message", "content": "hi"})
+    await settle()
+    assert [f for f in bob.sent if f["type"] == "message"][-1]["content"] == "hi"
+
+    await a.set_locked("room", True)
+    await settle()
+    assert b.rooms["room"].locked
+
+    await a.leave(alice, "room")
+    await settle()
+    assert b.rooms["room"].members() == ["bob"]
+    assert b.rooms["room"].admin == "bob"
+    await a.backplane.stop()
+    await b.backplane.stop()
+
+async def test_sqlite_backplane_preserves_order(tmp_path):
+    received = []
+
+    async def handler(origin, rid, event):
+        received.append((rid, event["n"]))
+
+    path = str(tmp_path / "bp.db")
+    sender, receiver = SQLiteBackplane(path, poll_interval=0.005), SQLiteBackplane(path, poll_interval=0.005)
+    await sender.start(handler)
+    await receiver.start(handler)
+    for n in range(50):
+        sender.publish("room-%d" % (n % 3), {"n": n})
+    for _ in range(100):
+        if len(received) == 50: break
+        await settle(0.01)
+    assert [n for _, n in received] == list(range(50))
+    await sender.stop()
+    await receiver.stop()
+
+async def test_late_worker_learns_existing_rooms():
+    hub = []
+    a, b = DimensionRegistry(InProcessBackplane(hub)), DimensionRegistry(InProcessBackplane(hub))
+    await a.start_backplane()
+    alice = FakeSocket()
+    assert await a.join(alice, "room", "alice", "pw")
+    await b.start_backplane()  # Started after the room exists
+    await settle()
+    eve, bob = FakeSocket(), FakeSocket()
+    assert not await b.join(eve, "room", "eve", "WRONG")
+    assert eve.sent[-1]["message"] == "Incorrect Seal"
+    assert await b.join(bob, "room", "bob", "pw")
+    await settle()
+    assert sorted(bob.sent[0]["users"]) == ["alice", "bob"]
+    assert b.rooms["room"].admin == "alice"
+    await a.backplane.stop()
+    await b.backplane.stop()
+
+async def test_relayed_join_with_wrong_seal_is_rejected():
+    hub = []
+    a, b = DimensionRegistry(InProcessBackplane(hub)), DimensionRegistry(InProcessBackplane(hub))
+    await a.start_backplane()
+    assert await a.join(FakeSocket(), "room", "alice", "pw")
+    await b.backplane.start(b.handle_remote)  # Missed the sync: b takes eve's seal for the room's
+    eve = FakeSocket()
+    assert await b.join(eve, "room", "eve", "WRONG")
+    await settle()
+    assert a.rooms["room"].members() == ["alice"]
+    assert eve.closed == 1008 and eve.sent[-1]["message"] == "Incorrect Seal"
+    assert "room" not in b.rooms
+    await a.broadcast("room", {"type": "message", "content": "secret"})
+    await settle()
+    assert all(frame.get("content") != "secret" for frame in eve.sent)
+    await a.backplane.stop()
+    await b.backplane.stop()
+
+async def test_workers_agree_on_message_seqs():
+    hub = []
+    a, b = DimensionRegistry(InProcessBackplane(hub)), DimensionRegistry(InProcessBackplane(hub))
+    await a.start_backplane()
+    await b.start_backplane()
+    alice, bob = FakeSocket(), FakeSocket()
+    assert await a.join(alice, "room", "alice", "pw")
+    for i in range(5):  # Numbered while alice is the only member anywhere
+        await a.broadcast("room", {"type": "message", "id": f"a{i}", "content": str(i)})
+    await settle()
+    assert await b.join(bob, "room", "bob", "pw")
+    await settle()
+    await b.broadcast("room", {"type": "message", "id": "b0", "content": "from b"})
+    await settle()
+    seqs = lambda reg: [(m["id"], m["seq"]) for m in map(json.loads, reg.rooms["room"].backlog.since(0))]
+    assert seqs(a) == seqs(b) and seqs(b)[-1] == ("b0", 6)
+
+    # Resuming on the other worker replays the same frames
+    carol = FakeSocket()
+    assert await b.join(carol, "room", "carol", "pw")
+    b.replay(carol, "room", 4)
+    await settle()
+    backlogs = lambda ws: [f for f in ws.sent if f["type"] == "backlog"]
+    assert [m["id"] for m in backlogs(carol)[-1]["messages"]] == ["a4", "b0"]
+
+    # Concurrent sends collide on a seq: older cursors are answered with the whole backlog
+    await a.broadcast("room", {"type": "message", "id": "x", "content": "x"})
+    await b.broadcast("room", {"type": "message", "id": "y", "content": "y"})
+    await settle()
+    assert b.rooms["room"].diverged_upto == 8
+    b.replay(carol, "room", 6)
+    await settle()
+    assert backlogs(carol)[-1]["reset"] and backlogs(carol)[-1]["messages"][0]["id"] == "a0"
+    await a.backplane.stop()
+    await b.backplane.stop()
+
+async def test_members_of_a_silent_worker_expire():
+    hub = []
+    a, b = DimensionRegistry(InProcessBackplane(hub)), DimensionRegistry(InProcessBackplane(hub))
+    await a.start_backplane()
+    await b.start_backplane()
+    alice = FakeSocket()
+    assert await a.join(alice, "room", "alice", "pw")
+    assert await b.join(FakeSocket(), "room", "bob", "pw")
+    await settle()
+    await b.backplane.stop()  # Killed: no node_down is ever sent
+    await a.heartbeat()
+    assert a.rooms["room"].members() == ["alice", "bob"]
+    a.nodes[b.backplane.node_id] -= main.BACKPLANE_NODE_TIMEOUT + 1
+    await a.heartbeat()
+    assert a.rooms["room"].members() == ["alice"] and not a.nodes
+    assert await a.join(FakeSocket(), "room", "bob", "pw")  # The handle is free again
+    await a.backplane.stop()
+
+async def test_sqlite_backplane_file_is_owner_only(tmp_path):
+    path = str(tmp_path / "bp.db")
+    backplane = SQLiteBackplane(path)
+    await backplane.start(lambda *args: None)
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    await backplane.stop()
+
+async def test_admin_kicks_a_member_held_by_another_worker():
+    hub = []
+    a, b = DimensionRegistry(InProcessBackplane(hub)), DimensionRegistry(InProcessBackplane(hub))
+    await a.start_backplane()
+    await b.start_backplane()
+    alice, bob = FakeSocket(), FakeSocket()
+    assert await a.join(alice, "room", "alice", "pw")
+    await settle()
+    assert await b.join(bob, "room", "bob", "pw")
+    await settle()
+    await a.kick("room", "bob")
+    await settle()
+    assert bob.closed == 1008 and bob.sent[-1] == {"type": "kicked", "target": "bob"}
+    assert a.rooms["room"].members() == ["alice"] and "bob" not in b.rooms["room"].sockets
+    await a.backplane.stop()
+    await b.backplane.stop()
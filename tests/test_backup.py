@@ -0,0 +1,44 @@
+import fcntl
+import glob
+import gzip
+import os
+import sqlite3
+from server.main import backup_if_due, connect_db, prune_backups, snapshot_database
+
+def test_snapshot_includes_uncheckpointed_wal_pages(tmp_path):
+    db_path = str(tmp_path / "live.db")
+    live = connect_db(db_path)
+    live.execute("PRAGMA wal_autocheckpoint=0")
+    live.execute("CREATE TABLE users (id INTEGER PRIMARY KEY, username TEXT)")
+    live.executemany("INSERT INTO users (username) VALUES (?)", [(f"user{i}",) for i in range(500)])
+    live.commit()
+    assert os.path.getsize(db_path + "-wal") > 0
+
+    path, size = snapshot_database(db_path, str(tmp_path / "backups"), pages=2, sleep=0)
+    assert path.endswith(".db.gz") and size == os.path.getsize(path)
+    restored = tmp_path / "restored.db"
+    restored.write_bytes(gzip.decompress(open(path, "rb").read()))
+    copy = sqlite3.connect(restored)
+    assert copy.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 500
+    assert copy.execute("PRAGMA journal_mode").fetchone()[0] == "delete"
+    copy.close()
+    live.close()
+
+def test_prune_keeps_newest(tmp_path):
+    for day in range(1, 6):
+        (tmp_path / f"database_backup_2026010{day}_000000.db.gz").write_bytes(b"x")
+    removed = prune_backups(str(tmp_path), keep=2)
+    assert len(removed) == 3
+    assert sorted(os.listdir(tmp_path)) == ["database_backup_20260104_000000.db.gz", "database_backup_20260105_000000.db.gz"]
+
+def test_one_worker_backs_up_per_round(tmp_path):
+    db_path = str(tmp_path / "live.db")
+    connect_db(db_path).close()
+    dest = str(tmp_path / "backups")
+    os.makedirs(dest)
+    with open(os.path.join(dest, ".lock"), "w") as held:
+        fcntl.flock(held, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        assert backup_if_due(db_path, dest, interval=60) is None  # Another worker is backing up
+    assert backup_if_due(db_path, dest, interval=60)
+    assert backup_if_due(db_path, dest, interval=60) is None  # Already done this round
+    assert len(glob.glob(os.path.join(dest, "database_backup_*"))) == 1
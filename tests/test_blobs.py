@@ -0,0 +1,77 @@
+import os
+import time
+from server.main import BlobStore
+
+async def chunks(*parts):
+    for part in parts:
+        yield part
+
+async def test_identical_uploads_are_stored_once(tmp_path):
+    store = BlobStore(str(tmp_path))
+    a = await store.put(chunks(b"cipher", b"text"))
+    b = await store.put(chunks(b"ciphertext"))
+    assert a == b and a[1] == 10
+    files = [f for _, _, fs in os.walk(tmp_path / a[0][:2]) for f in fs]
+    assert files == [a[0]]
+    assert not os.listdir(tmp_path / "tmp")
+
+async def test_oversized_upload_is_rejected(tmp_path):
+    store = BlobStore(str(tmp_path), max_bytes=4)
+    try:
+        await store.put(chunks(b"abc", b"def"))
+        assert False, "expected ValueError"
+    except ValueError:
+        pass
+    assert not os.listdir(tmp_path / "tmp")
+
+async def test_blob_deleted_when_last_reference_released(tmp_path):
+    store = BlobStore(str(tmp_path))
+    digest, _ = await store.put(chunks(b"payload"))
+    store.ref(digest, "room", "m1")
+    store.ref(digest, "room", "m2")
+    store.release_message("room", "m1")
+    assert store.exists(digest)
+    store.release_room("room")
+    assert not store.exists(digest)
+
+async def test_sweep_removes_only_stale_orphans(tmp_path):
+    store = BlobStore(str(tmp_path), grace=60)
+    kept, _ = await store.put(chunks(b"referenced"))
+    orphan, _ = await store.put(chunks(b"orphan"))
+    fresh, _ = await store.put(chunks(b"fresh"))
+    store.ref(kept, "room", "m1")
+    old = time.time() - 120
+    for digest in (kept, orphan):
+        os.utime(store.path(digest), (old, old))
+    assert store.sweep() == 1
+    assert store.exists(kept) and store.exists(fresh) and not store.exists(orphan)
+
+async def test_references_are_shared_between_workers(tmp_path):
+    uploader, other = BlobStore(str(tmp_path), grace=60), BlobStore(str(tmp_path), grace=60)
+    digest, _ = await uploader.put(chunks(b"attachment"))
+    uploader.ref(digest, "room", "m1")
+    other.ref(digest, "other-room", "m2")
+    old = time.time() - 120
+    os.utime(uploader.path(digest), (old, old))
+    assert other.sweep() == 0  # Held by the uploader, not by this worker
+    uploader.release_room("room")
+    assert uploader.exists(digest)  # Still referenced from the other worker
+    other.release_message("other-room", "m2")
+    assert not uploader.exists(digest)
+    assert os.listdir(tmp_path / "refs") == [".owners"]
+
+async def test_references_of_a_dead_worker_are_reaped(tmp_path):
+    crashed, survivor = BlobStore(str(tmp_path), grace=60), BlobStore(str(tmp_path), grace=60)
+    kept, _ = await crashed.put(chunks(b"kept"))
+    dropped, _ = await crashed.put(chunks(b"self-destructing"))
+    crashed.ref(kept, "room", "m1")
+    crashed.ref(dropped, "room", "m2")
+    survivor.ref(kept, "room", "m1")  # Restored after the restart under the new worker
+    old = time.time() - 120
+    for digest in (kept, dropped):
+        os.utime(crashed.path(digest), (old, old))
+    assert survivor.sweep() == 0  # Its owner is still alive
+    crashed._owner_lock.close()  # The process died without releasing anything
+    assert survivor.sweep() == 1
+    assert survivor.exists(kept) and not survivor.exists(dropped)
+    assert os.listdir(tmp_path / "refs" / ".owners") == [survivor.owner]
@@ -0,0 +1,35 @@
+import asyncio
+import sqlite3
+import pytest
+from server.main import Database, connect_db
+
+@pytest.fixture
+def database(tmp_path):
+    path = str(tmp_path / "test.db")
+    with connect_db(path) as db:
+        db.execute("CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT UNIQUE)")
+    database = Database(path, readers=2)
+    yield database
+    database.close()
+
+async def test_concurrent_writes_are_group_committed(database):
+    counts = await asyncio.gather(*[
+        database.execute("INSERT INTO users (username) VALUES (?)", (f"user{i}",)) for i in range(50)])
+    assert counts == [1] * 50
+    rows = await database.fetchall("SELECT username FROM users ORDER BY id")
+    assert len(rows) == 50
+
+async def test_failing_unit_does_not_roll_back_neighbours(database):
+    results = await asyncio.gather(
+        database.execute("INSERT INTO users (username) VALUES (?)", ("alice",)),
+        database.transaction([("INSERT INTO users (username) VALUES (?)", ("bob",)),
+                              ("INSERT INTO users (username) VALUES (?)", ("alice",))]),
+        database.execute("INSERT INTO users (username) VALUES (?)", ("carol",)),
+        return_exceptions=True)
+    assert isinstance(results[1], sqlite3.IntegrityError)
+    rows = await database.fetchall("SELECT username FROM users ORDER BY id")
+    assert [r["username"] for r in rows] == ["alice", "carol"]
+
+async def test_reader_connections_are_read_only(database):
+    with pytest.raises(sqlite3.OperationalError):
+        await database.fetchone("DELETE FROM users")
@@ -0,0 +1,29 @@
+from server.dispatcher import HashRing, route_key
+
+ROOMS = [f"room-{i}" for i in range(2000)]
+
+def test_ring_is_sticky():
+    ring = HashRing(["w0", "w1", "w2"])
+    assert all(ring.get(r) == HashRing(["w2", "w0", "w1"]).get(r) for r in ROOMS[:50])
+
+def test_removing_a_worker_only_moves_its_rooms():
+    ring = HashRing(["w0", "w1", "w2", "w3"])
+    before = {r: ring.get(r) for r in ROOMS}
+    ring.remove("w2")
+    moved = [r for r in ROOMS if ring.get(r) != before[r]]
+    assert moved and all(before[r] == "w2" for r in moved)
+
+def test_adding_a_worker_moves_about_its_share():
+    ring = HashRing(["w0", "w1", "w2", "w3"])
+    before = {r: ring.get(r) for r in ROOMS}
+    ring.add("w4")
+    moved = [r for r in ROOMS if ring.get(r) != before[r]]
+    assert all(ring.get(r) == "w4" for r in moved)
+    assert 0.1 < len(moved) / len(ROOMS) < 0.3
+
+def test_route_key():
+    assert route_key("/ws/secret-room/alice?pwd=x&token=y") == "secret-room"
+    assert route_key("/api/ws-token?rid=secret-room") == "secret-room"
+    assert route_key("/api/rooms/secret-room/members?after=bob") == "secret-room"
+    assert route_key("/api/login") is None
+    assert route_key("/static/script.js") is None
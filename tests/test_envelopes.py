@@ -0,0 +1,69 @@
+import asyncio
+import json
+import pytest
+from conftest import FakeSocket
+import server.main as main
+from server.main import (AttachmentEnvelope, ChatEnvelope, EnvelopeError, TypingEnvelope, decode_envelope,
+                         frame_too_large)
+
+def test_unknown_fields_are_dropped():
+    env = decode_envelope(json.dumps({"type": "message", "content": "ct", "room": "r", "sender": "x", "junk": [1] * 100}))
+    assert isinstance(env, ChatEnvelope) and not hasattr(env, "__dict__")
+    assert env.to_dict() == {"type": "message", "content": "ct"}
+
+def test_web_client_ciphertext_pair_is_accepted():
+    env = decode_envelope(json.dumps({"type": "message", "room": "r", "sender": "alice",
+                                      "content": {"iv": "aXY=", "data": "Y3Q=", "extra": "x"}}))
+    assert env.to_dict() == {"type": "message", "content": {"iv": "aXY=", "data": "Y3Q="}}
+
+def test_attachment_keeps_only_transfer_id_and_size():
+    env = decode_envelope(json.dumps({"type": "image", "content": "", "transfer": {"id": "ab", "size": 5, "x": 1},
+                                      "reply_to": "m1", "self_destruct": 30}))
+    assert isinstance(env, AttachmentEnvelope)
+    assert env.to_dict() == {"type": "image", "content": "", "reply_to": "m1", "self_destruct": 30,
+                             "transfer": {"id": "ab", "size": 5}}
+
+def test_kinds_are_typed():
+    assert decode_envelope('{"type":"typing","status":1}').status is True
+    assert isinstance(decode_envelope('{"type":"typing"}'), TypingEnvelope)
+    assert decode_envelope('{"type":"presence_sync","v":true}').v is None
+    assert decode_envelope('{"type":"something_new"}') is None
+    for bad in ('{"type":"message","content":{"a":1}}', '{"type":"message","content":{"iv":"x","data":3}}',
+                '{"type":[]}', '{"type":{"a":1}}', '{"type":"kick"}', '{"type":"message","content":"x","self_destruct":"1"}',
+                '[1,2]', '{"type":', '{"type":"file","content":"x","blob":7}'):
+        with pytest.raises(EnvelopeError):
+            decode_envelope(bad)
+
+def test_size_cap_counts_utf8_bytes_before_parsing():
+    assert not frame_too_large("a" * 100, limit=100)
+    assert frame_too_large("é" * 60, limit=100)  # 60 characters, 120 bytes
+    with pytest.raises(EnvelopeError, match="too large"):
+        decode_envelope('{"type":"message","content":"' + "x" * (1024 * 1024) + '"}')
+
+async def test_repeated_bad_frames_close_the_socket():
+    class Peer(FakeSocket):
+        def __init__(self, frames):
+            super().__init__()
+            self.frames = iter(frames)
+
+        async def receive(self):
+            await asyncio.sleep(0)
+            return next(self.frames, {"type": "websocket.disconnect"})
+
+    async def serve(frames):
+        ws = Peer(frames)
+        token = await main.registry.tokens.issue(1, "mallory")
+        await main.serve_socket(ws, "bad-frames", "mallory", "", token, None, False)
+        await asyncio.sleep(0.05)
+        return ws
+
+    malformed = await serve([{"type": "websocket.receive", "text": "{"}] * main.ENVELOPE_ERROR_LIMIT)
+    assert malformed.closed == 1007
+    assert "bad-frames" not in main.registry.rooms
+    oversized = "x" * (main.WS_MAX_FRAME_BYTES + 1)
+    assert (await serve([{"type": "websocket.receive", "text": oversized}] * main.ENVELOPE_ERROR_LIMIT)).closed == 1009
+    # Below the limit the peer is told what was wrong with each frame
+    survivor = await serve([{"type": "websocket.receive", "text": "{"}] * (main.ENVELOPE_ERROR_LIMIT - 1))
+    assert survivor.closed is None
+    assert [f["message"] for f in survivor.sent if f["type"] == "error"] == ["Malformed frame"] * (main.ENVELOPE_ERROR_LIMIT - 1)
+
@@ -0,0 +1,31 @@
+import asyncio
+from conftest import FakeSocket
+import server.main as main
+from server.main import DimensionRegistry
+
+async def test_quiet_sockets_are_pinged_then_reaped():
+    reg = DimensionRegistry()
+    alive, dead = FakeSocket(), FakeSocket()
+    await reg.join(alive, "room", "alice", "pw")
+    await reg.join(dead, "room", "bob", "pw")
+    start = reg.rooms["room"].states[alive].last_seen
+    await reg.heartbeat(start + main.HEARTBEAT_INTERVAL + 1)
+    await asyncio.sleep(0.01)
+    assert dead.sent[-1] == {"type": "ping"}
+    reg.rooms["room"].states[alive].last_seen = start + main.HEARTBEAT_TIMEOUT  # Answered with a pong
+    await reg.heartbeat(start + main.HEARTBEAT_TIMEOUT + 1)
+    await asyncio.sleep(0.01)
+    assert reg.rooms["room"].members() == ["alice"]
+    assert dead.closed == 1001 and reg.reaped == {"timeout": 1, "idle": 0}
+    assert dead not in reg.rooms["room"].states
+
+async def test_idle_sockets_are_reaped(monkeypatch):
+    monkeypatch.setattr(main, "IDLE_TIMEOUT", 100)
+
+    reg = DimensionRegistry()
+    ws = FakeSocket()
+    await reg.join(ws, "room", "alice", "pw")
+    state = reg.rooms["room"].states[ws]
+    state.last_seen = state.last_active + 101  # Still answering pings, but nothing else
+    await reg.heartbeat(state.last_active + 101)
+    assert "room" not in reg.rooms and reg.reaped["idle"] == 1
@@ -0,0 +1,51 @@
+import asyncio
+from conftest import FakeSocket
+import server.main as main
+from server.main import DimensionRegistry
+
+async def test_large_room_exceeds_participant_cap_with_sharded_fanout():
+    reg = DimensionRegistry()
+    sockets = [FakeSocket() for _ in range(120)]
+    for i, ws in enumerate(sockets):
+        assert await reg.join(ws, "big", f"user{i:03}", "pw", large=True)
+    room = reg.rooms["big"]
+    assert len(room.shards) == main.LARGE_ROOM_SHARDS
+    assert sum(len(shard.writers) for shard in room.shards) == 120
+    await reg.broadcast("big", {"type": "message", "content": "hi"})
+    await asyncio.sleep(0.05)
+    assert all(ws.sent[-1]["content"] == "hi" for ws in sockets)
+
+async def test_snapshot_is_paged_and_presence_collapses_to_counts():
+    reg = DimensionRegistry()
+    sockets = [FakeSocket() for _ in range(150)]
+    for i, ws in enumerate(sockets):
+        await reg.join(ws, "big", f"user{i:03}", "pw", large=True)
+    await reg.flush_presence()
+    await asyncio.sleep(0.05)
+    snapshot = sockets[-1].sent[0]
+    assert snapshot["total"] == 150 and len(snapshot["users"]) == main.LARGE_ROOM_SNAPSHOT
+    assert sockets[0].sent[-1] == {"type": "presence", "v": 1, "op": "count", "total": 150}
+
+    page = reg.members_page("big", limit=100)
+    assert page["next"] == "user099" and len(page["members"]) == 100
+    page = reg.members_page("big", page["next"], limit=100)
+    assert page["members"][0] == "user100" and page["next"] is None
+
+async def test_admission_is_capped_by_memory_budget(monkeypatch):
+    monkeypatch.setattr(main, "LARGE_ROOM_MEMORY_BUDGET", 3 * main.LARGE_ROOM_CONN_BYTES + 4096)
+
+    reg = DimensionRegistry()
+    results = [await reg.join(FakeSocket(), "big", f"user{i}", "pw", large=True) for i in range(5)]
+    assert results == [True, True, True, False, False]
+
+async def test_typing_is_sampled_in_crowded_rooms(monkeypatch):
+    monkeypatch.setattr(main, "LARGE_ROOM_TYPING_THRESHOLD", 10)
+
+    reg = DimensionRegistry()
+    sockets = [FakeSocket() for _ in range(20)]
+    for i, ws in enumerate(sockets):
+        await reg.join(ws, "big", f"user{i:02}", "pw", large=True)
+    for i in range(20):
+        reg.queue_typing("big", f"user{i:02}", True)
+    await reg.flush_presence()
+    assert len(reg.rooms["big"].typing) == main.LARGE_ROOM_MAX_TYPERS
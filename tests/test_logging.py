@@ -0,0 +1,40 @@
+import json
+import logging
+import queue
+from server.main import LogFormatter, LogThrottle, ThreadQueueHandler, parse_log_rate, parse_log_rules
+
+def record(name="GhostOracle.auth", level=logging.WARNING, created=0.0, msg="Failed login attempt for: %s", args=("bob",)):
+    rec = logging.LogRecord(name, level, __file__, 1, msg, args, None)
+    rec.created = created
+    return rec
+
+def test_rate_limit_reports_suppressed_count_in_next_window():
+    throttle = LogThrottle(parse_log_rules("auth=2/60", parse_log_rate), {})
+    passed = [throttle.filter(record(created=t)) for t in range(5)]
+    assert passed == [True, True, False, False, False]
+    assert throttle.filter(record(level=logging.ERROR, created=5))  # Errors are never throttled
+    assert throttle.filter(record(name="GhostOracle", created=6))  # Other categories are untouched
+    later = record(created=61)
+    assert throttle.filter(later) and later.suppressed == 3
+    assert throttle.suppressed == 3
+
+def test_sampling_keeps_a_fraction():
+    throttle = LogThrottle({}, parse_log_rules("access=0", float))
+    assert not throttle.filter(record(name="GhostOracle.access", level=logging.INFO))
+    assert throttle.sampled_out == 1
+
+def test_queue_handler_defers_formatting_and_drops_when_full():
+    handler = ThreadQueueHandler(queue.Queue(1))
+    first = record()
+    handler.handle(first)
+    handler.handle(record())
+    queued = handler.queue.get_nowait()
+    assert queued is first and queued.args == ("bob",) and not hasattr(queued, "message")
+    assert handler.dropped == 1
+
+def test_json_lines():
+    rec = record()
+    rec.suppressed = 4
+    entry = json.loads(LogFormatter(structured=True).format(rec))
+    assert entry["msg"] == "Failed login attempt for: bob" and entry["suppressed"] == 4
+    assert LogFormatter().format(rec).endswith("Failed login attempt for: bob (4 similar suppressed)")
@@ -0,0 +1,37 @@
+from conftest import FakeSocket
+import server.main as main
+from server.main import DimensionRegistry, Histogram, Metrics, statement_label
+
+def test_histogram_buckets_are_cumulative_in_exposition():
+    metrics = Metrics()
+    h = metrics.histogram("demo_seconds", "Demo", (0.1, 1.0), label="op")
+    for value in (0.05, 0.5, 0.5, 3.0):
+        h.labels("hash").observe(value)
+    text = metrics.render()
+    assert 'demo_seconds_bucket{op="hash",le="0.1"} 1' in text
+    assert 'demo_seconds_bucket{op="hash",le="1.0"} 3' in text
+    assert 'demo_seconds_bucket{op="hash",le="+Inf"} 4' in text
+    assert 'demo_seconds_count{op="hash"} 4' in text
+
+def test_observe_reuses_preallocated_slots():
+    h = Histogram((1, 2))
+    counts = h.counts
+    for value in (0, 1, 2, 5):
+        h.observe(value)
+    assert h.counts is counts and h.counts == [2, 1, 1]
+
+def test_statement_labels_have_low_cardinality():
+    assert statement_label("SELECT id, password FROM users WHERE username = ?") == "SELECT users"
+    assert statement_label("INSERT OR IGNORE INTO history (user_id, room_id) VALUES (?, ?)") == "INSERT history"
+    assert statement_label("UPDATE users SET password = ? WHERE id = ?") == "UPDATE users"
+
+async def test_registry_gauges_and_fanout_histogram(monkeypatch):
+    reg = DimensionRegistry()
+    monkeypatch.setattr(main, "registry", reg)
+    before = main.FANOUT_SECONDS.count
+    await reg.join(FakeSocket(), "room", "alice", "pw")
+    await reg.broadcast("room", {"type": "message", "content": "hi"})
+    text = main.metrics.render()
+    assert "securechat_rooms 1" in text and "securechat_connections 1" in text
+    assert 'securechat_throttled_total{kind="chat"} 0' in text
+    assert main.FANOUT_SECONDS.count > before
@@ -0,0 +1,83 @@
+import asyncio
+from conftest import FakeSocket
+from server.main import DimensionRegistry
+
+def events(ws):
+    for frame in ws.sent:
+        yield from frame["events"] if frame["type"] == "batch" else [frame]
+
+def presence(ws):
+    return [(f["v"], f["op"]) for f in events(ws) if f["type"] == "presence"]
+
+async def test_join_sends_snapshot_to_newcomer_and_delta_to_others():
+    reg = DimensionRegistry()
+    alice, bob = FakeSocket(), FakeSocket()
+    await reg.join(alice, "room", "alice", "pw")
+    await reg.join(bob, "room", "bob", "pw")
+    await reg.flush_presence()
+    await asyncio.sleep(0.01)
+    assert bob.sent[0] == {"type": "user_list", "v": 2, "users": ["alice", "bob"], "admin": "alice", "is_locked": False}
+    assert not any(f["type"] == "user_list" for f in alice.sent[1:])
+    assert presence(alice) == [(1, "joined"), (2, "joined")]
+    assert alice.sent[-1]["type"] == "batch"
+    assert not await reg.join(FakeSocket(), "room", "bob", "pw")
+
+async def test_leave_and_lock_emit_versioned_deltas():
+    reg = DimensionRegistry()
+    alice, bob = FakeSocket(), FakeSocket()
+    await reg.join(alice, "room", "alice", "pw")
+    await reg.join(bob, "room", "bob", "pw")
+    await reg.set_locked("room", True)
+    await reg.set_locked("room", True)  # No change, no delta
+    await reg.leave(alice, "room")
+    await reg.flush_presence()
+    await asyncio.sleep(0.01)
+    assert presence(bob) == [(1, "joined"), (2, "joined"), (3, "lock_changed"), (4, "left"), (5, "admin_changed")]
+    assert reg.rooms["room"].admin == "bob"
+
+async def test_presence_sync_only_resends_on_version_mismatch():
+    reg = DimensionRegistry()
+    alice = FakeSocket()
+    await reg.join(alice, "room", "alice", "pw")
+    reg.send_snapshot(alice, "room", 1)
+    reg.send_snapshot(alice, "room", 0)
+    await asyncio.sleep(0.01)
+    assert [f["type"] for f in alice.sent].count("user_list") == 2
+
+async def test_kick_ejects_only_the_target():
+    reg = DimensionRegistry()
+    alice, bob = FakeSocket(), FakeSocket()
+    await reg.join(alice, "room", "alice", "pw")
+    await reg.join(bob, "room", "bob", "pw")
+    await reg.kick("room", "bob")
+    await reg.flush_presence()
+    await asyncio.sleep(0.01)
+    assert bob.sent[-1] == {"type": "kicked", "target": "bob"} and bob.closed == 1008
+    assert not any(f["type"] == "kicked" for f in alice.sent)
+    assert reg.rooms["room"].members() == ["alice"]
+    assert "bob" not in reg.rooms["room"].sockets
+
+async def test_typing_is_debounced_into_one_frame_per_tick():
+    reg = DimensionRegistry()
+    sockets = [FakeSocket() for _ in range(3)]
+    for i, ws in enumerate(sockets):
+        await reg.join(ws, "room", f"user{i}", "pw")
+    await reg.flush_presence()
+    await asyncio.sleep(0.01)
+    before = [len(ws.sent) for ws in sockets]
+    for _ in range(10):
+        for i in range(3):
+            reg.queue_typing("room", f"user{i}", True)
+    reg.queue_typing("room", "user2", False)  # Started and stopped within the tick
+    await reg.flush_presence()
+    await asyncio.sleep(0.01)
+    assert [len(ws.sent) for ws in sockets] == [n + 1 for n in before]
+    assert sockets[2].sent[-1] == {"type": "batch", "events": [
+        {"type": "typing", "username": "user0", "status": True},
+        {"type": "typing", "username": "user1", "status": True}]}
+    # Typists are not told about their own typing
+    assert sockets[0].sent[-1] == {"type": "typing", "username": "user1", "status": True}
+    reg.queue_typing("room", "user0", True)  # Unchanged state is not resent
+    await reg.flush_presence()
+    await asyncio.sleep(0.01)
+    assert len(sockets[0].sent) == before[0] + 1
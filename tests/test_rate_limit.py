@@ -0,0 +1,21 @@
+from conftest import FakeSocket
+from server.main import DimensionRegistry, TokenBucket, parse_budget
+
+def test_bucket_refills_over_time():
+    bucket = TokenBucket(*parse_budget("2/10"))
+    now = bucket.stamp
+    assert bucket.take(now) and bucket.take(now)
+    assert not bucket.take(now)
+    assert bucket.take(now + 5)
+
+async def test_budgets_are_separate_and_released_on_leave():
+    reg = DimensionRegistry()
+    ws = FakeSocket()
+    await reg.join(ws, "room", "alice", "pw")
+    assert all([await reg.check_rate_limit(ws, "room", "media") for _ in range(5)])
+    assert not await reg.check_rate_limit(ws, "room", "media")
+    assert await reg.check_rate_limit(ws, "room", "chat")
+    assert reg.throttled["media"] == 1
+    await reg.join(FakeSocket(), "room", "bob", "pw")
+    await reg.leave(ws, "room")
+    assert ws not in reg.rooms["room"].states
@@ -0,0 +1,51 @@
+import asyncio
+import server.main as main
+from conftest import FakeSocket
+from server.main import DimensionRegistry, ConnectionWriter
+
+async def test_stalled_receiver_does_not_block_broadcast():
+    reg = DimensionRegistry()
+    fast, slow = FakeSocket(), FakeSocket(stall=True)
+    assert await reg.join(fast, "room", "alice", "pw")
+    assert await reg.join(slow, "room", "bob", "pw")
+    await asyncio.wait_for(reg.broadcast("room", {"type": "message", "content": "hi"}), 0.5)
+    await asyncio.sleep(0.01)
+    assert fast.sent[-1]["content"] == "hi"
+
+async def test_overflow_sheds_typing_then_disconnects():
+    writer = ConnectionWriter(FakeSocket(stall=True), max_queue=2)
+    await asyncio.sleep(0)  # Let the writer task start waiting
+    assert writer.enqueue('{"type":"message"}')
+    assert writer.enqueue('{"type":"typing"}', droppable=True)
+    assert writer.enqueue('{"type":"message"}')
+    assert writer.enqueue('{"type":"typing"}', droppable=True)  # Shed on arrival
+    assert writer.dropped == 2
+    assert not writer.enqueue('{"type":"message"}')
+    assert writer.dead
+    writer.close()
+
+async def test_slow_consumer_is_evicted_from_room():
+    reg = DimensionRegistry()
+    fast, slow = FakeSocket(), FakeSocket(stall=True)
+    await reg.join(fast, "room", "alice", "pw")
+    await reg.join(slow, "room", "bob", "pw")
+    reg.rooms["room"].writers[slow].max_queue = 1
+    for i in range(5):
+        await reg.broadcast("room", {"type": "message", "content": str(i)})
+    await asyncio.sleep(0.01)
+    assert list(reg.rooms["room"].connections.values()) == ["alice"]
+    assert slow.closed == 1013
+
+async def test_broadcast_encodes_once_per_frame(monkeypatch):
+    calls = []
+    real = main.codec.dumps
+    monkeypatch.setattr(main.codec, "dumps", lambda obj: calls.append(obj) or real(obj))
+    reg = DimensionRegistry()
+    sockets = [FakeSocket() for _ in range(10)]
+    for i, ws in enumerate(sockets):
+        await reg.join(ws, "room", f"user{i}", "pw")
+    calls.clear()
+    await reg.broadcast("room", {"type": "message", "content": "x" * 1000})
+    await asyncio.sleep(0.01)
+    assert len(calls) == 1
+    assert all(ws.sent[-1]["content"] == "x" * 1000 for ws in sockets)
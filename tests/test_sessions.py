@@ -0,0 +1,37 @@
+import os
+from server.main import TTLCache, load_session_secret, sign_session, verify_session
+
+def test_session_round_trip():
+    assert verify_session(sign_session(42)) == 42
+
+def test_session_rejects_tampering_and_expiry():
+    token = sign_session(42)
+    uid, expires, sig = token.split(".")
+    assert verify_session(f"43.{expires}.{sig}") is None
+    assert verify_session(sign_session(42, ttl=-1)) is None
+    assert verify_session("42") is None
+    assert verify_session(None) is None
+
+def test_ttl_cache_is_bounded_lru():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set(1, "alice")
+    cache.set(2, "bob")
+    assert cache.get(1) == "alice"
+    cache.set(3, "carol")  # Evicts 2, the least recently used
+    assert cache.get(2) is None and len(cache) == 2
+    cache.invalidate(1)
+    assert cache.get(1) is None
+
+def test_ttl_cache_expires_entries():
+    cache = TTLCache(maxsize=10, ttl=-1)
+    cache.set(1, "alice")
+    assert cache.get(1) is None
+
+def test_generated_session_key_is_persisted_owner_only(tmp_path, monkeypatch):
+    monkeypatch.delenv("SESSION_SECRET", raising=False)
+    path = str(tmp_path / "state" / "session.key")
+    key = load_session_secret(path)
+    assert load_session_secret(path) == key and len(key) == 64  # The next process reuses it
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    monkeypatch.setenv("SESSION_SECRET", "configured")
+    assert load_session_secret(path) == b"configured"
@@ -0,0 +1,45 @@
+import asyncio
+from conftest import FakeSocket
+from server.main import DimensionRegistry, TimerWheel, self_destruct_ttl, SELF_DESTRUCT_MAX
+
+def run_until_empty(wheel, limit=10000):
+    fired = {}
+    for _ in range(limit):
+        if not len(wheel): break
+        for entry in wheel.advance():
+            fired[entry.key] = wheel.now_tick
+    return fired
+
+def test_entries_fire_on_their_tick_across_levels():
+    wheel = TimerWheel(slots=8, levels=3)
+    delays = [1, 5, 7, 8, 9, 63, 64, 65, 200, 511]
+    for d in delays:
+        wheel.schedule(d, "room", f"m{d}")
+    fired = run_until_empty(wheel)
+    assert fired == {f"m{d}": d for d in delays}
+
+def test_cancel_group_purges_room():
+    wheel = TimerWheel(slots=8, levels=2)
+    for d in range(1, 30):
+        wheel.schedule(d, "doomed", f"m{d}")
+    wheel.schedule(3, "other", "keep")
+    assert wheel.cancel_group("doomed") == 29
+    assert len(wheel) == 1
+    assert list(run_until_empty(wheel)) == ["keep"]
+
+def test_ttl_is_clamped():
+    assert self_destruct_ttl(True) == 30
+    assert self_destruct_ttl(1) == 5
+    assert self_destruct_ttl(10 ** 9) == SELF_DESTRUCT_MAX
+    assert self_destruct_ttl(False) is None and self_destruct_ttl("30") is None
+
+async def test_expiry_evicts_from_backlog():
+    reg = DimensionRegistry()
+    ws = FakeSocket()
+    await reg.join(ws, "room", "alice", "pw")
+    await reg.broadcast("room", {"type": "message", "id": "m1", "content": "boom"})
+    assert len(reg.rooms["room"].backlog) == 1
+    await reg.expire_message("room", "m1")
+    await asyncio.sleep(0.01)
+    assert len(reg.rooms["room"].backlog) == 0
+    assert ws.sent[-1] == {"type": "delete_msg", "id": "m1"}
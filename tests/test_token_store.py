@@ -0,0 +1,31 @@
+from server.main import MemoryTokenStore, SQLiteTokenStore
+
+async def test_tokens_are_single_use():
+    store = MemoryTokenStore()
+    token = await store.issue(1, "alice")
+    assert (await store.redeem(token))["user"] == "alice"
+    assert await store.redeem(token) is None
+    assert store.stats() == {"issued": 1, "redeemed": 1, "expired": 0, "held": 0}
+
+async def test_sweep_removes_abandoned_tokens():
+    store = MemoryTokenStore()
+    for i in range(100):
+        await store.issue(i, "ghost", ttl=-1)
+    assert await store.sweep() == 1  # Each issue already swept the ones before it
+    live = await store.issue(1, "alice")
+    assert len(store) == 1 and store.expired == 100
+    assert await store.redeem(live)
+
+async def test_sqlite_store_is_shared_between_workers(tmp_path):
+    path = str(tmp_path / "tokens.db")
+    minting, redeeming = SQLiteTokenStore(path), SQLiteTokenStore(path)
+    token = await minting.issue(7, "bob")
+    data = await redeeming.redeem(token)
+    assert (data["uid"], data["user"]) == (7, "bob")
+    assert await minting.redeem(token) is None
+    await minting.issue(8, "eve", ttl=-1)
+    await minting.issue(9, "carol")
+    assert await redeeming.sweep() == 1
+    assert len(redeeming) == 1  # Counted by the sweep, not per call
+    minting.close()
+    redeeming.close()
@@ -0,0 +1,62 @@
+import asyncio
+import uuid
+from conftest import FakeSocket
+import server.main as main
+from server.main import CHUNK_HEADER, CHUNK_KIND, CHUNK_LAST, DimensionRegistry
+
+def chunk(tid, index, payload, last=False):
+    return CHUNK_HEADER.pack(CHUNK_KIND, tid, index, CHUNK_LAST if last else 0) + payload
+
+async def room_of_three():
+    reg = DimensionRegistry()
+    sockets = [FakeSocket() for _ in range(3)]
+    for i, ws in enumerate(sockets):
+        await reg.join(ws, "room", f"user{i}", "pw")
+    return reg, sockets
+
+async def test_chunks_are_relayed_as_the_same_object():
+    reg, (sender, a, b) = await room_of_three()
+    tid = uuid.uuid4().bytes
+    assert reg.open_transfer(sender, "room", {"id": tid.hex(), "size": 10}) is None
+    first, last = chunk(tid, 0, b"x" * 6), chunk(tid, 1, b"y" * 4, last=True)
+    await reg.relay_chunk(sender, "room", first)
+    await reg.relay_chunk(sender, "room", last)
+    await asyncio.sleep(0.01)
+    assert a.chunks[0] is first and b.chunks[1] is last and not sender.chunks
+    room = reg.rooms["room"]
+    assert not room.transfers and room.transfer_bytes == 0 and room.states[sender].transfer_bytes == 0
+
+async def test_budgets_and_oversend_are_enforced(monkeypatch):
+    monkeypatch.setattr(main, "MEDIA_MAX_CONN_BYTES", 15)
+
+    reg, (sender, a, _) = await room_of_three()
+    tid = uuid.uuid4().bytes
+    assert reg.open_transfer(sender, "room", {"id": tid.hex(), "size": 10}) is None
+    assert reg.open_transfer(sender, "room", {"id": uuid.uuid4().hex, "size": 10})
+    assert reg.open_transfer(sender, "room", {"id": "nothex", "size": 1})
+    await reg.relay_chunk(sender, "room", chunk(tid, 0, b"z" * 11))
+    await asyncio.sleep(0.01)
+    assert not a.chunks and a.sent[-1]["type"] == "transfer_aborted"
+    assert reg.rooms["room"].transfer_bytes == 0
+
+async def test_sender_leaving_aborts_transfer():
+    reg, (sender, a, _) = await room_of_three()
+    tid = uuid.uuid4().bytes
+    reg.open_transfer(sender, "room", {"id": tid.hex(), "size": 10})
+    await reg.leave(sender, "room")
+    await asyncio.sleep(0.01)
+    assert {"type": "transfer_aborted", "transfer_id": tid.hex()} in a.sent
+    assert not reg.rooms["room"].transfers
+
+async def test_stalled_transfer_expires_in_heartbeat():
+    reg, (sender, a, _) = await room_of_three()
+    stalled, moving = uuid.uuid4().bytes, uuid.uuid4().bytes
+    reg.open_transfer(sender, "room", {"id": stalled.hex(), "size": 10})
+    reg.open_transfer(sender, "room", {"id": moving.hex(), "size": 10})
+    room = reg.rooms["room"]
+    room.transfers[stalled].last_chunk -= main.MEDIA_TRANSFER_TIMEOUT + 1
+    await reg.heartbeat()
+    await asyncio.sleep(0.01)
+    assert {"type": "transfer_aborted", "transfer_id": stalled.hex()} in a.sent
+    assert list(room.transfers) == [moving]
+    assert room.transfer_bytes == room.states[sender].transfer_bytes == 10
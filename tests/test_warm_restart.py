@@ -0,0 +1,83 @@
+import json
+import os
+from conftest import FakeSocket
+import server.main as main
+from server.main import DimensionRegistry, MessageBacklog, read_snapshot, write_snapshot
+
+def test_backlog_restore_keeps_numbering_and_gaps():
+    backlog = MessageBacklog(capacity=4)
+    for seq in range(1, 7):
+        backlog.append(seq, f'{{"seq":{seq}}}', f"m{seq}")
+    backlog.remove("m5")
+    restored = MessageBacklog(capacity=4)
+    restored.restore(backlog.first_seq, backlog.next_seq, backlog.items())
+    assert (restored.first_seq, restored.next_seq) == (3, 7)
+    assert restored.since(0) == backlog.since(0) == ['{"seq":3}', '{"seq":4}', '{"seq":6}']
+    assert restored.nbytes == backlog.nbytes
+    assert restored.remove("m6") and not restored.remove("m5")
+
+async def test_drain_snapshot_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "RECONNECT_JITTER_MS", 100)
+    path = str(tmp_path / "state" / "rooms.snap")
+
+    reg = DimensionRegistry()
+    alice, bob = FakeSocket(), FakeSocket()
+    await reg.join(alice, "room", "alice", "pw")
+    await reg.join(bob, "room", "bob", "pw")
+    await reg.broadcast("room", {"type": "message", "id": "keep", "content": "hi", "self_destruct": None})
+    await reg.broadcast("room", {"type": "message", "id": "burn", "content": "gone", "self_destruct": 30})
+    await reg.set_locked("room", True)
+    await reg.drain(timeout=0.5)
+    hint = alice.sent[-1]
+    assert hint["type"] == "reconnect" and main.RECONNECT_MIN_MS <= hint["after_ms"] <= main.RECONNECT_MIN_MS + 100
+    # Still numbered and sent while hints flush; the snapshot must not hand seq 3 out again
+    await reg.broadcast("room", {"type": "message", "id": "late", "content": "during drain"})
+    await reg.leave(alice, "room")
+    await reg.leave(bob, "room")
+    assert "room" in reg.rooms  # Kept while draining
+    assert not await reg.join(FakeSocket(), "other", "carol", "pw")
+    write_snapshot(path, reg.snapshot())
+    with open(path, "rb") as f:
+        assert b'"pw"' not in f.read()  # Only the seal is written, never the room password
+
+    restored = DimensionRegistry()
+    restored.restore(read_snapshot(path))
+    assert not os.path.exists(path)
+    room = restored.rooms["room"]
+    assert (room.admin, room.locked, room.returning) == ("alice", True, {"alice", "bob"})
+    assert [json.loads(f)["id"] for f in room.backlog.since(0)] == ["keep", "late"]
+    assert room.backlog.next_seq == 4
+    await restored.broadcast("room", {"type": "message", "id": "next", "content": "again"})
+    assert [json.loads(f)["seq"] for f in room.backlog.since(3)] == [4]
+
+async def test_dormant_rooms_admit_returning_members_then_expire():
+    old = DimensionRegistry()
+    await old.join(FakeSocket(), "room", "alice", "pw")
+    await old.join(FakeSocket(), "room", "bob", "pw")
+    await old.join(FakeSocket(), "empty", "carol", "pw")
+    await old.set_locked("room", True)
+
+    reg = DimensionRegistry()
+    now = main.time.monotonic()
+    reg.restore(main.decode_snapshot(old.snapshot()), now=now)
+    stranger, bob = FakeSocket(), FakeSocket()
+    assert not await reg.join(stranger, "room", "mallory", "pw")
+    assert stranger.sent[-1]["message"] == "Dimension Sealed"
+    assert await reg.join(bob, "room", "bob", "pw")
+    await reg.leave(bob, "room")
+    assert "room" in reg.rooms  # Still within the grace period
+    assert await reg.join(bob, "room", "bob", "pw")
+    reg.expire_dormant(now + main.WARM_RESTART_GRACE + 1)
+    assert "empty" not in reg.rooms
+    assert reg.rooms["room"].admin == "bob"  # alice never came back
+    assert not await reg.join(FakeSocket(), "room", "alice", "pw")  # Locked again for everyone
+
+def test_unnumbered_workers_claim_distinct_snapshot_slots(tmp_path):
+    first, first_lock = main.claim_snapshot_slot(str(tmp_path))
+    second, second_lock = main.claim_snapshot_slot(str(tmp_path))
+    assert (os.path.basename(first), os.path.basename(second)) == ("rooms-0.snap", "rooms-1.snap")
+    first_lock.close()  # That worker exited; its replacement takes over the slot
+    again, again_lock = main.claim_snapshot_slot(str(tmp_path))
+    assert again == first
+    second_lock.close()
+    again_lock.close()